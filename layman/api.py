@@ -16,8 +16,10 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import functools
 import os
 import sys
+import time
 
 from layman.config          import BareConfig
 from layman.dbbase          import UnknownOverlayException, UnknownOverlayMessage
@@ -26,8 +28,9 @@ from layman.remotedb        import RemoteDB
 from layman.overlays.source import require_supported
 #from layman.utils import path, delete_empty_directory
 from layman.compatibility   import encode
-from layman.utils           import get_ans, verify_overlay_src
+from layman.utils           import get_ans, int_option, verify_overlay_src
 from layman.mounter         import Mounter
+from layman.scheduler       import HookPool, SyncScheduler, source_host
 
 if sys.hexversion >= 0x30200f0:
     STR = str
@@ -68,6 +71,9 @@ class LaymanAPI(object):
         self._available_ids = None
         self._error_messages = []
         self.sync_results = []
+        # {'overlay-name': [(status, path), ...] or None if unknown}
+        # of the overlays synced successfully by the last sync() call
+        self.sync_changes = {}
 
         self.config.set_option('mounts', Mounter(self._get_installed_db,
                                                  self.get_installed,
@@ -178,9 +184,17 @@ class LaymanAPI(object):
         @type repos: list of strings or string
         @param repos: ['repo-id1', ...] or 'repo-id'
         """
+        repos = self._check_repo_type(repos, "readd_repos")
+        # keep the sparse checkouts set up when the overlays were added
+        sparse = {}
+        for ovl in repos:
+            if self.is_installed(ovl) and self.is_repo(ovl):
+                sparse[ovl] = self._get_installed_db().select(ovl).sparse_paths
         success = self.delete_repos(repos)
         if not success:
             return success
+        for ovl, sparse_paths in sparse.items():
+            self._get_remote_db().select(ovl).set_sparse_paths(sparse_paths)
         success = self.add_repos(repos)
         if update_news:
             self.update_news(repos)
@@ -383,11 +397,21 @@ class LaymanAPI(object):
         warnings = []
         success  = []
         repos = self._check_repo_type(repos, "sync")
+        # drop duplicates, the same overlay must not be synced concurrently
+        repos = [ovl for i, ovl in enumerate(repos) if ovl not in repos[:i]]
         db = self._get_installed_db()
         rdb = self._get_remote_db()
+        # (success, warnings, fatals) per overlay, so that the results are
+        # reported in the order of repos regardless of the job scheduling
+        results = dict((ovl, ([], [], [])) for ovl in repos)
+        tasks = []
+        types = {}
+        intervals = self._get_sync_intervals()
+        state = db.sync_state.read()
 
         self.output.debug("API.sync(); starting ovl loop", 5)
         for ovl in repos:
+            ovl_success, ovl_warnings, ovl_fatals = results[ovl]
             update_url = False
             self.output.debug("API.sync(); starting ovl = %s" %ovl, 5)
             try:
@@ -397,7 +421,7 @@ class LaymanAPI(object):
             except UnknownOverlayException as error:
                 #self.output.debug("API.sync(); UnknownOverlayException selecting %s" %ovl, 5)
                 #self._error(str(error))
-                fatals.append((ovl,
+                ovl_fatals.append((ovl,
                     'Failed to select overlay "%(repo)s".\nError was: %(error)s'
                      % {'repo': ovl, 'error': error}))
                 self.output.debug("API.sync(); UnknownOverlayException "
@@ -405,14 +429,25 @@ class LaymanAPI(object):
                     % {'repo': ovl}, 5)
                 continue
 
+            interval = intervals[1].get(ovl, intervals[0])
+            last_success = state.get(ovl, {}).get('last_success')
+            if interval > 0 and last_success:
+                age = time.time() - last_success
+                if 0 <= age < interval:
+                    ovl_success.append((ovl, 'Skipped overlay "%(repo)s", '
+                        'last synchronized %(age)d minute(s) ago.'
+                        % {'repo': ovl, 'age': age // 60}))
+                    continue
+
             try:
                 self.output.debug("API.sync(); try: self._get_remote_db().select(ovl)", 5)
                 ordb = rdb.select(ovl)
             except UnknownOverlayException:
+                ordb = None
                 message = 'Overlay "%(repo)s" could not be found in the remote '\
                         'lists.\nPlease check if it has been renamed and '\
                         're-add if necessary.' % {'repo': ovl}
-                warnings.append((ovl, message))
+                ovl_warnings.append((ovl, message))
                 (diff_type, update_url) = (False, False)
             else:
                 self.output.debug("API.sync(); else: self._get_remote_db().select(ovl)", 5)
@@ -423,13 +458,15 @@ class LaymanAPI(object):
                 try:
                     if diff_type:
                         self.output.debug("API.sync(); starting API.readd_repos(ovl)", 5)
-                        warnings.append((ovl, type_msg))
+                        ovl_warnings.append((ovl, type_msg))
                         self.readd_repos(ovl)
-                        success.append((ovl, 'Successfully readded overlay "' + ovl + '".'))
+                        ovl_success.append((ovl, 'Successfully readded overlay "' + ovl + '".'))
+                        # readd_repos() reloads the installed db
+                        db = self._get_installed_db()
                     else:
                         if update_url:
                             self.output.debug("API.sync() starting db.update(ovl)", 5)
-                            warnings.append((ovl, url_msg))
+                            ovl_warnings.append((ovl, url_msg))
                             update_success = db.update(ordb, available_srcs)
                             if not update_success:
                                 msg = 'Failed to update source URL for overlay'\
@@ -437,6 +474,7 @@ class LaymanAPI(object):
                                       % {'ovl': ovl}
                                 if get_ans(msg, color='yellow'):
                                     self.readd_repos(ovl)
+                                    db = self._get_installed_db()
                 except Exception as error:
                     self.output.warn('Failed to perform overlay type or url updates', 2)
                     self.output.warn('    for Overlay: %s' % ovl, 2)
@@ -444,14 +482,72 @@ class LaymanAPI(object):
                     continue
 
             try:
-                    self.output.debug("API.sync(); starting db.sync(ovl)", 5)
-                    db.sync(ovl)
-                    success.append((ovl,'Successfully synchronized overlay "' + ovl + '".'))
-            except Exception as error:
-                fatals.append((ovl,
+                source = db.select(ovl).sources[0]
+            except UnknownOverlayException as error:
+                ovl_fatals.append((ovl,
+                    'Failed to select overlay "%(repo)s".\nError was: %(error)s'
+                     % {'repo': ovl, 'error': error}))
+                continue
+            types[ovl] = source.type_key
+            alternates = []
+            if ordb:
+                alternates = [e.src for e in ordb.sources
+                              if e.type_key == source.type_key
+                              and e.src != source.src]
+            tasks.append((ovl, source_host(source.src), alternates))
+
+        # readd_repos() replaces the installed db, bind the jobs to the
+        # final one
+        db = self._get_installed_db()
+        tasks = [(ovl, host, functools.partial(db.sync, ovl,
+                                               alternates=alternates))
+                 for ovl, host, alternates in tasks]
+        self.output.debug("API.sync(); starting db.sync() jobs", 5)
+        scheduler = SyncScheduler(self.config)
+        tasks = scheduler.order(tasks, state, types)
+        hooks = None
+        hook_results = []
+        postsync_jobs = int_option(self.config, 'postsync_jobs', 0)
+        if postsync_jobs > 0 and tasks:
+            hooks = HookPool(postsync_jobs, self.output)
+            self.config.set_option('postsync_pool', hooks)
+        try:
+            sync_results = scheduler.run(tasks)
+        finally:
+            if hooks is not None:
+                self.config.set_option('postsync_pool', None)
+                self.output.info('Waiting for the postsync hooks...', 3)
+                hook_results = hooks.wait()
+        self.sync_changes = {}
+        for ovl, result, error in sync_results:
+            attempts = db.select(ovl).sync_attempts
+            if len(attempts) > 1:
+                results[ovl][1].append((ovl,
+                    self._format_sync_attempts(ovl, attempts)))
+            if error is None:
+                self.sync_changes[ovl] = db.select(ovl).changes
+                results[ovl][0].append((ovl,
+                    'Successfully synchronized overlay "' + ovl + '".'))
+            else:
+                results[ovl][2].append((ovl,
                     'Failed to sync overlay "%(repo)s".\nError was: %(err)s'
                     % {'repo': ovl, 'err': error}))
 
+        for ovl, result, error in hook_results:
+            if error is None and not result:
+                results[ovl][0].append((ovl,
+                    'Finished the postsync hook of overlay "' + ovl + '".'))
+            else:
+                results[ovl][2].append((ovl,
+                    'Postsync hook of overlay "%(repo)s" failed.\nError '
+                    'was: %(err)s'
+                    % {'repo': ovl, 'err': error or 'exit status %s' % result}))
+
+        for ovl in repos:
+            success.extend(results[ovl][0])
+            warnings.extend(results[ovl][1])
+            fatals.extend(results[ovl][2])
+
         if output_results:
             if success:
                 message = '\nSucceeded:\n------\n'
@@ -479,6 +575,50 @@ class LaymanAPI(object):
         return fatals == []
 
 
+    @staticmethod
+    def _format_sync_attempts(ovl, attempts):
+        """returns a message listing the sync attempts of an overlay
+
+        @param attempts: list of (source URL, status, error) tuples
+        """
+        lines = ['Overlay "%(repo)s" needed %(count)d sync attempts:'
+                 % {'repo': ovl, 'count': len(attempts)}]
+        for i, (src, status, error) in enumerate(attempts):
+            if status == 0:
+                outcome = 'succeeded'
+            elif error is not None:
+                outcome = 'failed: %s' % str(error).split('\n')[0]
+            else:
+                outcome = 'failed with status %s' % status
+            lines.append('  %(num)d. %(src)s %(outcome)s'
+                         % {'num': i + 1, 'src': src, 'outcome': outcome})
+        return '\n'.join(lines)
+
+
+    def _get_sync_intervals(self):
+        """returns the minimum sync interval in seconds along with a dict
+        of the per overlay intervals overriding it
+
+        The --stale-only HOURS option replaces all of them for the run.
+        """
+        stale_only = self.config['stale_only']
+        if stale_only is not None:
+            return (float(stale_only) * 3600, {})
+        default = int_option(self.config, 'sync_min_interval', 0)
+        overrides = {}
+        for line in (self.config['overlay_sync_intervals'] or '').split('\n'):
+            entry = line.split()
+            if not entry:
+                continue
+            try:
+                overrides[entry[0]] = int(entry[1])
+            except (IndexError, ValueError):
+                self.output.warn('Invalid overlay_sync_intervals entry '
+                                 '"%(entry)s", expected "overlay seconds"'
+                                 % {'entry': line.strip()})
+        return (default, overrides)
+
+
     def fetch_remote_list(self):
         """
         Fetches the latest remote overlay list.
@@ -495,7 +635,10 @@ class LaymanAPI(object):
             self.output.error('Failed to fetch overlay list!\n Original Error'
                               ' was:\n%(err)s' % {'err': error})
             return False
-        self.get_available(dbreload)
+        # cache() updated the remote db with the lists it parsed
+        if dbreload:
+            self._available_ids = None
+        self.get_available()
         return succeeded
 
 
@@ -515,6 +658,22 @@ class LaymanAPI(object):
         return self._installed_ids[:]
 
 
+    def get_sync_state(self, repos=None):
+        """returns the recorded add/sync state of the installed overlays
+
+        @type repos: list of strings or string
+        @param repos: optional ['repo-id', ...]; all recorded overlays
+                      if None
+        @rtype dict: {'repo-id': {'start': ..., 'duration': ...,
+                     'status': ..., 'revision': ..., ...}, ...}
+        """
+        state = self._get_installed_db().sync_state.read()
+        if repos is None:
+            return state
+        repos = self._check_repo_type(repos, "get_sync_state")
+        return dict((ovl, state[ovl]) for ovl in repos if ovl in state)
+
+
     def _get_installed_db(self, dbreload=False):
         """returns the list of installed overlays"""
         if not self._installed_db or dbreload:
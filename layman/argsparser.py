@@ -46,6 +46,10 @@ _USAGE = """
   layman -f [-o URL]
   layman (-l|-L|-S)"""
 
+# Command line options that override a layman.cfg setting of the same
+# name, they fall back to the config file value when they are not given.
+CONFIG_OVERRIDES = ['sync_jobs']
+
 
 class ArgsParser(BareConfig):
     '''Handles the configuration and option parser.'''
@@ -143,6 +147,14 @@ class ArgsParser(BareConfig):
                              'ing order of the overlays in the PORTDIR_OVERLAY varia'
                              'ble.')
 
+        actions.add_argument('--sparse-paths',
+                             nargs = '+',
+                             metavar = 'PATH',
+                             help = 'Use this with the --add switch to only chec'
+                             'k out the given top level directories (categories)'
+                             ' of git overlays. metadata, profiles and eclass ar'
+                             'e always checked out.')
+
         actions.add_argument('-r',
                              '--readd',
                              nargs = '+',
@@ -161,6 +173,11 @@ class ArgsParser(BareConfig):
                              action = 'store_true',
                              help = 'Update all overlays.')
 
+        actions.add_argument('--sync-stats',
+                             action = 'store_true',
+                             help = 'Report the recorded timings, status and rev'
+                             'ision of the last add/sync of the installed overlays.')
+
         #-----------------------------------------------------------------
         # Path Options
 
@@ -265,6 +282,24 @@ class ArgsParser(BareConfig):
         # Additional Options
         etc_opts = self.parser.add_argument_group('<Additional options>')
 
+        etc_opts.add_argument('-j',
+                              '--jobs',
+                              action = 'store',
+                              type = int,
+                              dest = 'sync_jobs',
+                              help = 'Sets the number of overlays that are '
+                              'synchronized concurrently [default: %s].'
+                              % self.defaults['sync_jobs'])
+
+        etc_opts.add_argument('--stale-only',
+                              action = 'store',
+                              type = float,
+                              metavar = 'HOURS',
+                              help = 'Use this with the --sync or --sync-all sw'
+                              'itch to only synchronize the overlays that were '
+                              'last synchronized successfully more than HOURS '
+                              'ago.')
+
         etc_opts.add_argument('--protocol_filter',
                               nargs = '+',
                               help = 'Sets the protocol filter that determines '
@@ -382,7 +417,8 @@ class ArgsParser(BareConfig):
         self.output.debug('ARGSPARSER: Retrieving options option: %s' % key, 9)
 
         if (key in self.options.keys()
-            and not self.options[key] is False):
+            and not self.options[key] is False
+            and not (key in CONFIG_OVERRIDES and self.options[key] is None)):
             return self.options[key]
 
         self.output.debug('ARGSPARSER: Retrieving config option: %s' % key, 9)
@@ -25,6 +25,7 @@ __version__ = "$Id: cli.py 2011-01-15 23:52 PST Brian Dolbec$"
 
 
 import os, sys
+import time
 
 from layman.api import LaymanAPI
 from layman.utils import (decode_selection, encoder, get_encoding,
@@ -148,7 +149,8 @@ class Main(object):
                         ('disable',    'Disable'),
                         ('enable',     'Enable'),
                         ('list',       'ListRemote'),
-                        ('list_local', 'ListLocal'),]
+                        ('list_local', 'ListLocal'),
+                        ('sync_stats', 'SyncStats'),]
 
     def __call__(self):
         self.output.debug("CLI.__call__(): self.config.keys()"
@@ -374,6 +376,46 @@ class Main(object):
         return info != {}
 
 
+    def SyncStats(self):
+        ''' Reports the recorded add/sync state of the installed overlays,
+        slowest first.
+        '''
+        self.output.debug('Printing the sync state.', 6)
+        state = self.api.get_sync_state()
+        installed = self.api.get_installed()
+        names = sorted((ovl for ovl in installed if ovl in state),
+                       key=lambda ovl: (-state[ovl]['duration'], ovl))
+
+        for ovl in names:
+            entry = state[ovl]
+            if entry['status']:
+                status = 'failed (%d)' % entry['status']
+            else:
+                status = 'ok'
+            last = time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.localtime(entry['end']))
+            line = '%s %s %8.1fs  %-11s %s' % (pad(ovl, 25), last,
+                entry['duration'], status, entry['action'])
+            self.output.info(line, 1)
+            details = ['syncs: %d' % entry['syncs'],
+                       'failures: %d' % entry['failures']]
+            if entry.get('bytes') is not None:
+                details.append('bytes: %d' % entry['bytes'])
+            if entry.get('revision'):
+                details.append('revision: %s' % entry['revision'])
+            self.output.notice('    ' + ', '.join(details))
+
+        missing = sorted(ovl for ovl in installed if ovl not in state)
+        if missing:
+            self.output.notice('')
+            self.output.info('No recorded syncs for: %s'
+                             % ', '.join(missing), 1)
+
+        # blank newline  -- no " *"
+        self.output.notice('')
+        return state != {}
+
+
     def ListLocal(self):
         ''' Lists the local overlays.
         '''
@@ -96,9 +96,11 @@ class BareConfig(object):
             'cache'     : '%(storage)s/cache',
             'local_list': '%(storage)s/overlays.xml',
             'installed': '%(storage)s/installed.xml',
+            'sync_state': '%(storage)s/sync_state.json',
             'protocol_filter': '',
             'auto_sync': 'No',
             'check_official': 'Yes',
+            'check_upstream': 'No',
             'conf_type': 'repos.conf',
             'db_type': 'xml',
             'require_repoconfig': 'Yes',
@@ -130,7 +132,12 @@ class BareConfig(object):
             'rsync_command': path([self.root, EPREFIX,'/usr/bin/rsync']),
             'svn_command': path([self.root, EPREFIX,'/usr/bin/svn']),
             'tar_command': path([self.root, EPREFIX,'/bin/tar']),
-            't/f_options': ['check_official', 'clean_archive', 'nocheck', 'require_repoconfig'],
+            'egencache_command': path([self.root, EPREFIX,'/usr/bin/egencache']),
+            'xdelta3_command': path([self.root, EPREFIX,'/usr/bin/xdelta3']),
+            't/f_options': ['check_official', 'check_upstream',
+                            'clean_archive', 'git_shared_objects', 'nocheck',
+                            'regen_cache', 'require_repoconfig',
+                            'sync_failover', 'tar_stream'],
             'bzr_addopts' : '',
             'bzr_syncopts' : '',
             'cvs_addopts' : '',
@@ -150,6 +157,7 @@ class BareConfig(object):
             'g-common_syncopts' : '',
             'g-sorcery_generateopts' : '',
             'g-sorcery_syncopts' : '',
+            'egencache_opts' : '',
             'bzr_postsync' : '',
             'cvs_postsync' : '',
             'darcs_postsync' : '',
@@ -163,7 +171,26 @@ class BareConfig(object):
             'g-sorcery_postsync' : '',
             'git_user': 'layman',
             'git_email': 'layman@localhost',
+            'git_clone_depth': '0',
+            'git_partial_clone': '',
+            'git_shared_objects': 'No',
+            'regen_cache': 'No',
+            'tar_stream': 'No',
+            'vcs_mirror_dir': '',
+            'vcs_mirror_interval': '600',
             'support_url_updates': ['Bzr', 'cvs', 'Git', 'Mercurial', 'Subversion'],
+            'command_timeout': '0',
+            'fetch_jobs': '4',
+            'postsync_jobs': '0',
+            'sync_jobs': '1',
+            'sync_manifest_dir': '',
+            'sync_host_limit': '4',
+            'sync_min_interval': '0',
+            'sync_order': 'longest',
+            'sync_failover': 'No',
+            'sync_retries': '0',
+            'sync_retry_delay': '5',
+            'overlay_sync_intervals': '',
             }
         self._options = {
             'config': config if config else self._defaults['config'],
@@ -177,6 +204,7 @@ class BareConfig(object):
             'verbose': verbose,
             'quiet': quiet,
             'custom_news_func': None,
+            'custom_sync_order_func': None,
             }
         self._set_quietness(quietness)
         self.config = None
@@ -28,10 +28,15 @@ __version__ = "$Id: db.py 309 2007-04-09 16:23:38Z wrobel $"
 #-------------------------------------------------------------------------------
 
 import os, os.path
+import tempfile
+import threading
+import time
 
+from   layman.compatibility     import fileopen
 from   layman.utils             import path, delete_empty_directory, get_ans
 from   layman.dbbase            import DbBase
 from   layman.repoconfmanager   import RepoConfManager
+from   layman.syncstate         import SyncState
 
 #===============================================================================
 #
@@ -64,6 +69,9 @@ class DB(DbBase):
                           )
 
         self.repo_conf = RepoConfManager(self.config, self.overlays)
+        self.sync_state = SyncState(self.config)
+        # serializes the source URL updates of concurrent syncs
+        self._update_lock = threading.Lock()
 
         self.output.debug('DB handler initiated', 6)
 
@@ -111,8 +119,10 @@ class DB(DbBase):
         if overlay.name not in self.overlays.keys():
             if not self._check_official(overlay):
                 return False
+            if self.config['sparse_paths']:
+                overlay.set_sparse_paths(self.config['sparse_paths'])
             self.output.debug('RemoteDB.__init__(), DB.add overlay.add() call', 4)
-            result = overlay.add(self.config['storage'])
+            result = self._timed(overlay, 'add', overlay.add)
             if result == 0:
                 if 'priority' in self.config.keys():
                     overlay.set_priority(self.config['priority'])
@@ -121,6 +131,8 @@ class DB(DbBase):
                 repo_ok = self.repo_conf.add(overlay)
                 if False in repo_ok:
                     return False
+                # egencache needs the repository config written above
+                overlay.regen_cache(self.config['storage'])
                 return True
             else:
                 mdir = path([self.config['storage'], overlay.name])
@@ -148,6 +160,7 @@ class DB(DbBase):
         '''
         if overlay.name in self.overlays.keys():
             overlay.delete(self.config['storage'])
+            self.sync_state.remove(overlay.name)
             repo_ok = self.repo_conf.delete(overlay)
             self.remove(overlay, self.path)
             self.write(self.path, remove=True)
@@ -197,8 +210,12 @@ class DB(DbBase):
         @params available_srcs: set of available source URLs.
         '''
 
-        source, result = self.overlays[overlay.name].update(self.config['storage'],
-                                                    available_srcs)
+        updated = self.overlays[overlay.name].update(self.config['storage'],
+                                                     available_srcs)
+        if not isinstance(updated, tuple):
+            # Overlay.update() returns 1 for unsupported protocols
+            return False
+        source, result = updated
         result = [result]
         self.overlays[overlay.name].sources = source
         result.extend(self.repo_conf.update(self.overlays[overlay.name]))
@@ -210,12 +227,116 @@ class DB(DbBase):
 
 
 
-    def sync(self, overlay_name):
-        '''Synchronize the given overlay.'''
+    def _timed(self, overlay, action, func):
+        '''
+        Runs an overlay add/sync and records its outcome in the sync
+        state store.
+
+        @params overlay: layman.overlays.Overlay object.
+        @params action: 'add' or 'sync'.
+        @params func: overlay method called with the storage base.
+        @rtype int: the result of func.
+        '''
+        base = self.config['storage']
+        start = time.time()
+        result = 1
+        try:
+            result = func(base)
+        finally:
+            revision = transferred = None
+            if len(overlay.sources) == 1:
+                source = overlay.sources[0]
+                transferred = source.transferred
+                if result == 0:
+                    try:
+                        revision = source.local_revision(base)
+                    except Exception as error:
+                        self.output.debug('DB._timed(); failed to read the '
+                                          'revision of %(name)s: %(err)s'
+                                          % {'name': overlay.name,
+                                             'err': error}, 4)
+            self.sync_state.record(overlay.name, action, start, time.time(),
+                                   result, revision=revision,
+                                   transferred=transferred)
+        return result
+
+
+    def sync(self, overlay_name, alternates=None):
+        '''
+        Synchronize the given overlay.
+
+        @params overlay_name: string of the overlay name.
+        @params alternates: list of alternate source URLs. With
+                            sync_failover set, when the sync fails
+                            because the overlay's source cannot be
+                            reached the overlay is switched to each of
+                            them in turn (via update()) until a sync
+                            succeeds.
+        '''
 
         overlay = self.select(overlay_name)
-        result = overlay.sync(self.config['storage'])
+        overlay.sync_attempts = []
+        if not self.config['sync_failover']:
+            alternates = None
+
+        def sync_sources(base):
+            result, error = 1, None
+            for src in [None] + list(alternates or []):
+                if src is not None:
+                    # local failures (merge conflicts, local changes)
+                    # would follow the overlay to any other source
+                    if not overlay.sources[0].upstream_unreachable(base):
+                        break
+                    self.output.warn('Failing over overlay "%(repo)s" to '
+                                     'source %(src)s'
+                                     % {'repo': overlay_name, 'src': src}, 2)
+                    with self._update_lock:
+                        if not self.update(overlay, [src]):
+                            continue
+                try:
+                    result, error = overlay.sync(base), None
+                except Exception as err:
+                    result, error = 1, err
+                if result == 0:
+                    break
+            if error is not None:
+                raise error
+            return result
+
+        result = self._timed(overlay, 'sync', sync_sources)
         if result:
             raise Exception('Syncing overlay "' + overlay_name +
                             '" returned status ' + str(result) + '!' +
                             '\ndb.sync()')
+        if self.config['sync_manifest_dir']:
+            self._write_manifest(overlay)
+
+
+    def _write_manifest(self, overlay):
+        '''
+        Writes the files changed by the last sync of the overlay to
+        <sync_manifest_dir>/<overlay name>.changes, one "status<TAB>path"
+        line per file.  The file is removed when the changes are unknown.
+
+        @params overlay: layman.overlays.Overlay object.
+        '''
+        manifest_dir = self.config['sync_manifest_dir']
+        manifest = path([manifest_dir, overlay.name + '.changes'])
+        try:
+            if overlay.changes is None:
+                if os.path.exists(manifest):
+                    os.unlink(manifest)
+                return
+            if not os.path.isdir(manifest_dir):
+                os.makedirs(manifest_dir)
+            fd, temp_path = tempfile.mkstemp(dir=manifest_dir,
+                                             prefix='.' + overlay.name)
+            os.close(fd)
+            with fileopen(temp_path, 'w') as manifest_file:
+                for status, name in overlay.changes:
+                    manifest_file.write('%s\t%s\n' % (status, name))
+            os.rename(temp_path, manifest)
+        except (IOError, OSError) as error:
+            self.output.warn('Failed to write the sync manifest %(path)s'
+                             '\nError was: %(err)s'
+                             % {'path': manifest, 'err': error}, 2)
@@ -26,6 +26,7 @@ __version__ = "$Id: xml_db.py 273 2015-07-07 10:30:30Z twitch153 $"
 #
 #-------------------------------------------------------------------------------
 
+import io
 import sys
 import xml
 import xml.etree.ElementTree as ET # Python 2.5
@@ -100,21 +101,20 @@ class DBHandler(object):
         '''
         Read the overlay definition file.
         '''
-        document = text
-
-        if not document:
-            try:
-                with fileopen(path, 'r') as df:
-                    document = df.read()
-            except Exception as error:
-                if not self.ignore_init_read_errors:
-                    msg = 'XML DBHandler - Failed to read the overlay list at '\
-                      '"%(path)s"' % {'path': path}
+        if text:
+            return self.read(text, origin=path)
+
+        try:
+            document = open(path, 'rb')
+        except Exception as error:
+            if not self.ignore_init_read_errors:
+                msg = 'XML DBHandler - Failed to read the overlay list at '\
+                  '"%(path)s"' % {'path': path}
                 self.output.error(msg)
-                return False
+            return False
 
-        success = self.read(document, origin=path)
-        return success
+        with document:
+            return self._read_stream(document, origin=path)
 
 
     def read(self, text, origin):
@@ -122,22 +122,60 @@ class DBHandler(object):
         Read an xml list of overlays (adding to and potentially overwriting
         existing entries)
         '''
+        if isinstance(text, bytes):
+            document = io.BytesIO(text)
+        else:
+            document = io.StringIO(text)
+        return self._read_stream(document, origin)
+
+
+    def _read_stream(self, document, origin):
+        '''
+        Reads the overlays of the list in the file object document.  None
+        of them are added if the list turns out to be broken.
+        '''
+        overlays = {}
         try:
-            document = ET.fromstring(text)
+            for ovl in self.iter_overlays(document):
+                overlays[ovl.name] = ovl
         except ET.ParseError as error:
             msg = 'XML DBHandler - ET.ParseError: %(err)s' % {'err': error}
             self.output.error(msg)
             return False
 
-        overlays = document.findall('overlay') + document.findall('repo')
+        self.overlays.update(overlays)
+        return True
 
-        for overlay in overlays:
-            msg = 'XML DBHandler - Parsing overlay: %(ovl)s' % {'ovl': overlay}
-            self.output.debug(msg, 9)
-            ovl = Overlay(config=self.config, xml=overlay, ignore=self.ignore)
-            self.overlays[ovl.name] = ovl
 
-        return True
+    def iter_overlays(self, document):
+        '''
+        Parses the xml list of overlays in the file object document
+        incrementally, yielding each overlay as soon as its element is
+        complete.  The elements are dropped once they are parsed, so
+        neither the text nor the tree of the whole list are kept in memory.
+
+        @rtype generator of Overlay objects.
+        @raise ET.ParseError: if the list is broken.
+        '''
+        depth = 0
+        root = None
+        for event, element in ET.iterparse(document, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            # the overlays are the children of the root element
+            if depth != 1:
+                continue
+            if element.tag in ('overlay', 'repo'):
+                msg = 'XML DBHandler - Parsing overlay: %(ovl)s'\
+                      % {'ovl': element}
+                self.output.debug(msg, 9)
+                yield Overlay(config=self.config, xml=element,
+                              ignore=self.ignore)
+            root.clear()
 
 
     def add_new(self, xml=None, origin=None):
@@ -1,22 +1,64 @@
 #!/usr/bin/python
 from __future__ import unicode_literals
 
+import hashlib
+import json
 import os
 import sys
 import shutil
 import tempfile
 
+from urllib.error import HTTPError
+from urllib.request import build_opener, ProxyHandler, Request
+
 import xml.etree.ElementTree as ET # Python 2.5
 
 from  layman.constants         import MOUNT_TYPES
 from  layman.compatibility     import fileopen
-from  layman.overlays.source   import OverlaySource, require_supported
-from  layman.utils             import path
+from  layman.overlays.source   import (OverlaySource, require_supported,
+                                       tree_snapshot, tree_changes)
+from  layman.utils             import exchange_paths, path
 from  layman.version           import VERSION
-from  sslfetch.connections     import Connector
 
 USERAGENT = "Layman-" + VERSION
 
+# archives are downloaded and hashed in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+class _TeeReader(object):
+    '''
+    File like wrapper around a stream feeding all data read from it to
+    a list of hashes and an optional copy of the archive.
+    '''
+    def __init__(self, stream, hashes, copy=None):
+        self.stream = stream
+        self.hashes = hashes
+        self.copy = fileopen(copy, 'wb') if copy else None
+        self.transferred = 0
+
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        for checksum in self.hashes:
+            checksum.update(data)
+        if self.copy:
+            self.copy.write(data)
+        self.transferred += len(data)
+        return data
+
+
+    def drain(self):
+        '''Reads the rest of the stream, e.g. the end of archive padding.'''
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+    def close(self):
+        if self.copy:
+            self.copy.close()
+        self.stream.close()
+
+
 class ArchiveOverlay(OverlaySource):
 
     type = 'Archive'
@@ -32,52 +74,493 @@ class ArchiveOverlay(OverlaySource):
         self.proxies = config.proxies
         self.branch = self.parent.branch
         self.mount_me = bool(self.type in MOUNT_TYPES)
+        # set when the last sync found the archive unchanged
+        self.not_modified = False
 
 
-    def _fetch(self, base, archive_url, dest_dir):
+    def _fetch(self, base, archive_url, validators=None):
         '''
         Fetches overlay source archive.
 
         @params base: string of directory base for installed overlays.
         @params archive_url: string of URL where archive is located.
-        @params dest_dir: string of destination of extracted archive.
-        @rtype tuple (str of package location, bool to clean_archive)
+        @params validators: dict of the installed archive, see
+                            _read_validators(), makes the download
+                            conditional.
+        @rtype tuple (str of package location or None if the server
+               reported the archive as not modified, dict of the
+               validators of the fetched archive)
         '''
         ext = self.get_extension()
  
         if 'file://' not in archive_url:
-            # set up ssl-fetch output map
-            connector_output = {
-                'info': self.output.debug,
-                'error': self.output.error,
-                'kwargs-info': {'level': 5},
-                'kwargs-debug': {'level': 2},
-                'kwargs-error': {'level': None},
-            }
+            pkg = path([base, self.parent.name + ext])
+            try:
+                fetched = self._download(archive_url, pkg, validators)
+            except Exception as error:
+                raise Exception('Failed to fetch the archive %(url)s to '\
+                                '%(pkg)s\nError was: %(error)s'\
+                                % ({'url': archive_url, 'pkg': pkg,
+                                    'error': error}))
+            if fetched is None:
+                return (None, validators)
+            return (pkg, fetched)
+
+        self.clean_archive = False
+        pkg = archive_url.replace('file://', '')
+        content = hashlib.sha256()
+        checksum = self._new_checksum()
+        with fileopen(pkg, 'rb') as archive:
+            for chunk in iter(lambda: archive.read(CHUNK_SIZE), b''):
+                content.update(chunk)
+                if checksum is not None:
+                    checksum.update(chunk)
+        if checksum is not None:
+            self._verify_checksum(checksum, pkg)
+        return (pkg, {'url': archive_url, 'sha256': content.hexdigest()})
+
+
+    def _download(self, url, pkg, validators=None):
+        '''
+        Streams the archive at url to pkg + '.part' and renames it to pkg
+        once it is complete and matches the digest of the source.  A
+        partial download left by an interrupted fetch is resumed with an
+        HTTP Range request, made conditional with If-Range on the ETag or
+        Last-Modified date the partial download was started with.
+        Otherwise the request is made conditional on the ETag and
+        Last-Modified date of the validators.
+
+        @params url: string of the archive URL.
+        @params pkg: string location the archive is stored at.
+        @params validators: dict of the installed archive or None.
+        @rtype dict of the validators of the downloaded archive, None if
+               the server reported it as not modified.
+        '''
+        part = pkg + '.part'
+        offset = 0
+        resume = None
+        if os.path.exists(part):
+            resume = self._read_part_validators(part)
+            if resume.get('url') == url:
+                offset = os.path.getsize(part)
+        response, offset = self._open_archive(url, offset, validators,
+                                              resume)
+        if response is None:
+            self.output.info('The archive %(url)s has not been modified'
+                             % {'url': url}, 4)
+            return None
+        if not offset:
+            headers = response.info()
+            self._record_part_validators(part, {
+                'url': url, 'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')})
+
+        content = hashlib.sha256()
+        checksum = self._new_checksum()
+        checksums = [c for c in (content, checksum) if c is not None]
+        self.transferred = 0
+        try:
+            if offset:
+                self.output.info('Resuming the download of %(url)s at '
+                                 '%(offset)d bytes'
+                                 % {'url': url, 'offset': offset}, 3)
+                with fileopen(part, 'rb') as in_file:
+                    for chunk in iter(lambda: in_file.read(CHUNK_SIZE), b''):
+                        for c in checksums:
+                            c.update(chunk)
+            with fileopen(part, 'ab' if offset else 'wb') as out_file:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out_file.write(chunk)
+                    for c in checksums:
+                        c.update(chunk)
+                    self.transferred += len(chunk)
+            headers = response.info()
+        finally:
+            response.close()
+
+        if checksum is not None:
+            try:
+                self._verify_checksum(checksum, url)
+            except Exception:
+                # do not resume from corrupt data
+                os.unlink(part)
+                self._record_part_validators(part, None)
+                raise
+        os.rename(part, pkg)
+        self._record_part_validators(part, None)
+        return {'url': url, 'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'sha256': content.hexdigest()}
+
+
+    def _open_archive(self, url, offset, validators=None, resume=None):
+        '''
+        Requests the archive at url from offset on.  The partial download
+        is only resumed if the archive still has the ETag or Last-Modified
+        date of resume, otherwise the whole archive is requested.
+
+        @params url: string of the archive URL.
+        @params offset: int number of bytes already downloaded.
+        @params validators: dict of the installed archive or None.
+        @params resume: dict of the archive the partial download was
+                        started for, see _read_part_validators().
+        @rtype tuple (response or None if not modified, int offset the
+               response data starts at)
+        '''
+        if_range = None
+        if resume:
+            etag = resume.get('etag')
+            # If-Range requires a strong validator
+            if etag and not etag.startswith('W/'):
+                if_range = etag
+            else:
+                if_range = resume.get('last_modified')
+        if offset and if_range:
+            response = None
+            try:
+                response = self._open_url(url, headers={
+                    'Range': 'bytes=%d-' % offset, 'If-Range': if_range})
+            except HTTPError as error:
+                # 416: the partial download does not fit the archive
+                if error.code != 416:
+                    raise
+            if response is not None:
+                content_range = response.info().get('Content-Range') or ''
+                if (response.getcode() == 206 and
+                    content_range.startswith('bytes %d-' % offset)):
+                    return (response, offset)
+                if response.getcode() == 200:
+                    # the archive changed or the server does not support
+                    # ranges
+                    return (response, 0)
+                response.close()
+            validators = None
+
+        headers = {}
+        if validators and validators.get('url') == url:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        try:
+            return (self._open_url(url, headers=headers), 0)
+        except HTTPError as error:
+            if error.code == 304:
+                return (None, 0)
+            raise
 
-            fetcher = Connector(connector_output, self.proxies, USERAGENT)
 
-            success, archive, timestamp = fetcher.fetch_content(archive_url)
+    def _fetch_extract(self, base, dest_dir, validators=None):
+        '''
+        Extracts the overlay source archive to dest_dir while it is read,
+        see streaming().  Remote archives are only kept, as
+        <base>/<name><extension>, if clean_archive is not set.
 
-            pkg = path([base, self.parent.name + ext])
+        @params base: string of directory base for installed overlays.
+        @params dest_dir: string of destination of the extracted archive.
+        @params validators: dict of the installed archive, see
+                            _read_validators(), makes the download
+                            conditional.
+        @rtype dict of the validators of the fetched archive, validators
+               if the server reported the archive as not modified.
+        '''
+        url = self.src
+        copy = None
+        if 'file://' in url:
+            stream = fileopen(url.replace('file://', ''), 'rb')
+            fetched = {'url': url}
+        else:
+            stream = self._open_archive(url, 0, validators)[0]
+            if stream is None:
+                self.output.info('The archive %(url)s has not been modified'
+                                 % {'url': url}, 4)
+                return validators
+            headers = stream.info()
+            fetched = {'url': url, 'etag': headers.get('ETag'),
+                       'last_modified': headers.get('Last-Modified')}
+            if not self.clean_archive:
+                copy = path([base, self.parent.name + self.get_extension()])
+
+        content = hashlib.sha256()
+        checksum = self._new_checksum()
+        reader = _TeeReader(stream,
+                            [c for c in (content, checksum) if c is not None],
+                            copy and copy + '.part')
+        try:
+            try:
+                self.extract_stream(reader, dest_dir)
+                reader.drain()
+            finally:
+                reader.close()
+            if checksum is not None:
+                self._verify_checksum(checksum, url)
+        except Exception:
+            if copy and os.path.exists(copy + '.part'):
+                os.unlink(copy + '.part')
+            raise
+
+        if copy:
+            os.rename(copy + '.part', copy)
+        if 'file://' not in url:
+            self.transferred = reader.transferred
+        fetched['sha256'] = content.hexdigest()
+        return fetched
+
+
+    def streaming(self):
+        '''
+        Determines whether the archive is extracted while it is
+        downloaded, by extract_stream(), instead of being fetched to a
+        file and extracted by post_fetch().
+
+        @rtype bool
+        '''
+        return False
+
+
+    def extract_stream(self, stream, dest_dir):
+        '''
+        Extracts the archive read from stream, see streaming().
+
+        @params stream: file like object of the archive.
+        @params dest_dir: string of destination of extracted archive.
+        '''
+        pass
+
+
+    def _new_checksum(self):
+        '''
+        @rtype hashlib object for the digest of the source, None if the
+               overlay definition gives no digest.
+        '''
+        if not self.digest:
+            return None
+        algorithm = self.digest.split(':', 1)[0].strip().lower()
+        try:
+            return hashlib.new(algorithm)
+        except ValueError:
+            raise Exception('Unsupported digest "%(digest)s" for overlay '\
+                            '"%(name)s", expected "algorithm:hexdigest"'\
+                            % {'digest': self.digest,
+                               'name': self.parent.name})
+
+
+    def _verify_checksum(self, checksum, location):
+        '''
+        Compares the checksum of the archive with the digest of the source.
+
+        @params checksum: hashlib object returned by _new_checksum().
+        @params location: string of the archive location for the message.
+        '''
+        expected = self.digest.split(':', 1)[-1].strip().lower()
+        if checksum.hexdigest() != expected:
+            raise Exception('The checksum of %(loc)s does not match: got '\
+                            '%(got)s, expected %(digest)s'\
+                            % {'loc': location, 'got': checksum.hexdigest(),
+                               'digest': self.digest})
 
+
+    def _open_url(self, url, method='GET', headers=None):
+        '''
+        Opens url through the configured proxies.
+
+        @params url: string of the URL to open.
+        @params method: string of the HTTP request method.
+        @params headers: optional dict of additional request headers.
+        @rtype file like response object.
+        '''
+        _headers = {'User-Agent': USERAGENT}
+        if headers:
+            _headers.update(headers)
+        request = Request(url, headers=_headers)
+        request.get_method = lambda: method
+        opener = build_opener(ProxyHandler(self.proxies))
+        return opener.open(request, timeout=60)
+
+
+    def _revision_file(self, base):
+        return path([base, self.parent.name + '.timestamp'])
+
+
+    def remote_revision(self, base):
+        '''
+        Identifies the current upstream archive by its ETag or its
+        Last-Modified date and size using a HEAD request, local archives
+        by their modification time and size.
+
+        @params base: string location where overlays are installed.
+        @rtype str or None
+        '''
+        if 'file://' in self.src:
             try:
-                with fileopen(pkg, 'w+b') as out_file:
-                    out_file.write(archive)
+                info = os.stat(self.src.replace('file://', ''))
+            except OSError:
+                return None
+            return '%s %s' % (repr(info.st_mtime), info.st_size)
+
+        try:
+            response = self._open_url(self.src, method='HEAD')
+            headers = response.info()
+            response.close()
+        except Exception as error:
+            self.output.debug('ArchiveOverlay.remote_revision(); HEAD request'
+                              ' for %(url)s failed: %(err)s'
+                              % {'url': self.src, 'err': error}, 4)
+            return None
+
+        if headers.get('ETag'):
+            return headers.get('ETag')
+        if headers.get('Last-Modified'):
+            return '%s %s' % (headers.get('Last-Modified'),
+                              headers.get('Content-Length', ''))
+        return None
+
+
+    def upstream_unreachable(self, base):
+        '''
+        Whether the archive is missing or its server does not answer a
+        HEAD request.
+
+        @params base: string location where overlays are installed.
+        @rtype bool
+        '''
+        if 'file://' in self.src:
+            return not os.path.exists(self.src.replace('file://', ''))
+        try:
+            self._open_url(self.src, method='HEAD').close()
+        except Exception:
+            return True
+        return False
+
+
+    def local_revision(self, base):
+        '''
+        Returns the upstream revision recorded at the last add/sync.
+
+        @params base: string location where overlays are installed.
+        @rtype str or None
+        '''
+        revision_file = self._revision_file(base)
+        if not os.path.exists(revision_file):
+            return None
+        with fileopen(revision_file) as revision:
+            return revision.read().strip() or None
+
+
+    def sync_snapshot(self, base):
+        '''The files of the installed overlay before the sync.'''
+        return tree_snapshot(path([base, self.parent.name]))
+
+
+    def changed_files(self, base, snapshot):
+        '''The differences between the files before and after the sync.'''
+        if snapshot is None:
+            return None
+        return tree_changes(snapshot,
+                            tree_snapshot(path([base, self.parent.name])))
+
+
+    def _record_revision(self, base, revision):
+        revision_file = self._revision_file(base)
+        if not revision:
+            if os.path.exists(revision_file):
+                os.unlink(revision_file)
+            return
+        with fileopen(revision_file, 'w') as out_file:
+            out_file.write(revision)
+
+
+    def _validators_file(self, base):
+        return path([base, self.parent.name + '.validators'])
+
+
+    def _read_validators(self, base):
+        '''
+        Returns the URL, ETag, Last-Modified date and sha256 hash of the
+        archive the installed overlay was extracted from.
+
+        @params base: string location where overlays are installed.
+        @rtype dict, empty if unknown.
+        '''
+        validators_file = self._validators_file(base)
+        if not os.path.exists(validators_file):
+            return {}
+        try:
+            with fileopen(validators_file) as in_file:
+                return json.load(in_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+
+    def _record_validators(self, base, validators):
+        validators_file = self._validators_file(base)
+        if not validators:
+            if os.path.exists(validators_file):
+                os.unlink(validators_file)
+            return
+        with fileopen(validators_file, 'w') as out_file:
+            json.dump(validators, out_file)
 
-            except Exception as error:
-                raise Exception('Failed to store archive package in '\
-                                '%(pkg)s\nError was: %(error)s'\
-                                % ({'pkg': pkg, 'error': error}))
-        
-        else:
-            self.clean_archive = False
-            pkg = archive_url.replace('file://', '')
 
-        return pkg
+    @staticmethod
+    def _read_part_validators(part):
+        '''
+        Returns the URL, ETag and Last-Modified date of the archive the
+        partial download at part was started for.
+
+        @params part: string location of the partial download.
+        @rtype dict, empty if unknown.
+        '''
+        try:
+            with fileopen(part + '.validators') as in_file:
+                return json.load(in_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
 
+    @staticmethod
+    def _record_part_validators(part, validators):
+        validators_file = part + '.validators'
+        if not validators:
+            if os.path.exists(validators_file):
+                os.unlink(validators_file)
+            return
+        with fileopen(validators_file, 'w') as out_file:
+            json.dump(validators, out_file)
 
-    def _add_unchecked(self, base):
+
+    def _install(self, base, conditional=False):
+        '''
+        Fetches and installs the archive, recording the upstream revision
+        it was fetched at.
+
+        @params base: string location where overlays are installed.
+        @params conditional: bool, skip the installation if the archive
+                             did not change since the installed one was
+                             fetched.
+        @rtype int
+        '''
+        revision = None
+        self.transferred = None
+        if self.config['check_upstream']:
+            # probed before fetching, a change in between only causes
+            # one more fetch on the next sync
+            revision = self.upstream_revision or self.remote_revision(base)
+        validators = None
+        target = path([base, self.parent.name])
+        if conditional and (os.path.ismount(target) if self.mount_me
+                            else os.path.exists(target)):
+            validators = self._read_validators(base)
+        result = self._add_unchecked(base, validators)
+        if result == 0:
+            self._record_revision(base, revision)
+        return result
+
+
+    def _add_unchecked(self, base, validators=None):
         def try_to_wipe(folder):
             if not os.path.exists(folder):
                 return
@@ -92,27 +575,54 @@ class ArchiveOverlay(OverlaySource):
                     % ({'dir': folder, 'err': error}))
 
         final_path = path([base, self.parent.name])
+        self.not_modified = False
+        pkg = temp_path = None
+        streaming = self.streaming() and not self.mount_me
         try:
-            if not self.mount_me:
+            if streaming:
                 temp_path = tempfile.mkdtemp(dir=base)
+                fetched = self._fetch_extract(base, temp_path, validators)
             else:
-                temp_path = final_path
-                if not os.path.exists(temp_path):
-                    os.mkdir(temp_path)
-                else:
-                    if os.path.ismount(temp_path):
-                      self.config['mounts'].umount([self.parent.name],
-                                                   dest=temp_path,
-                                                   sync=True)
-            pkg = self._fetch(base=base, archive_url=self.src,
-                dest_dir=temp_path)
-            result = self.post_fetch(pkg, temp_path)
-            if self.clean_archive:
-                os.unlink(pkg)
+                pkg, fetched = self._fetch(base=base, archive_url=self.src,
+                                           validators=validators)
         except Exception as error:
-            try_to_wipe(temp_path)
+            if temp_path:
+                try_to_wipe(temp_path)
             raise error
 
+        if validators and fetched.get('sha256') == validators.get('sha256'):
+            self.output.info('The archive of overlay "%(name)s" has not '
+                             'changed, keeping the installed files.'
+                             % {'name': self.parent.name}, 3)
+            if pkg is not None and self.clean_archive:
+                os.unlink(pkg)
+            if temp_path:
+                try_to_wipe(temp_path)
+            self.not_modified = True
+            return 0
+
+        if streaming:
+            result = 0
+        else:
+            try:
+                if not self.mount_me:
+                    temp_path = tempfile.mkdtemp(dir=base)
+                else:
+                    temp_path = final_path
+                    if not os.path.exists(temp_path):
+                        os.mkdir(temp_path)
+                    else:
+                        if os.path.ismount(temp_path):
+                          self.config['mounts'].umount([self.parent.name],
+                                                       dest=temp_path,
+                                                       sync=True)
+                result = self.post_fetch(pkg, temp_path)
+                if self.clean_archive:
+                    os.unlink(pkg)
+            except Exception as error:
+                try_to_wipe(temp_path)
+                raise error
+
         if result == 0 and not self.mount_me:
             if self.branch:
                 source = temp_path + os.path.sep + self.branch
@@ -120,11 +630,18 @@ class ArchiveOverlay(OverlaySource):
                 source = temp_path
 
             if os.path.exists(source):
-                if os.path.exists(final_path):
-                    self.delete(base)
-
                 try:
-                    os.rename(source, final_path)
+                    if not os.path.exists(final_path):
+                        os.rename(source, final_path)
+                    elif not exchange_paths(source, final_path):
+                        # no atomic exchange, keep the time without an
+                        # overlay down to two renames
+                        old_path = tempfile.mkdtemp(dir=base)
+                        os.rename(final_path,
+                                  path([old_path, self.parent.name]))
+                        os.rename(source, final_path)
+                        try_to_wipe(old_path)
+                    # otherwise the old tree is wiped along with temp_path
                 except Exception as error:
                     raise Exception('Failed to rename archive subdirectory '\
                         '%(src)s to %(path)s\nError was: %(err)s'\
@@ -138,6 +655,8 @@ class ArchiveOverlay(OverlaySource):
         if not self.mount_me:
             try_to_wipe(temp_path)
 
+        if result == 0:
+            self._record_validators(base, fetched)
         return result
 
 
@@ -159,10 +678,26 @@ class ArchiveOverlay(OverlaySource):
                 'overwrite its contents!' % ({'dir': target}))
 
         return self.postsync(
-            self._add_unchecked(base),
+            self._install(base),
             cwd=target)
 
 
+    def delete(self, base):
+        '''
+        Deletes the overlay and its recorded revision.
+
+        @params base: string location where overlays are installed.
+        @rtype bool
+        '''
+        self._record_revision(base, None)
+        self._record_validators(base, None)
+        part = path([base, self.parent.name + self.get_extension() + '.part'])
+        if os.path.exists(part):
+            os.unlink(part)
+        self._record_part_validators(part, None)
+        return super(ArchiveOverlay, self).delete(base)
+
+
     def sync(self, base):
         '''
         Sync overlay.
@@ -176,9 +711,10 @@ class ArchiveOverlay(OverlaySource):
 
         target = path([base, self.parent.name])
 
-        return self.postsync(
-            self._add_unchecked(base),
-            cwd=target)
+        result = self._install(base, conditional=True)
+        if result == 0 and self.not_modified:
+            return 0
+        return self.postsync(result, cwd=target)
 
 
     def supported(self):
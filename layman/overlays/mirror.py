@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+################################################################################
+# LAYMAN VCS MIRROR
+################################################################################
+# File:       mirror.py
+#
+#             Host wide bare mirrors of version controlled overlays.
+#
+# Copyright:
+#             (c) 2026 Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Host wide bare mirrors of version controlled overlays.'''
+
+from __future__ import unicode_literals
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import hashlib
+import os
+import time
+
+from layman.flocker   import FileLocker
+from layman.utils     import int_option, path, run_command
+
+#===============================================================================
+#
+# Class Mirror
+#
+#-------------------------------------------------------------------------------
+
+class Mirror(object):
+    '''
+    A bare mirror of an overlay source below vcs_mirror_dir.
+
+    Mirrors are shared by every layman storage of the host, so that
+    several chroots or containers syncing the same overlay only go to
+    the network once per vcs_mirror_interval.  They are keyed by the
+    source type and a hash of the source URL:
+
+        <vcs_mirror_dir>/<type>/<sha1 of URL>        the bare repository
+        <vcs_mirror_dir>/<type>/<sha1 of URL>.lock   held while updating
+        <vcs_mirror_dir>/<type>/<sha1 of URL>.stamp  time of the last update
+    '''
+
+    def __init__(self, source, url):
+        '''
+        @params source: layman.overlays.source.OverlaySource object.
+        @params url: string of the upstream URL as passed to the VCS.
+        '''
+        self.source = source
+        self.config = source.config
+        self.output = source.config['output']
+        self.url = url
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        self.path = path([self.config['vcs_mirror_dir'], source.type_key,
+                          key])
+
+
+    @staticmethod
+    def enabled(config):
+        '''Whether the VCS mirror tier is configured.'''
+        return bool(config['vcs_mirror_dir'])
+
+
+    def refresh(self, create, update):
+        '''
+        Creates the mirror, or updates it if it was last updated more than
+        vcs_mirror_interval seconds ago.
+
+        @params create: list of argument lists run with the source command
+                        in the parent directory to create the mirror.
+        @params update: list of argument lists run in the mirror to update it.
+        @rtype bool: whether the mirror is up to date and can be used.
+        '''
+        parent = os.path.dirname(self.path)
+        stamp = self.path + '.stamp'
+        interval = int_option(self.config, 'vcs_mirror_interval', 0)
+        locker = FileLocker()
+        try:
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            locker.lock_file(self.path + '.lock', exclusive=True)
+        except (IOError, OSError) as error:
+            self.output.warn('Failed to lock the mirror of %(url)s\nError '
+                             'was: %(err)s' % {'url': self.url, 'err': error})
+            return False
+
+        try:
+            # checked under the lock, another process may just have
+            # updated the mirror while we were waiting
+            if (os.path.exists(stamp)
+                and 0 <= time.time() - os.path.getmtime(stamp) < interval):
+                self.output.debug('Mirror.refresh(); %s is fresh'
+                                  % self.path, 6)
+                return True
+
+            if os.path.isdir(self.path):
+                commands, cwd = update, self.path
+                self.output.info('Updating the mirror of %s' % self.url, 3)
+            else:
+                commands, cwd = create, parent
+                self.output.info('Creating a mirror of %s' % self.url, 3)
+            for args in commands:
+                if run_command(self.config, self.source.command(), args,
+                               cmd=self.source.type, cwd=cwd,
+                               timeout=self.source.timeout()):
+                    self.output.warn('Failed to update the mirror of %s, '
+                                     'using the upstream URL' % self.url)
+                    return False
+
+            with open(stamp, 'a'):
+                os.utime(stamp, None)
+            return True
+        finally:
+            locker.unlock_file(self.path + '.lock')
@@ -76,7 +76,8 @@ class BzrOverlay(OverlaySource):
         else:
             args = ['branch', src, target]
         return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
+            run_command(self.config, self.command(), args, cmd=self.type,
+                        timeout=self.timeout()),
             cwd=target)
 
     def update(self, base, src):
@@ -97,7 +98,8 @@ class BzrOverlay(OverlaySource):
         if self.config['quiet']:
             args.append('--quiet')
         return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
+            run_command(self.config, self.command(), args, cmd=self.type,
+                        timeout=self.timeout()),
             cwd=target)
 
     def sync(self, base):
@@ -116,7 +118,7 @@ class BzrOverlay(OverlaySource):
             args = ['pull', '--overwrite', self.src]
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=target,
-                        cmd=self.type),
+                        cmd=self.type, timeout=self.timeout()),
             cwd=target)
 
     def supported(self):
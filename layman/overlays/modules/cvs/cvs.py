@@ -71,7 +71,8 @@ class CvsOverlay(OverlaySource):
 
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=base,
-                env=dict(CVSROOT=self.src), cmd=self.type),
+                env=dict(CVSROOT=self.src), cmd=self.type,
+                timeout=self.timeout()),
             cwd=target)
 
     def update(self, base, src):
@@ -131,7 +132,7 @@ class CvsOverlay(OverlaySource):
             args.extend(cfg_opts.split())
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=target,
-                        cmd=self.type),
+                        cmd=self.type, timeout=self.timeout()),
             cwd=target)
 
     def supported(self):
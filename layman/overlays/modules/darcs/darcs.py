@@ -70,7 +70,8 @@ class DarcsOverlay(OverlaySource):
                 src, target]
 
         return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
+            run_command(self.config, self.command(), args, cmd=self.type,
+                        timeout=self.timeout()),
             cwd=target)
 
     def sync(self, base):
@@ -89,7 +90,7 @@ class DarcsOverlay(OverlaySource):
             args = ['pull', '--all', self.src]
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=target,
-                        cmd=self.type),
+                        cmd=self.type, timeout=self.timeout()),
             cwd=target)
 
     def supported(self):
@@ -77,7 +77,7 @@ class GSorceryOverlay(OverlaySource):
         args = [self.backend, '-o', target, 'generate-tree']
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=target,
-                        cmd=self.type),
+                        cmd=self.type, timeout=self.timeout()),
             cwd=target)
 
     def supported(self):
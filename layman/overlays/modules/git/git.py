@@ -26,8 +26,25 @@ __version__ = "$Id: git.py 146 2006-05-27 09:52:36Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
-from   layman.utils             import path, run_command
-from   layman.overlays.source   import OverlaySource, require_supported
+import os
+
+from   layman.compatibility     import fileopen
+from   layman.utils             import path, run_command, get_command_output, \
+                                       int_option
+from   layman.overlays.mirror   import Mirror
+from   layman.overlays.source   import (OverlaySource, require_supported,
+                                       MD5_CACHE, MD5_CACHE_STAMP)
+
+# object filters git_partial_clone accepts, see git-rev-list(1)
+PARTIAL_CLONE_FILTERS = ['blob:none', 'tree:0']
+
+# directories checked out along with the sparse_paths of an overlay,
+# portage needs them to use the repository
+SPARSE_DEFAULT_PATHS = ['eclass', 'metadata', 'profiles']
+
+# bare repository below the storage directory holding the objects shared
+# by the overlays when git_shared_objects is enabled
+OBJECT_POOL = '.git-objects'
 
 #===============================================================================
 #
@@ -59,6 +76,215 @@ class GitOverlay(OverlaySource):
                 return source + '/'
         return source
 
+    def _clone_depth(self):
+        '''
+        Number of commits to keep from git_clone_depth, 0 for the full
+        history.
+        '''
+        return max(0, int_option(self.config, 'git_clone_depth', 0))
+
+    def _partial_clone_filter(self):
+        '''
+        Object filter from git_partial_clone, None for a full clone.
+        '''
+        spec = self.config['git_partial_clone']
+        if not spec:
+            return None
+        if spec not in PARTIAL_CLONE_FILTERS:
+            self.output.warn('Invalid value "%(spec)s" for option '
+                             '"git_partial_clone", expected one of '
+                             '%(filters)s' % {'spec': spec,
+                             'filters': ', '.join(PARTIAL_CLONE_FILTERS)})
+            return None
+        return spec
+
+    def _mirror_args(self):
+        '''
+        Refreshes the local mirror of the overlay if vcs_mirror_dir is set
+        and returns the git options redirecting the upstream URL to it.
+        The URL is only rewritten per command, the clones keep the
+        upstream URL as origin.
+
+        @rtype list: git -c options, empty without a usable mirror.
+        '''
+        if not Mirror.enabled(self.config):
+            return []
+        src = self._fix_git_source(self.src)
+        mirror = Mirror(self, src)
+        quiet = ['-q'] if self.config['quiet'] else []
+        create = [['clone', '--mirror'] + quiet + [src, mirror.path],
+                  # allows shallow and partial clones from the mirror
+                  ['--git-dir', mirror.path, 'config',
+                   'uploadpack.allowFilter', 'true']]
+        update = [['fetch', '--prune'] + quiet + ['origin']]
+        if not mirror.refresh(create, update):
+            return []
+        return ['-c', 'url.file://%(mirror)s.insteadOf=%(src)s'
+                % {'mirror': mirror.path, 'src': src}]
+
+    def _sparse_paths(self):
+        '''
+        Directories of a cone mode sparse checkout of the overlay.
+
+        @rtype list, empty for a full checkout.
+        '''
+        if not self.parent.sparse_paths:
+            return []
+        return sorted(set(self.parent.sparse_paths + SPARSE_DEFAULT_PATHS))
+
+    def _apply_sparse_checkout(self, target, mirror_args=()):
+        '''
+        Brings the sparse checkout of the overlay in line with its
+        sparse_paths, if they were changed since it was cloned.
+
+        @params target: overlay location.
+        @params mirror_args: git options returned by _mirror_args(), git
+                             may need to fetch blobs of a partial clone.
+        @rtype int
+        '''
+        wanted = self._sparse_paths()
+        if not wanted and not os.path.exists(path([target, '.git', 'info',
+                                                    'sparse-checkout'])):
+            return 0
+
+        result, out = get_command_output(self.config, self.command(),
+                                         ['sparse-checkout', 'list'],
+                                         cmd=self.type,
+                                         timeout=self.timeout(), cwd=target)
+        current = sorted(out.split()) if not result else []
+        if current == wanted:
+            return 0
+        if wanted:
+            # git sparse-checkout set --cone PATH...
+            args = ['sparse-checkout', 'set', '--cone'] + wanted
+        else:
+            args = ['sparse-checkout', 'disable']
+        return run_command(self.config, self.command(),
+                           list(mirror_args) + args, cmd=self.type,
+                           timeout=self.timeout(), cwd=target)
+
+    def _use_object_pool(self):
+        '''
+        Whether new clones should borrow their objects from the shared
+        pool.  Shallow and partial clones do not, their missing objects
+        could not be told apart from the ones the pool provides.
+        '''
+        return bool(self.config['git_shared_objects']
+                    and not self._clone_depth()
+                    and not self._partial_clone_filter())
+
+    def _uses_object_pool(self, base, name=None):
+        '''
+        Whether the installed overlay borrows objects from the pool.
+
+        @params base: base location where all overlays are installed.
+        @params name: overlay name, defaults to this overlay.
+        @rtype bool
+        '''
+        alternates = path([base, name or self.parent.name, '.git', 'objects',
+                           'info', 'alternates'])
+        pool_objects = os.path.realpath(path([base, OBJECT_POOL, 'objects']))
+        try:
+            with fileopen(alternates) as alt_file:
+                return pool_objects in [os.path.realpath(line.strip())
+                                        for line in alt_file]
+        except (IOError, OSError):
+            return False
+
+    def _fetch_into_pool(self, base, mirror_args=()):
+        '''
+        Fetches the overlay branch from upstream into the shared object
+        pool, below refs/layman/<overlay>/, so that the following clone
+        or pull finds the objects there and only transfers the rest.
+
+        @params base: base location where all overlays are installed.
+        @params mirror_args: git options returned by _mirror_args().
+        @rtype int
+        '''
+        pool = path([base, OBJECT_POOL])
+        if not os.path.isdir(pool):
+            # git init --bare -q POOL
+            result = run_command(self.config, self.command(),
+                                 ['init', '--bare', '-q', pool],
+                                 cmd=self.type,
+                                 timeout=self.timeout(), cwd=base)
+            if result:
+                return result
+            # git config gc.auto 0, an automatic gc in the pool does not
+            # know which objects the overlays borrow and could prune
+            # them, it is only collected by _prune_object_pool()
+            result = run_command(self.config, self.command(),
+                                 ['config', 'gc.auto', '0'],
+                                 cmd=self.type,
+                                 timeout=self.timeout(), cwd=pool)
+            if result:
+                return result
+
+        if self.branch:
+            refspec = '+refs/heads/%(branch)s:refs/layman/%(name)s/heads/' \
+                      '%(branch)s' % {'branch': self.branch,
+                                      'name': self.parent.name}
+        else:
+            refspec = '+HEAD:refs/layman/%s/HEAD' % self.parent.name
+
+        # git fetch [-q] SOURCE REFSPEC
+        args = list(mirror_args) + ['fetch']
+        if self.config['quiet']:
+            args.append('-q')
+        args.extend([self._fix_git_source(self.src), refspec])
+        return run_command(self.config, self.command(), args, cmd=self.type,
+                           timeout=self.timeout(), cwd=pool)
+
+    def _prune_object_pool(self, base):
+        '''
+        Drops the refs of this overlay from the shared pool and garbage
+        collects it.  The checked out commit and every ref of the
+        remaining overlays, remote tracking branches included, are
+        fetched into the pool first, so gc keeps every object they may
+        still borrow even if their upstream rewrote its history since
+        their last sync.
+
+        @params base: base location where all overlays are installed.
+        @rtype int
+        '''
+        pool = path([base, OBJECT_POOL])
+        if not os.path.isdir(pool):
+            return 0
+
+        result, out = get_command_output(self.config, self.command(),
+            ['for-each-ref', '--format=%(refname)',
+             'refs/layman/%s/' % self.parent.name],
+            cmd=self.type, timeout=self.timeout(), cwd=pool)
+        if result:
+            return result
+        for ref in out.split():
+            result = run_command(self.config, self.command(),
+                                 ['update-ref', '-d', ref],
+                                 cmd=self.type,
+                                 timeout=self.timeout(), cwd=pool)
+            if result:
+                return result
+
+        for name in sorted(os.listdir(base)):
+            if (name.startswith('.') or name == self.parent.name
+                or not self._uses_object_pool(base, name)):
+                continue
+            result = run_command(self.config, self.command(),
+                ['fetch', '-q', '--prune', path([base, name]),
+                 '+HEAD:refs/layman/%s/checkout' % name,
+                 '+refs/*:refs/layman/%s/all/*' % name],
+                cmd=self.type, timeout=self.timeout(), cwd=pool)
+            if result:
+                self.output.warn('Not garbage collecting the shared git '
+                                 'objects, failed to protect the objects '
+                                 'of overlay "%s"' % name)
+                return result
+
+        # gc keeps unreachable objects younger than gc.pruneExpire (two
+        # weeks by default), which covers clones and pulls in progress
+        return run_command(self.config, self.command(), ['gc', '--quiet'],
+                           cmd=self.type, timeout=self.timeout(), cwd=pool)
+
     def add(self, base):
         '''Add overlay.'''
 
@@ -68,10 +294,29 @@ class GitOverlay(OverlaySource):
         cfg_opts = self.config["git_addopts"]
         target = path([base, self.parent.name])
 
-        # git clone [-q] SOURCE TARGET
-        args = ['clone']
+        mirror_args = self._mirror_args()
+
+        # git clone [-q] [--depth N] [--filter SPEC] SOURCE TARGET
+        args = mirror_args + ['clone']
         if self.config['quiet']:
             args.append('-q')
+        depth = self._clone_depth()
+        if depth:
+            args.extend(['--depth', str(depth)])
+        spec = self._partial_clone_filter()
+        if spec:
+            args.append('--filter=' + spec)
+        if self._sparse_paths():
+            # only the top level files are checked out until the
+            # sparse-checkout set below
+            args.append('--sparse')
+        if self._use_object_pool():
+            if self._fetch_into_pool(base, mirror_args):
+                self.output.warn('Failed to fetch overlay "%s" into the '
+                                 'shared git objects, cloning it without'
+                                 % self.parent.name)
+            else:
+                args.extend(['--reference', path([base, OBJECT_POOL])])
         if len(cfg_opts):
             args.extend(cfg_opts.split())
         args.append(self._fix_git_source(self.src))
@@ -85,8 +330,13 @@ class GitOverlay(OverlaySource):
         # not having user_home_dir_t and portage_fetch_t permissions
         # but changing dir works around it.
         success = run_command(self.config, self.command(), args,cmd=self.type,
-                              cwd=base)
+                              timeout=self.timeout(), cwd=base)
         self.output.debug("cloned git repo...success=%s" % str(success), 8)
+        if success:
+            return success
+        success = self._apply_sparse_checkout(target, mirror_args)
+        if success:
+            return success
         success = self.set_user(target)
         return self.postsync(success, cwd=target)
 
@@ -96,14 +346,15 @@ class GitOverlay(OverlaySource):
         email = '"%s"' % self.config['git_email']
         args = ['config', 'user.name', user]
         self.output.debug("set git user info...args=%s" % ' '.join(args), 8)
-        failure = run_command(self.config, self.command(), args, cmd=self.type, cwd=target)
+        failure = run_command(self.config, self.command(), args, cmd=self.type,
+                              timeout=self.timeout(), cwd=target)
         if failure:
             self.output.debug("set git user info...failure setting name")
             return failure
         args = ['config', 'user.email', email]
         self.output.debug("set git user info...args=%s" % ' '.join(args), 8)
         return run_command(self.config, self.command(), args, cmd=self.type,
-                           cwd=target)
+                           timeout=self.timeout(), cwd=target)
 
     def update(self, base, src):
         '''
@@ -118,8 +369,22 @@ class GitOverlay(OverlaySource):
         # git remote set-url <name> <newurl> <oldurl>
         args = ['remote', 'set-url', 'origin', self._fix_git_source(src), self._fix_git_source(self.src)]
 
-        return run_command(self.config, self.command(), args, cmd=self.type,
-                           cwd=target)
+        result = run_command(self.config, self.command(), args, cmd=self.type,
+                             timeout=self.timeout(), cwd=target)
+        spec = self._partial_clone_filter()
+        if result or not spec:
+            return result
+
+        # the new remote has to be marked as a promisor, or objects left
+        # out of the partial clone can not be fetched from it on demand
+        for args in (['config', 'remote.origin.promisor', 'true'],
+                     ['config', 'remote.origin.partialclonefilter', spec]):
+            result = run_command(self.config, self.command(), args,
+                                 cmd=self.type,
+                                 timeout=self.timeout(), cwd=target)
+            if result:
+                break
+        return result
 
     def sync(self, base):
         '''Sync overlay.'''
@@ -131,7 +396,24 @@ class GitOverlay(OverlaySource):
         cfg_opts = self.config["git_syncopts"]
         target = path([base, self.parent.name])
 
-        args = ['pull']
+        mirror_args = self._mirror_args()
+
+        result = self._apply_sparse_checkout(target, mirror_args)
+        if result:
+            return result
+
+        depth = self._clone_depth()
+        if depth:
+            return self.postsync(self._shallow_sync(target, depth, cfg_opts,
+                                                    mirror_args),
+                                 cwd=target)
+
+        if (self._uses_object_pool(base)
+            and self._fetch_into_pool(base, mirror_args)):
+            self.output.warn('Failed to fetch overlay "%s" into the shared '
+                             'git objects' % self.parent.name)
+
+        args = mirror_args + ['pull']
         if self.config['quiet']:
             args.append('-q')
         if len(cfg_opts):
@@ -139,9 +421,143 @@ class GitOverlay(OverlaySource):
 
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=target,
-                        cmd=self.type),
+                        cmd=self.type, timeout=self.timeout()),
             cwd=target)
 
+    def _shallow_sync(self, target, depth, cfg_opts, mirror_args):
+        '''
+        Fetches the last depth commits of the upstream branch and moves the
+        checkout to it.  A plain pull can not be used, the new commits
+        often do not connect to the shallow local history, or upstream
+        has been rewritten, and the merge would fail.
+
+        @params target: overlay location.
+        @params depth: int number of commits to fetch.
+        @params cfg_opts: git_syncopts, passed to git fetch.
+        @params mirror_args: git options returned by _mirror_args().
+        @rtype int
+        '''
+        # git fetch [-q] --depth N origin
+        args = mirror_args + ['fetch']
+        if self.config['quiet']:
+            args.append('-q')
+        args.extend(['--depth', str(depth)])
+        if len(cfg_opts):
+            args.extend(cfg_opts.split())
+        args.append('origin')
+        result = run_command(self.config, self.command(), args, cwd=target,
+                             cmd=self.type, timeout=self.timeout())
+        if result:
+            return result
+
+        # git reset [-q] --merge @{upstream}, keeps local changes to
+        # files upstream did not touch, like a fast-forward would
+        args = ['reset']
+        if self.config['quiet']:
+            args.append('-q')
+        args.extend(['--merge', '@{upstream}'])
+        return run_command(self.config, self.command(), args, cwd=target,
+                           cmd=self.type, timeout=self.timeout())
+
+    def delete(self, base):
+        '''
+        Deletes the overlay and garbage collects the shared git objects
+        if it borrowed from them.
+
+        @params base: base location where all overlays are installed.
+        @rtype bool
+        '''
+        shared = self._uses_object_pool(base)
+        result = super(GitOverlay, self).delete(base)
+        if shared and self._prune_object_pool(base):
+            self.output.warn('Failed to garbage collect the shared git '
+                             'objects in %s' % path([base, OBJECT_POOL]))
+        return result
+
+    def remote_revision(self, base):
+        '''Upstream commit id of the synced branch via git ls-remote.'''
+        if not self.supported():
+            return None
+
+        target = path([base, self.parent.name])
+        if self.branch:
+            ref = 'refs/heads/' + self.branch
+        else:
+            ref = 'HEAD'
+
+        # git ls-remote origin REF, asks the mirror after refreshing it
+        args = self._mirror_args() + ['ls-remote', 'origin', ref]
+        result, out = get_command_output(self.config, self.command(), args,
+                                         cwd=target, cmd=self.type,
+                                         timeout=self.timeout())
+        if result or not out.strip():
+            return None
+        return out.split()[0]
+
+    def upstream_unreachable(self, base):
+        '''Whether the upstream revision cannot be determined.'''
+        return self.remote_revision(base) is None
+
+    def local_revision(self, base):
+        '''Commit id of the checked out HEAD.'''
+        target = path([base, self.parent.name])
+
+        result, out = get_command_output(self.config, self.command(),
+                                         ['rev-parse', 'HEAD'],
+                                         cwd=target, cmd=self.type,
+                                         timeout=self.timeout())
+        if result:
+            return None
+        return out.strip() or None
+
+    def regen_cache(self, base, changes):
+        '''
+        Excludes the generated metadata cache from the checkout first,
+        git overwrites ignored files, so upstream can still start to
+        ship its own cache later.
+        '''
+        if self.config['regen_cache']:
+            exclude = path([base, self.parent.name, '.git', 'info',
+                            'exclude'])
+            patterns = ['/%s/' % MD5_CACHE, '/%s' % MD5_CACHE_STAMP]
+            existing = []
+            if os.path.exists(exclude):
+                with fileopen(exclude) as exclude_file:
+                    existing = exclude_file.read().splitlines()
+            missing = [e for e in patterns if e not in existing]
+            if missing:
+                if not os.path.isdir(os.path.dirname(exclude)):
+                    os.makedirs(os.path.dirname(exclude))
+                with fileopen(exclude, 'a') as exclude_file:
+                    exclude_file.write(''.join(e + '\n' for e in missing))
+        return super(GitOverlay, self).regen_cache(base, changes)
+
+    def sync_snapshot(self, base):
+        '''Commit id of the checked out HEAD before the sync.'''
+        return self.local_revision(base)
+
+    def changed_files(self, base, snapshot):
+        '''Files changed between the HEAD before the sync and the new one.'''
+        revision = self.local_revision(base)
+        if not snapshot or not revision:
+            return None
+        if snapshot == revision:
+            return []
+
+        # git diff --name-status --no-renames -z OLD NEW
+        args = ['diff', '--name-status', '--no-renames', '-z', snapshot,
+                revision]
+        result, out = get_command_output(self.config, self.command(), args,
+                                         cwd=path([base, self.parent.name]),
+                                         cmd=self.type,
+                                         timeout=self.timeout())
+        if result:
+            return None
+        fields = out.split('\0')
+        # T(ype changed) files count as modified
+        return [(fields[i].replace('T', 'M'), fields[i + 1])
+                for i in range(0, len(fields) - 1, 2)]
+
     def supported(self):
         '''Overlay type supported?'''
 
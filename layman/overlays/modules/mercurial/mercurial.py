@@ -29,7 +29,9 @@ __version__ = "$Id: mercurial.py 236 2006-09-05 20:39:37Z wrobel $"
 
 import re
 
-from   layman.utils             import path, run_command
+from   layman.compatibility     import fileopen
+from   layman.utils             import path, run_command, get_command_output
+from   layman.overlays.mirror   import Mirror
 from   layman.overlays.source   import OverlaySource, require_supported
 
 #===============================================================================
@@ -62,6 +64,22 @@ class MercurialOverlay(OverlaySource):
             return source
         return source + '/'
 
+    def _mirror_source(self):
+        '''
+        Refreshes the local mirror of the overlay if vcs_mirror_dir is set.
+
+        @rtype str: location of the mirror, None without a usable one.
+        '''
+        if not Mirror.enabled(self.config):
+            return None
+        src = self._fix_mercurial_source(self.src)
+        mirror = Mirror(self, src)
+        # hg clone -U SOURCE MIRROR, hg pull
+        if not mirror.refresh([['clone', '-U', src, mirror.path]],
+                              [['pull']]):
+            return None
+        return mirror.path
+
     def add(self, base):
         '''Add overlay.'''
 
@@ -72,20 +90,26 @@ class MercurialOverlay(OverlaySource):
         target = path([base, self.parent.name])
 
         src = self._fix_mercurial_source(self.src)
+        mirror = self._mirror_source()
 
         # hg clone SOURCE TARGET
         if len(cfg_opts):
-            args = ['clone'] + cfg_opts.split() + [src, target]
+            args = ['clone'] + cfg_opts.split() + [mirror or src, target]
         else:
-            args = ['clone', src, target]
+            args = ['clone', mirror or src, target]
 
         if self.branch:
             args.append('-r')
             args.append(self.branch)
 
-        return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
-            cwd=target)
+        result = run_command(self.config, self.command(), args, cmd=self.type,
+                             timeout=self.timeout())
+        if not result and mirror:
+            # keep the upstream URL as default path, update() relies on it
+            with fileopen(path([target, '.hg', 'hgrc']), 'w') as hgrc:
+                hgrc.write('[paths]\ndefault = %s\n' % src)
+
+        return self.postsync(result, cwd=target)
 
     def update(self, base, src):
         '''
@@ -120,17 +144,71 @@ class MercurialOverlay(OverlaySource):
         cfg_opts = self.config["mercurial_syncopts"]
         target = path([base, self.parent.name])
 
+        src = self._mirror_source() or self.src
+
         # hg pull -u SOURCE
         if len(cfg_opts):
-            args = ['pull', '-u'] + cfg_opts.split() + [self.src]
+            args = ['pull', '-u'] + cfg_opts.split() + [src]
         else:
-            args = ['pull', '-u', self.src]
+            args = ['pull', '-u', src]
 
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=target,
-                        cmd=self.type),
+                        cmd=self.type, timeout=self.timeout()),
             cwd=target)
 
+    def _identify(self, location, cwd=None):
+        # hg identify -i -r REV LOCATION
+        args = ['identify', '-i', '-r', self.branch or 'tip']
+        if location:
+            args.append(location)
+        result, out = get_command_output(self.config, self.command(), args,
+                                         cwd=cwd, cmd=self.type,
+                                         timeout=self.timeout())
+        if result:
+            return None
+        return out.strip() or None
+
+    def remote_revision(self, base):
+        '''Upstream changeset id of the branch head (or tip).'''
+        if not self.supported():
+            return None
+        return self._identify(self._mirror_source()
+                              or self._fix_mercurial_source(self.src))
+
+    def upstream_unreachable(self, base):
+        '''Whether the upstream revision cannot be determined.'''
+        return self.remote_revision(base) is None
+
+    def local_revision(self, base):
+        '''Local changeset id of the branch head (or tip).'''
+        return self._identify(None, cwd=path([base, self.parent.name]))
+
+    def sync_snapshot(self, base):
+        '''Changeset id of the working directory before the sync.'''
+        return self.local_revision(base)
+
+    def changed_files(self, base, snapshot):
+        '''Files changed between the changeset before the sync and the
+        new one.'''
+        revision = self.local_revision(base)
+        if not snapshot or not revision:
+            return None
+        if snapshot == revision:
+            return []
+
+        # hg status --rev OLD --rev NEW
+        args = ['status', '--rev', snapshot, '--rev', revision]
+        result, out = get_command_output(self.config, self.command(), args,
+                                         cwd=path([base, self.parent.name]),
+                                         cmd=self.type,
+                                         timeout=self.timeout())
+        if result:
+            return None
+        status_map = {'A': 'A', 'M': 'M', 'R': 'D'}
+        return [(status_map[line[0]], line[2:]) for line in out.splitlines()
+                if line[:1] in status_map]
+
     def supported(self):
         '''Overlay type supported?'''
 
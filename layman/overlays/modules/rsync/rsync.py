@@ -26,8 +26,18 @@ __version__ = "$Id: rsync.py 236 2006-09-05 20:39:37Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
+import os
+import re
+import tempfile
+
+from   layman.compatibility     import fileopen
 from   layman.utils             import path, run_command
-from   layman.overlays.source   import OverlaySource, require_supported
+from   layman.overlays.source   import (OverlaySource, require_supported,
+                                       MD5_CACHE, MD5_CACHE_STAMP)
+
+# "<date> <time> [<pid>] <itemized changes> <name>" lines of the
+# --log-file written with --log-file-format="%i %n"
+ITEMIZE_REGEX = re.compile(r'\] (\*deleting|[<>ch.][^ ]{8,10}) +(.*)$')
 
 #===============================================================================
 #
@@ -47,6 +57,8 @@ class RsyncOverlay(OverlaySource):
         super(RsyncOverlay, self).__init__(parent, config,
             _location, ignore)
         self.branch = None
+        # files changed by the last sync, read from the rsync log
+        self._itemized = None
 
     def add(self, base):
         '''Add overlay.'''
@@ -76,12 +88,58 @@ class RsyncOverlay(OverlaySource):
             args.append('-q')
         if len(cfg_opts):
             args.extend(cfg_opts.split())
+        if (self.config['regen_cache']
+            and os.path.exists(path([target, MD5_CACHE_STAMP]))):
+            # keep the metadata cache generated by layman
+            args.extend(['--exclude=/%s/' % MD5_CACHE,
+                         '--exclude=/%s' % MD5_CACHE_STAMP])
+
+        # log the itemized changes, the output is left to the user
+        fd, log_file = tempfile.mkstemp(prefix='layman-rsync-')
+        os.close(fd)
+        args.extend(['--log-file=' + log_file, '--log-file-format=%i %n'])
         args.append(self.src + '/')
         args.append(target)
 
-        return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
-            cwd=target)
+        try:
+            result = run_command(self.config, self.command(), args,
+                                 cmd=self.type, timeout=self.timeout())
+            self._itemized = self._read_itemized(log_file)
+        finally:
+            os.unlink(log_file)
+
+        return self.postsync(result, cwd=target)
+
+    def _read_itemized(self, log_file):
+        '''
+        Extracts the changed files from an rsync log file.
+
+        @params log_file: string location of the --log-file.
+        @rtype list of (status, path) tuples.
+        '''
+        changes = []
+        with fileopen(log_file) as log:
+            for line in log:
+                match = ITEMIZE_REGEX.search(line.rstrip('\n'))
+                if not match:
+                    continue
+                item, name = match.groups()
+                if name.endswith('/'):
+                    continue
+                if item == '*deleting':
+                    changes.append(('D', name))
+                elif item[1] == 'd':
+                    continue
+                elif '+++++++++' in item:
+                    changes.append(('A', name))
+                elif item[0] in '<>ch':
+                    # "." items only had their attributes updated
+                    changes.append(('M', name))
+        return changes
+
+    def changed_files(self, base, snapshot):
+        '''Files the last sync transferred or deleted.'''
+        return self._itemized
 
     def supported(self):
         '''Overlay type supported?'''
@@ -24,12 +24,16 @@ from __future__ import unicode_literals
 #
 #-------------------------------------------------------------------------------
 
+import hashlib
 import os
 import shutil
 
+from urllib.error import HTTPError
+
+from   layman.compatibility    import fileopen
 from   layman.constants        import FILE_EXTENSIONS
-from   layman.overlays.archive import ArchiveOverlay
-from   layman.utils            import path
+from   layman.overlays.archive import ArchiveOverlay, CHUNK_SIZE
+from   layman.utils            import path, resolve_command, run_command
 
 #===============================================================================
 #
@@ -65,6 +69,122 @@ class SquashfsOverlay(ArchiveOverlay):
         return ext
 
 
+    def _fetch(self, base, archive_url, validators=None):
+        '''
+        Fetches the squashfs image.  If the source has a delta URL the
+        image fetched by the last sync is kept and updated with the delta
+        published for it, falling back to the full download.
+
+        @params base: string of directory base for installed overlays.
+        @params archive_url: string of URL where the image is located.
+        @params validators: dict of the installed image, see
+                            _read_validators().
+        @rtype tuple (str of package location or None, dict of validators)
+        '''
+        if self.delta and 'file://' not in archive_url:
+            # the image is the base of the next delta
+            self.clean_archive = False
+            pkg = path([base, self.parent.name + self.get_extension()])
+            if validators and os.path.exists(pkg):
+                fetched = self._apply_delta(pkg, archive_url)
+                if fetched is not None:
+                    return (pkg, fetched)
+
+        return super(SquashfsOverlay, self)._fetch(base, archive_url,
+                                                   validators)
+
+
+    def _apply_delta(self, pkg, archive_url):
+        '''
+        Updates the image at pkg with the VCDIFF delta published at
+        <delta>/<sha256 of the image>.vcdiff, using xdelta3.
+
+        @params pkg: string location of the image of the last sync.
+        @params archive_url: string of URL where the image is located.
+        @rtype dict of the validators of the updated image, None if no
+               delta could be applied.
+        '''
+        command = self.config['xdelta3_command']
+        if not resolve_command(command,
+                               lambda msg: self.output.debug(msg, 4))[1]:
+            return None
+
+        base_sum = hashlib.sha256()
+        with fileopen(pkg, 'rb') as image:
+            for chunk in iter(lambda: image.read(CHUNK_SIZE), b''):
+                base_sum.update(chunk)
+        url = '%(delta)s/%(sum)s.vcdiff' % {'delta': self.delta.rstrip('/'),
+                                            'sum': base_sum.hexdigest()}
+        delta = pkg + '.vcdiff'
+        new = pkg + '.new'
+        transferred = 0
+        fetched = {'url': archive_url}
+        try:
+            # the validators of the image are taken before the delta is,
+            # so they never describe a newer image than the updated one
+            response = self._open_url(archive_url, method='HEAD')
+            headers = response.info()
+            response.close()
+            fetched['etag'] = headers.get('ETag')
+            fetched['last_modified'] = headers.get('Last-Modified')
+        except Exception as error:
+            self.output.debug('SquashfsOverlay._apply_delta(); HEAD request'
+                              ' for %(url)s failed: %(err)s'
+                              % {'url': archive_url, 'err': error}, 4)
+        try:
+            try:
+                response = self._open_url(url)
+            except HTTPError as error:
+                if error.code == 404:
+                    # the image is current or too old for a delta
+                    self.output.debug('No delta at %s' % url, 4)
+                    return None
+                raise
+            try:
+                with fileopen(delta, 'wb') as out_file:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                        out_file.write(chunk)
+                        transferred += len(chunk)
+            finally:
+                response.close()
+
+            # xdelta3 -d -f -s BASE DELTA TARGET, fails on a base image
+            # that does not match the one the delta was made against
+            args = ['-d', '-f', '-s', pkg, delta, new]
+            if run_command(self.config, command, args, cmd='xdelta3',
+                           timeout=self.timeout()):
+                raise Exception('xdelta3 failed to apply the delta')
+
+            content = hashlib.sha256()
+            checksum = self._new_checksum()
+            with fileopen(new, 'rb') as image:
+                for chunk in iter(lambda: image.read(CHUNK_SIZE), b''):
+                    content.update(chunk)
+                    if checksum is not None:
+                        checksum.update(chunk)
+            if checksum is not None:
+                self._verify_checksum(checksum, new)
+            os.rename(new, pkg)
+        except Exception as error:
+            self.output.warn('Failed to apply the delta %(url)s to the image '
+                             'of overlay "%(name)s", downloading the full '
+                             'image.\nError was: %(err)s'
+                             % {'url': url, 'name': self.parent.name,
+                                'err': error})
+            return None
+        finally:
+            for leftover in (delta, new):
+                if os.path.exists(leftover):
+                    os.unlink(leftover)
+
+        self.transferred = transferred
+        self.output.info('Updated the image of overlay "%(name)s" with a '
+                         '%(size)d bytes delta'
+                         % {'name': self.parent.name, 'size': transferred}, 3)
+        fetched['sha256'] = content.hexdigest()
+        return fetched
+
+
     def delete(self, base):
         '''
         Deletes the selected overlay.
@@ -82,12 +202,21 @@ class SquashfsOverlay(ArchiveOverlay):
             pkg = path([self.config['storage'], pkg_name])
 
         if os.path.ismount(mdir):
-            result = self.mounter.umount([self.parent.name])
+            # the overlay is not necessarily registered or mounted below
+            # the storage directory yet
+            result = self.mounter.umount([self.parent.name], dest=mdir,
+                                         sync=True)
         else:
             result = 1
 
         shutil.rmtree(mdir)
-        if self.clean_archive:
+        self._record_revision(base, None)
+        self._record_validators(base, None)
+        if os.path.exists(pkg + '.part'):
+            os.unlink(pkg + '.part')
+        self._record_part_validators(pkg + '.part', None)
+        # images kept as the base of deltas go with the overlay
+        if self.clean_archive or (self.delta and 'file://' not in source):
             if os.path.exists(pkg):
                 os.unlink(pkg)
 
@@ -30,7 +30,8 @@ from subprocess import PIPE, Popen
 #
 #------------------------------------------------------------------------------
 
-from layman.utils           import path, resolve_command, run_command
+from layman.utils           import (path, resolve_command, run_command,
+                                   get_command_output, CommandTimeout)
 from layman.overlays.source import (OverlaySource, require_supported)
 
 #==============================================================================
@@ -85,9 +86,15 @@ class SvnOverlay(OverlaySource):
         args.append(src)
         args.append(self.target)
 
-        return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
-            cwd=self.target)
+        try:
+            result = run_command(self.config, self.command(), args,
+                                 cmd=self.type, timeout=self.timeout())
+        except CommandTimeout:
+            # release the working copy locks the killed checkout left
+            self.cleanup()
+            raise
+
+        return self.postsync(result, cwd=self.target)
 
     def update(self, base, src):
         '''
@@ -104,7 +111,8 @@ class SvnOverlay(OverlaySource):
         args = ['switch', '--relocate', self._fix_svn_source(self.src), self._fix_svn_source(src)]
 
         return self.postsync(
-             run_command(self.config, self.command(), args, cmd=self.type),
+             run_command(self.config, self.command(), args, cmd=self.type,
+                         timeout=self.timeout()),
              cwd=target)
 
 
@@ -137,9 +145,68 @@ class SvnOverlay(OverlaySource):
             args.extend(cfg_opts.split())
         args.append(self.target)
 
-        return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
-            cwd=self.target)
+        try:
+            result = run_command(self.config, self.command(), args,
+                                 cmd=self.type, timeout=self.timeout())
+        except CommandTimeout:
+            # release the working copy locks the killed update left
+            self.cleanup()
+            raise
+
+        return self.postsync(result, cwd=self.target)
+
+    def _last_changed_revision(self, location):
+        # svn info --show-item last-changed-revision LOCATION
+        args = ['info', '--show-item', 'last-changed-revision', location]
+        result, out = get_command_output(self.config, self.command(), args,
+                                         cmd=self.type, timeout=self.timeout())
+        if result:
+            return None
+        return out.strip() or None
+
+    def remote_revision(self, base):
+        '''Last changed revision of the repository path.'''
+        if not self.supported():
+            return None
+        return self._last_changed_revision(self._fix_svn_source(self.src))
+
+    def upstream_unreachable(self, base):
+        '''Whether the upstream revision cannot be determined.'''
+        return self.remote_revision(base) is None
+
+    def local_revision(self, base):
+        '''Last changed revision of the working copy.'''
+        return self._last_changed_revision(path([base, self.parent.name]))
+
+    def sync_snapshot(self, base):
+        '''Last changed revision of the working copy before the sync.'''
+        return self.local_revision(base)
+
+    def changed_files(self, base, snapshot):
+        '''Files changed between the revision before the sync and the
+        new one.'''
+        revision = self.local_revision(base)
+        if not snapshot or not revision:
+            return None
+        if snapshot == revision:
+            return []
+
+        # svn diff --summarize -r OLD:NEW .
+        args = ['diff', '--summarize', '-r', '%s:%s' % (snapshot, revision),
+                '.']
+        result, out = get_command_output(self.config, self.command(), args,
+                                         cwd=path([base, self.parent.name]),
+                                         cmd=self.type,
+                                         timeout=self.timeout())
+        if result:
+            return None
+        changes = []
+        for line in out.splitlines():
+            # the second column flags property changes
+            status = line[:1].strip() or line[1:2].strip()
+            if status in ('A', 'M', 'D') and line[8:] != '.':
+                changes.append((status, line[8:]))
+        return changes
 
     def supported(self):
         '''Overlay type supported?'''
@@ -156,7 +223,7 @@ class SvnOverlay(OverlaySource):
         args = ["cleanup"]
         args.append(self.target)
         cleanup = run_command(self.config, self.command(), args,
-                              cmd="svn cleanup")
+                              cmd="svn cleanup", timeout=self.timeout())
         return
 
     def check_upgrade(self, target):
@@ -26,12 +26,33 @@ __version__ = "$Id: tar.py 310 2007-04-09 16:30:40Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
+import os
+import tarfile
 
 from   layman.constants        import FILE_EXTENSIONS
 from   layman.overlays.archive import ArchiveOverlay
 from   layman.overlays.source  import require_supported
 from   layman.utils            import run_command
 
+# the 'data' extraction filter refuses members and links that would end
+# up outside of the destination as well as device files, extract_stream()
+# checks the members and links itself on Pythons that do not know it
+if hasattr(tarfile, 'data_filter'):
+    EXTRACT_ARGS = {'filter': 'data'}
+else:
+    EXTRACT_ARGS = {}
+
+
+def _outside(location, dest_dir):
+    '''
+    Whether location, with the links extracted so far resolved, is
+    outside of dest_dir.
+    '''
+    dest_dir = os.path.realpath(dest_dir)
+    location = os.path.realpath(location)
+    return (location != dest_dir
+            and not location.startswith(dest_dir + os.path.sep))
+
 #===============================================================================
 #
 # Class TarOverlay
@@ -78,17 +99,73 @@ class TarOverlay(ArchiveOverlay):
         '''
         # tar -v -x -f SOURCE -C TARGET
         args = ['-v', '-x', '-f', pkg, '-C', dest_dir]
-        result = run_command(self.config, self.command(), args, cmd=self.type)
+        result = run_command(self.config, self.command(), args, cmd=self.type,
+                             timeout=self.timeout())
 
         return result
 
 
+    def streaming(self):
+        '''
+        Determines whether the archive is extracted in process while it
+        is downloaded, see the tar_stream option.
+
+        @rtype bool
+        '''
+        return self.config['tar_stream']
+
+
+    def extract_stream(self, stream, dest_dir):
+        '''
+        Extracts the tar archive read from stream, only the branch
+        subdirectory of it if a branch is set.
+
+        @params stream: file like object of the (compressed) archive.
+        @params dest_dir: string of destination of extracted archive.
+        '''
+        branch = os.path.normpath(self.branch).strip('/') \
+                 if self.branch else None
+        # only the branch becomes the overlay, links must stay inside it
+        root = os.path.join(dest_dir, branch) if branch else dest_dir
+        archive = tarfile.open(fileobj=stream, mode='r|*')
+        try:
+            for member in archive:
+                name = os.path.normpath(member.name)
+                if (os.path.isabs(name) or name == '..'
+                    or name.startswith('..' + os.path.sep)):
+                    raise Exception('Refusing to extract %(name)s outside '
+                                    'of %(dir)s' % {'name': member.name,
+                                                    'dir': dest_dir})
+                if (branch and name != branch
+                    and not name.startswith(branch + os.path.sep)):
+                    continue
+                parent = os.path.dirname(os.path.join(dest_dir, name))
+                if member.issym():
+                    link = os.path.join(parent, member.linkname)
+                elif member.islnk():
+                    link = os.path.join(dest_dir, member.linkname)
+                else:
+                    link = None
+                # written through a link or linking out of the overlay
+                if (_outside(parent, dest_dir)
+                    or (link and _outside(link, root))):
+                    raise Exception('Refusing to extract %(name)s outside '
+                                    'of %(dir)s' % {'name': member.name,
+                                                    'dir': dest_dir})
+                archive.extract(member, dest_dir, **EXTRACT_ARGS)
+        finally:
+            archive.close()
+
+
     def is_supported(self):
         '''
         Determines if overlay type is supported.
 
         @rtype bool
         '''
+        if self.streaming():
+            # extracted without the tar command
+            return True
 
         return require_supported(
             [(self.command(),  'tar', 'app-arch/tar'), ],
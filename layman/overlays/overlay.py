@@ -38,11 +38,14 @@ import os
 import os.path
 import re
 import sys
+import time
+import weakref
 import xml.etree.ElementTree as ET # Python 2.5
 
 from  layman.compatibility import encode
 from  layman.module        import Modules, InvalidModuleName
-from  layman.utils         import pad, terminal_width, get_encoding, encoder
+from  layman.utils         import pad, terminal_width, get_encoding, encoder, \
+                                  int_option
 
 #===============================================================================
 #
@@ -55,6 +58,16 @@ QUALITY_LEVELS = 'core|stable|testing|experimental|graveyard'.split('|')
 
 WHITESPACE_REGEX = re.compile('\s+')
 
+# module controllers shared by all overlays using the same output, creating
+# one imports every overlay type module
+_MODULE_CONTROLLERS = weakref.WeakKeyDictionary()
+
+def _module_controller(output):
+    if output not in _MODULE_CONTROLLERS:
+        _MODULE_CONTROLLERS[output] = Modules(
+            path=MOD_PATH, namepath='layman.overlays.modules', output=output)
+    return _MODULE_CONTROLLERS[output]
+
 
 class Overlay(object):
     ''' Derive the real implementations from this.'''
@@ -62,10 +75,14 @@ class Overlay(object):
     def __init__(self, config, json=None, ovl_dict=None, xml=None, ignore=0):
         self.config = config
         self.output = config['output']
-        self.module_controller = Modules(path=MOD_PATH,
-                                         namepath='layman.overlays.modules',
-                                         output=self.output)
+        self.module_controller = _module_controller(self.output)
         self._encoding_ = get_encoding(self.output)
+        # (source URL, status, error) of every sync attempt since the
+        # list was last reset
+        self.sync_attempts = []
+        # (status, path) list of the files changed by the last sync, None
+        # if unknown, see OverlaySource.changed_files()
+        self.changes = None
 
         if xml is not None:
             self.from_xml(xml, ignore)
@@ -182,7 +199,11 @@ class Overlay(object):
             raise Exception(msg)
 
         def create_dict_overlay_source(source_):
-            _src, _type, _sub = source_
+            _src, _type, _sub = source_[:3]
+            # optional fourth and fifth entries: archive digest and
+            # delta URL
+            _digest = source_[3] if len(source_) > 3 else None
+            _delta = source_[4] if len(source_) > 4 else None
             self.ovl_type = _type
             try:
                 _class = self.module_controller.get_class(_type)
@@ -195,8 +216,13 @@ class Overlay(object):
             else:
                 self.branch = None
 
-            return _class(parent=self, config=self.config,
+            source = _class(parent=self, config=self.config,
                 _location=_location, ignore=ignore)
+            if _digest:
+                source.digest = encode(_digest)
+            if _delta:
+                source.delta = encode(_delta)
+            return source
 
         self.sources = [create_dict_overlay_source(e) for e in _sources]
 
@@ -274,6 +300,11 @@ class Overlay(object):
         else:
             self.irc = None
 
+        if 'sparse' in overlay:
+            self.sparse_paths = [encode(e) for e in overlay['sparse']]
+        else:
+            self.sparse_paths = []
+
         # end of from_dict
 
 
@@ -322,8 +353,13 @@ class Overlay(object):
             else:
                 self.branch = None
 
-            return _class(parent=self, config=self.config,
+            source = _class(parent=self, config=self.config,
                 _location=_location, ignore=ignore)
+            if '@digest' in source_:
+                source.digest = encode(source_['@digest'])
+            if '@delta' in source_:
+                source.delta = encode(source_['@delta'])
+            return source
 
         self.sources = [create_json_overlay_source(e) for e in _sources]
 
@@ -332,11 +368,12 @@ class Overlay(object):
 
         for _owner in _owners:
             owner = {}
-            if 'name' in _owner:
+            # to_json() writes the owners with None for missing entries
+            if _owner.get('name') is not None:
                 owner['name'] = encode(_owner['name'])
             else:
                 owner['name'] = None
-            if 'email' in _owner:
+            if _owner.get('email') is not None:
                 owner['email'] = encode(_owner['email'])
             else:
                 owner['email'] = None
@@ -399,6 +436,11 @@ class Overlay(object):
         else:
             self.irc = None
 
+        if 'sparse' in json:
+            self.sparse_paths = [encode(e) for e in json['sparse']]
+        else:
+            self.sparse_paths = []
+
         # end of from_json()
 
 
@@ -450,8 +492,13 @@ class Overlay(object):
             _location = encode(strip_text(source_elem))
             self.branch = _branch
 
-            return _class(parent=self, config=self.config,
+            source = _class(parent=self, config=self.config,
                 _location=_location, ignore=ignore)
+            if 'digest' in source_elem.attrib:
+                source.digest = encode(source_elem.attrib['digest'])
+            if 'delta' in source_elem.attrib:
+                source.delta = encode(source_elem.attrib['delta'])
+            return source
 
         if not len(_sources):
             msg = 'Overlay from_xml(), "%(name)" is missing a "source" entry!'\
@@ -546,6 +593,9 @@ class Overlay(object):
         else:
             self.irc = None
 
+        self.sparse_paths = [encode(strip_text(e))
+                             for e in xml.findall('sparse')]
+
 
     def get_infostr(self):
         '''
@@ -609,6 +659,10 @@ class Overlay(object):
         if self.irc != None:
             result += '\nIRC : ' + self.irc + '\n'
 
+        if self.sparse_paths:
+            result += '\nSparse checkout: ' + ', '.join(self.sparse_paths)
+            result += '\n'
+
         if len(self.feeds):
             result += '\n%s:' % ((len(self.feeds) == 1) and "Feed" or "Feeds")
             for i in self.feeds:
@@ -629,6 +683,15 @@ class Overlay(object):
         self.priority = int(priority)
 
 
+    def set_sparse_paths(self, sparse_paths):
+        '''
+        Set the top level directories of a sparse checkout of this
+        overlay, an empty list checks out everything.
+        '''
+        self.sparse_paths = [encode(e.strip('/')) for e in sparse_paths
+                             if e.strip('/')]
+
+
     def short_list(self, width = 0):
         '''
         Return a shortened list of overlay information.
@@ -681,7 +744,75 @@ class Overlay(object):
         self.output.debug(msg, 4)
 
         assert len(self.sources) == 1
-        return self.sources[0].sync(base)
+        source = self.sources[0]
+        if self.config['check_upstream'] and source.is_up_to_date(base):
+            msg = 'Overlay "%(name)s" is already up to date with upstream '\
+                  'revision %(rev)s, skipping sync.'\
+                  % {'name': self.name, 'rev': source.upstream_revision}
+            self.output.info(msg, 3)
+            self.changes = []
+            return 0
+
+        self.changes = None
+        try:
+            snapshot = source.sync_snapshot(base)
+        except Exception as error:
+            self.output.debug('Overlay.sync(); failed to record the state '
+                              'of %(name)s: %(err)s'
+                              % {'name': self.name, 'err': error}, 4)
+            snapshot = None
+
+        retries = int_option(self.config, 'sync_retries', 0)
+        delay = int_option(self.config, 'sync_retry_delay', 0)
+        attempt = 0
+        while True:
+            attempt += 1
+            error = None
+            try:
+                result = source.sync(base)
+            except Exception as err:
+                result, error = 1, err
+            self.sync_attempts.append((source.src, result, error))
+            if result == 0 or attempt > retries:
+                break
+            wait = delay * 2 ** (attempt - 1)
+            msg = 'Syncing overlay "%(name)s" from %(src)s failed (attempt '\
+                  '%(attempt)d of %(attempts)d), retrying in %(wait)d '\
+                  'second(s)...'\
+                  % {'name': self.name, 'src': source.src, 'attempt': attempt,
+                     'attempts': retries + 1, 'wait': wait}
+            self.output.warn(msg, 2)
+            time.sleep(wait)
+        if error is not None:
+            raise error
+        if result == 0:
+            try:
+                self.changes = source.changed_files(base, snapshot)
+            except Exception as error:
+                self.output.debug('Overlay.sync(); failed to list the files '
+                                  'changed in %(name)s: %(err)s'
+                                  % {'name': self.name, 'err': error}, 4)
+            self.regen_cache(base)
+        return result
+
+
+    def regen_cache(self, base):
+        '''
+        Regenerates the metadata cache for the files changed by the last
+        sync (or for all packages if they are unknown).  A failure is only
+        reported, the overlay is usable without the cache.
+        '''
+        try:
+            result = self.sources[0].regen_cache(base, self.changes)
+            if result:
+                result = 'egencache returned status %s' % result
+        except Exception as error:
+            result = error
+        if result:
+            msg = 'Failed to regenerate the metadata cache of overlay '\
+                  '"%(name)s".\nError was: %(err)s'\
+                  % {'name': self.name, 'err': result}
+            self.output.warn(msg, 2)
 
 
     def to_json(self):
@@ -708,12 +839,18 @@ class Overlay(object):
             source = {'@type': i.__class__.type_key}
             if i.branch:
                 source['@branch'] = i.branch
+            if i.digest:
+                source['@digest'] = i.digest
+            if i.delta:
+                source['@delta'] = i.delta
             source['#text'] = i.src
             repo['source'].append(source)
         if self.feeds != None:
             repo['feed'] = []
             for feed in self.feeds:
                 repo['feed'].append(feed)
+        if self.sparse_paths:
+            repo['sparse'] = [i for i in self.sparse_paths]
 
         return repo
 
@@ -760,6 +897,10 @@ class Overlay(object):
                 source = ET.Element('source', type=i.__class__.type_key)
             else:
                 source = ET.Element('source', type=i.__class__.type_key, branch=i.branch)
+            if i.digest:
+                source.attrib['digest'] = i.digest
+            if i.delta:
+                source.attrib['delta'] = i.delta
             source.text = i.src
             repo.append(source)
             del source
@@ -773,6 +914,11 @@ class Overlay(object):
                 feed.text = i
                 repo.append(feed)
                 del feed
+        for i in self.sparse_paths:
+            sparse = ET.Element('sparse')
+            sparse.text = i
+            repo.append(sparse)
+            del sparse
         return repo
 
 
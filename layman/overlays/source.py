@@ -17,10 +17,21 @@ from __future__ import unicode_literals
 
 import os
 import copy
+import functools
+import re
 import sys
 import shutil
 import subprocess
-from layman.utils import path, resolve_command, run_command
+from layman.compatibility import fileopen
+from layman.constants import MOUNT_TYPES
+from layman.utils import int_option, path, resolve_command, run_command
+
+# metadata cache regenerated by regen_cache() and the stamp telling it
+# was generated by layman and not shipped by the overlay
+MD5_CACHE = 'metadata/md5-cache'
+MD5_CACHE_STAMP = 'metadata/.layman-md5-cache'
+
+EBUILD_REGEX = re.compile(r'^([^/]+/[^/]+)/[^/]+\.ebuild$')
 
 supported_cache = {}
 
@@ -46,6 +57,61 @@ def require_supported(binaries, _output):
     return True
 
 
+def changed_packages(changes):
+    '''
+    Determines the packages whose metadata may have changed.
+
+    @params changes: list of (status, path) tuples or None if unknown.
+    @rtype set of "category/package" strings, or None for all packages
+           (unknown changes, changed eclasses or layout.conf).
+    '''
+    if changes is None:
+        return None
+    packages = set()
+    for status, name in changes:
+        if name.startswith('eclass/') or name == 'metadata/layout.conf':
+            return None
+        match = EBUILD_REGEX.match(name)
+        if match:
+            packages.add(match.group(1))
+    return packages
+
+
+def tree_snapshot(target):
+    '''
+    Records the size and modification time of the files below target.
+
+    @params target: string of the directory to scan.
+    @rtype dict: {path relative to target: (size, mtime)}
+    '''
+    snapshot = {}
+    for root, dirs, files in os.walk(target):
+        for name in files:
+            location = os.path.join(root, name)
+            try:
+                info = os.lstat(location)
+            except OSError:
+                continue
+            snapshot[os.path.relpath(location, target)] = (info.st_size,
+                                                           info.st_mtime)
+    return snapshot
+
+
+def tree_changes(old, new):
+    '''
+    Compares two tree_snapshot()s.
+
+    @rtype list of (status, path) tuples, see OverlaySource.changed_files().
+    '''
+    changes = [('D', name) for name in old if name not in new]
+    for name, info in new.items():
+        if name not in old:
+            changes.append(('A', name))
+        elif old[name] != info:
+            changes.append(('M', name))
+    return sorted(changes, key=lambda change: change[1])
+
+
 class OverlaySource(object):
 
     type_key = None
@@ -58,6 +124,14 @@ class OverlaySource(object):
         self.ignore = ignore
 
         self.output = config['output']
+        # set by is_up_to_date()
+        self.upstream_revision = None
+        # bytes downloaded by the last add/sync, if the type can tell
+        self.transferred = None
+        # "algorithm:hexdigest" of archive sources, from the definition
+        self.digest = None
+        # URL of the binary deltas of squashfs sources, from the definition
+        self.delta = None
 
     def __eq__(self, other):
         return self.src == other.src
@@ -90,6 +164,77 @@ class OverlaySource(object):
         '''Sync the overlay.'''
         pass
 
+    def remote_revision(self, base):
+        '''
+        Cheaply determines the current revision of the upstream source
+        without fetching it.
+
+        @params base: base location where all overlays are installed.
+        @rtype str or None if the type has no way to tell.
+        '''
+        return None
+
+    def upstream_unreachable(self, base):
+        '''
+        Tells after a failed sync whether the upstream source could not be
+        reached, as opposed to a local failure like a merge conflict or
+        local changes in the installed overlay.
+
+        @params base: base location where all overlays are installed.
+        @rtype bool: False if the type has no way to tell.
+        '''
+        return False
+
+    def local_revision(self, base):
+        '''
+        Determines the upstream revision the installed overlay was last
+        synced to.
+
+        @params base: base location where all overlays are installed.
+        @rtype str or None if unknown.
+        '''
+        return None
+
+    def sync_snapshot(self, base):
+        '''
+        Records the state of the installed overlay changed_files()
+        compares against, called right before a sync.
+
+        @params base: base location where all overlays are installed.
+        @rtype type specific object.
+        '''
+        return None
+
+    def changed_files(self, base, snapshot):
+        '''
+        Lists the files the last sync changed.
+
+        @params base: base location where all overlays are installed.
+        @params snapshot: what sync_snapshot() returned before the sync.
+        @rtype list of (status, path) tuples with status "A" (added), "M"
+               (modified) or "D" (deleted) and path relative to the
+               overlay, or None if the type has no way to tell.
+        '''
+        return None
+
+    def is_up_to_date(self, base):
+        '''
+        Compares the upstream revision with the installed one.
+
+        @params base: base location where all overlays are installed.
+        @rtype bool: True if a sync would not change anything.
+        '''
+        self.upstream_revision = self.remote_revision(base)
+        if not self.upstream_revision:
+            return False
+        local = self.local_revision(base)
+        self.output.debug('%(type)s.is_up_to_date(); %(name)s remote: '
+                          '%(remote)s, local: %(local)s'
+                          % {'type': self.type, 'name': self.parent.name,
+                             'remote': self.upstream_revision,
+                             'local': local}, 6)
+        return local == self.upstream_revision
+
     def delete(self, base):
         '''Delete the overlay.'''
         mdir = path([base, self.parent.name])
@@ -117,6 +262,18 @@ class OverlaySource(object):
     def command(self):
         return self.config['%s_command' % self.__class__.type_key]
 
+    def timeout(self):
+        '''
+        Seconds a command of this overlay type may run before it is
+        killed, from <type>_timeout or else command_timeout.
+
+        @rtype int or None for no limit.
+        '''
+        key = '%s_timeout' % self.__class__.type_key
+        if not self.config[key]:
+            key = 'command_timeout'
+        return int_option(self.config, key, 0) or None
+
     def postsync(self, failed_sync, **kwargs):
         """Runs any repo specific postsync operations
         """
@@ -131,9 +288,66 @@ class OverlaySource(object):
                 kwargs.get('cwd', '')).split()
             command = _opt[0]
             args = _opt[1:]
+            pool = self.config['postsync_pool']
+            if pool is not None:
+                # run off the sync path, reported by LaymanAPI.sync()
+                pool.submit(self.parent.name, functools.partial(run_command,
+                    self.config, command, args,
+                    cmd='%s_postsync' % self.__class__.type_key))
+                return failed_sync
             return run_command(self.config, command, args,
                 cmd='%s_postsync' % self.__class__.type_key)
         return failed_sync
 
+    def regen_cache(self, base, changes):
+        '''
+        Post sync stage regenerating the metadata/md5-cache of the overlay
+        with egencache, if regen_cache is enabled.  Only the packages with
+        changed ebuilds are updated, egencache itself keeps the entries
+        of unchanged ebuilds (and eclasses) without sourcing them again.
+        Overlays shipping their own cache and read-only mounted overlays
+        are left alone.
+
+        @params base: base location where all overlays are installed.
+        @params changes: list of (status, path) tuples changed by the sync,
+                         None if unknown.
+        @rtype int
+        '''
+        if not self.config['regen_cache'] or changes == []:
+            return 0
+        if self.type in MOUNT_TYPES:
+            self.output.debug('OverlaySource.regen_cache(); %s is mounted '
+                              'read-only' % self.parent.name, 4)
+            return 0
+        target = path([base, self.parent.name])
+        stamp = path([target, MD5_CACHE_STAMP])
+        shipped = any(status != 'D' and name.startswith(MD5_CACHE + '/')
+                      for status, name in changes or [])
+        if shipped or not os.path.exists(stamp):
+            if shipped or os.path.exists(path([target, MD5_CACHE])):
+                self.output.debug('OverlaySource.regen_cache(); %s ships '
+                                  'its own metadata cache' % self.parent.name,
+                                  4)
+                if os.path.exists(stamp):
+                    os.unlink(stamp)
+                return 0
+            # first run
+            changes = None
+
+        packages = changed_packages(changes)
+        if packages is not None and not packages:
+            return 0
+        # egencache --update --repo NAME [CATEGORY/PACKAGE...]
+        args = ['--update', '--repo', self.parent.name]
+        if len(self.config['egencache_opts']):
+            args.extend(self.config['egencache_opts'].split())
+        args.extend(sorted(packages or []))
+        result = run_command(self.config, self.config['egencache_command'],
+                             args, cmd='egencache')
+        if result == 0:
+            with fileopen(stamp, 'w'):
+                pass
+        return result
+
     def to_xml_hook(self, repo_elem):
         pass
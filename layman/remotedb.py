@@ -26,6 +26,7 @@ __version__ = "$Id: db.py 309 2007-04-09 16:23:38Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
+import functools
 import os, os.path
 import sys
 import hashlib
@@ -39,8 +40,9 @@ except ImportError:
     pass
 
 
-from   layman.utils             import encoder
+from   layman.utils             import encoder, int_option
 from   layman.dbbase            import DbBase
+from   layman.scheduler         import HookPool
 from   layman.version           import VERSION
 from   layman.compatibility     import fileopen
 from   sslfetch.connections     import Connector
@@ -89,6 +91,9 @@ class RemoteDB(DbBase):
             self.output.debug('RemoteDB.__init__(), ignore = 0', 5)
             ignore = 0
 
+        # path -> dict of the overlays read from the list cached there
+        self._lists = {}
+
         #quiet = int(config['quietness']) < 3
         self.output.debug('RemoteDB.__init__(), DbBase.__init__() call', 5)
         DbBase.__init__(self, config, paths=paths, ignore=ignore,
@@ -104,10 +109,52 @@ class RemoteDB(DbBase):
         return 'Try running "sudo layman -f" to re-fetch that file'
 
 
+    def read_db(self, path, text=None, text_type=None):
+        '''
+        Reads a cached overlay list and keeps the overlays it defines,
+        see cache().
+        '''
+        if text is not None:
+            return DbBase.read_db(self, path, text=text, text_type=text_type)
+
+        success, parsed = self._parse_list(path)
+        if success:
+            self._lists[path] = parsed
+            self.overlays.update(parsed)
+        return success
+
+
+    def _parse_list(self, path, text=None):
+        '''
+        Parses an overlay list on its own, to know which overlays it
+        defines.
+
+        @params path: string location of the list, or its URL if text is
+                      given.
+        @params text: optional string of the list.
+        @rtype tuple (bool success, dict of the parsed overlays)
+        '''
+        overlays = self.overlays
+        self.overlays = {}
+        try:
+            if text is None:
+                success = DbBase.read_db(self, path)
+            else:
+                success = DbBase.read_db(self, path, text=text,
+                                         text_type='xml')
+        finally:
+            parsed, self.overlays = self.overlays, overlays
+        return success, parsed
+
+
     def cache(self):
         '''
         Copy the remote overlay list to the local cache.
 
+        The lists and detached signatures are downloaded by up to
+        fetch_jobs concurrent jobs, their verification and caching is
+        done one list after the other in the configured order.
+
         @rtype tuple: reflects whether the cache has updates and whether or not
         the cache retrieval was successful.
         '''
@@ -117,22 +164,31 @@ class RemoteDB(DbBase):
         succeeded = True
         url_lists = [self.urls, self.detached_urls, self.signed_urls]
         need_gpg = [False, True, True]
-        # setup the ssl-fetch output map
-        connector_output = {
-            'info':  self.output.info,
-            'debug': self.output.debug,
-            'error': self.output.error,
-            'exception': self.output.error,
-            # we want any warnings to be printed to the terminal
-            # so assign it to output.info with a lower noise level
-            'warning': self.output.info,
-            'kwargs-exception': {'level': None},
-            'kwargs-info': {'level': 5},
-            'kwargs-debug': {'level': 2},
-            'kwargs-error':{'level': None},
-            'kwargs-warning': {'level': 2},
-        }
-        fetcher = Connector(connector_output, self.proxies, USERAGENT)
+
+        pool = HookPool(int_option(self.config, 'fetch_jobs', 4), self.output)
+        for index in range(0, 3):
+            for url in url_lists[index]:
+                filepath, mpath, tpath, sig = self._paths(url)
+                if 'file://' in url:
+                    pool.submit(url, functools.partial(self._fetch_file,
+                                                       url, mpath, tpath))
+                elif sig:
+                    pool.submit(url[0], functools.partial(self._fetch_url,
+                                                          url[0], tpath))
+                    pool.submit(url[1], functools.partial(self.dl_sig,
+                                                          url[1], sig))
+                else:
+                    pool.submit(url, functools.partial(self._fetch_url,
+                                                       url, tpath))
+        results = iter(pool.wait())
+
+        def result():
+            key, fetched, error = next(results)
+            if error is not None:
+                self.output.error('RemoteDB.cache(); Failed to fetch %s\n'
+                                  'Error was: %s' % (key, error))
+                return False
+            return fetched
 
         for index in range(0, 3):
             self.output.debug("RemoteDB.cache() index = %s" %str(index), 2)
@@ -146,15 +202,11 @@ class RemoteDB(DbBase):
                 self.output.debug("RemoteDB.cache() url = %s is a tuple=%s"
                     %(str(url), str(isinstance(url, tuple))), 2)
                 filepath, mpath, tpath, sig = self._paths(url)
-                if 'file://' in url:
-                    success, olist, timestamp = self._fetch_file(
-                        url, mpath, tpath)
-                elif sig:
-                    success, olist, timestamp = fetcher.fetch_content(
-                        url[0], tpath, climit=60)
-                else:
-                    success, olist, timestamp = fetcher.fetch_content(
-                        url, tpath, climit=60)
+                fetched = result()
+                have_sig = result() if sig else True
+                if not fetched:
+                    continue
+                success, olist, timestamp = fetched
                 if not success:
                     #succeeded = False
                     continue
@@ -163,7 +215,12 @@ class RemoteDB(DbBase):
                     % str(len(olist)), 2)
                 # GPG handling
                 if need_gpg[index]:
-                    olist, verified = self.verify_gpg(url, sig, olist)
+                    if have_sig:
+                        olist, verified = self.verify_gpg(url, sig, olist)
+                    else:
+                        self.output.error('Failed to fetch the signature %s'
+                                          % url[1])
+                        olist, verified = '', False
                     if not verified:
                         self.output.debug("RemoteDB.cache() gpg returned "
                             "verified = %s" %str(verified), 2)
@@ -176,19 +233,54 @@ class RemoteDB(DbBase):
                 # Before we overwrite the old cache, check that the downloaded
                 # file is intact and can be parsed
                 if isinstance(url, tuple):
-                    olist = self._check_download(olist, url[0])
+                    olist, parsed = self._check_download(olist, url[0])
                 else:
-                    olist = self._check_download(olist, url)
+                    olist, parsed = self._check_download(olist, url)
 
                 # Ok, now we can overwrite the old cache
-                has_updates = max(has_updates,
-                    self.write_cache(olist, mpath, tpath, timestamp))
+                updated = self.write_cache(olist, mpath, tpath, timestamp)
+                has_updates = max(has_updates, updated)
+                # and keep what was parsed for this db
+                self._lists[mpath] = parsed
 
             self.output.debug("RemoteDB.cache() self.urls:  has_updates, "
                 "succeeded %s, %s" % (str(has_updates), str(succeeded)), 4)
+
+        if has_updates:
+            # later lists override the overlays of earlier ones
+            overlays = {}
+            for path in self.paths:
+                overlays.update(self._lists.get(path, {}))
+            self.overlays = overlays
         return has_updates, succeeded
 
 
+    def _fetch_url(self, url, tpath=None):
+        '''
+        Downloads url with a connector of its own, so that several
+        downloads can run concurrently.
+
+        @rtype tuple (success, content, timestamp)
+        '''
+        # setup the ssl-fetch output map
+        connector_output = {
+            'info':  self.output.info,
+            'debug': self.output.debug,
+            'error': self.output.error,
+            'exception': self.output.error,
+            # we want any warnings to be printed to the terminal
+            # so assign it to output.info with a lower noise level
+            'warning': self.output.info,
+            'kwargs-exception': {'level': None},
+            'kwargs-info': {'level': 5},
+            'kwargs-debug': {'level': 2},
+            'kwargs-error':{'level': None},
+            'kwargs-warning': {'level': 2},
+        }
+        fetcher = Connector(connector_output, self.proxies, USERAGENT)
+        return fetcher.fetch_content(url, tpath, climit=60)
+
+
     def _paths(self, url):
         self.output.debug("RemoteDB._paths(), url is tuple %s" % str(url), 2)
         if isinstance(url, tuple):
@@ -228,46 +320,58 @@ class RemoteDB(DbBase):
     def _fetch_file(self, url, mpath, tpath=None):
         self.output.debug('RemoteDB._fetch_file() url = %s' % url, 2)
         # check when the cache was last updated
-        # and don't re-fetch it unless it has changed
+        # and don't re-fetch it unless it has changed.  The timestamp of
+        # local lists is "<mtime> <size> <sha256>" of the file, the hash
+        # catches lists that were touched but not changed.
 
         filepath = url.replace('file://','')
-        url_timestamp = None
-        timestamp = ''
+        previous = ['', '', '']
 
         if tpath and os.path.exists(tpath):
-            with fileopen(tpath,'r') as previous:
-                timestamp = previous.read()
+            with fileopen(tpath,'r') as previous_file:
+                previous = (previous_file.read().split() + previous)[:3]
 
         if not self.check_path([mpath]):
             return (False, '', '')
 
         try:
-            url_timestamp = os.stat(filepath).st_mtime
-            if url_timestamp != timestamp:
+            stat = os.stat(filepath)
+            timestamp = ['%r' % stat.st_mtime, str(stat.st_size)]
+            cached = os.path.exists(mpath)
+            up_to_date = cached and timestamp == previous[:2]
+            if up_to_date:
+                timestamp.append(previous[2])
+            else:
                 self.output.debug('RemoteDB._fetch_file() opening file', 2)
                 # Fetch the remote list
                 with fileopen(filepath) as connection:
                     olist = connection.read()
-
-            else:
-                self.output.info('Remote list already up to date: %s'
-                    % url, 4)
-                self.output.info('Last-modified: %s' % timestamp, 4)
-        except IOError as error:
+                timestamp.append(hashlib.sha256(
+                    encoder(olist, 'UTF-8')).hexdigest())
+                up_to_date = cached and timestamp[2] == previous[2]
+                if up_to_date and tpath:
+                    # skip the hash the next time
+                    with fileopen(tpath, 'w') as out_file:
+                        out_file.write(' '.join(timestamp))
+        except (IOError, OSError) as error:
             self.output.error('RemoteDB._fetch_file(); Failed to update the '
                 'overlay list from: %s\nIOError was:%s\n'
                 % (url, str(error)))
             return (False, '', '')
-        else:
-            quieter = 1
-            self.output.info('Fetching new list... %s' % url, 4 + quieter)
-            if url_timestamp is not None:
-                self.output.info('Last-modified: %s' % url_timestamp,
-                    4 + quieter)
-            self.output.debug('RemoteDB._fetch_url(), olist type = %s'
-                % str(type(olist)),2)
 
-            return (True, olist, url_timestamp)
+        if up_to_date:
+            self.output.info('Remote list already up to date: %s'
+                % url, 4)
+            self.output.info('Last-modified: %s' % timestamp[0], 4)
+            return (False, '', '')
+
+        quieter = 1
+        self.output.info('Fetching new list... %s' % url, 4 + quieter)
+        self.output.info('Last-modified: %s' % timestamp[0], 4 + quieter)
+        self.output.debug('RemoteDB._fetch_url(), olist type = %s'
+            % str(type(olist)),2)
+
+        return (True, olist, ' '.join(timestamp))
 
     def check_path(self, paths, hint=True):
         '''Check for sufficient privileges'''
@@ -287,9 +391,15 @@ class RemoteDB(DbBase):
 
 
     def _check_download(self, olist, url):
+        '''
+        Parses a downloaded list to check it before it is cached.
 
+        @rtype tuple (string of the list, dict of the parsed overlays)
+        '''
         try:
-            self.read_db(url, text=olist, text_type="xml")
+            success, parsed = self._parse_list(url, text=olist)
+            if not success:
+                raise ValueError('The list is not valid XML')
         except Exception as error:
             self.output.debug("RemoteDB._check_download(), url=%s \nolist:\n"
                 % url,2)
@@ -303,22 +413,32 @@ class RemoteDB(DbBase):
         # the folowing is neded for py3 only
         if sys.hexversion >= 0x3000000 and hasattr(olist, 'decode'):
             olist = olist.decode("UTF-8")
-        return olist
+        return olist, parsed
 
 
     @staticmethod
     def write_cache(olist, mpath, tpath=None, timestamp=None):
+        '''
+        Caches olist at mpath, unless it is already cached there, so that
+        the modification time of the cache only changes with its content.
+
+        @rtype bool: whether the cache was written.
+        '''
         has_updates = False
         try:
-            with fileopen(mpath, 'w') as out_file:
-                out_file.write(olist)
+            cached = None
+            if os.path.exists(mpath):
+                with fileopen(mpath) as in_file:
+                    cached = in_file.read()
+            if cached != olist:
+                with fileopen(mpath, 'w') as out_file:
+                    out_file.write(olist)
+                has_updates = True
 
             if timestamp is not None and tpath is not None:
                 with fileopen(tpath, 'w') as out_file:
                     out_file.write(str(timestamp))
 
-            has_updates = True
-
         except Exception as error:
             raise IOError('Failed to temporarily cache overlays list in'
                           ' ' + mpath + '\nError was:\n' + str(error))
@@ -330,10 +450,9 @@ class RemoteDB(DbBase):
             " %s, type(olist)=%s" % (str(url),str(type(olist))), 2)
         #self.output.debug(olist, 2)
 
-        # detached sig
+        # detached sig, downloaded by cache() along with the list
         if sig:
             self.output.debug("RemoteDB.verify_gpg(), detached sig", 2)
-            self.dl_sig(url[1], sig)
             gpg_result = self.gpg.verify(
                 inputtxt=olist,
                 inputfile=sig)
@@ -358,9 +477,10 @@ class RemoteDB(DbBase):
 
     def dl_sig(self, url, sig):
         self.output.debug("RemoteDB.dl_sig() url=%s, sig=%s" % (url, sig), 2)
-        success, newsig, timestamp = self._fetch_url(url, sig)
+        success, newsig, timestamp = self._fetch_url(url)
         if success:
-            success = self.write_cache(newsig, sig)
+            # an unchanged signature is not rewritten, but still valid
+            self.write_cache(newsig, sig)
         return success
 
 
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+################################################################################
+# LAYMAN SYNC SCHEDULER
+################################################################################
+# File:       scheduler.py
+#
+#             Runs overlay sync jobs in a pool of worker threads.
+#
+# Copyright:
+#             (c) 2026 Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Runs overlay sync jobs in a pool of worker threads.'''
+
+from __future__ import unicode_literals
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import queue
+import threading
+
+from urllib.parse import urlparse
+
+from layman.utils import int_option, kill_process_groups
+
+
+def source_host(src):
+    '''
+    Determines the host an overlay source URL points to.
+
+    @params src: source URL, string.
+    @rtype str: lower case host name, '' for local sources.
+    '''
+    if '://' in src:
+        netloc = urlparse(src).netloc
+    # scp-like syntax, [user@]host:path
+    elif ':' in src.split('/')[0]:
+        netloc = src.split(':')[0]
+    else:
+        return ''
+    netloc = netloc.rpartition('@')[2]
+    if netloc.startswith('['):
+        # IPv6 literal
+        return netloc[1:].partition(']')[0].lower()
+    return netloc.partition(':')[0].lower()
+
+
+# Rough sync duration in seconds of an overlay of the given type, used
+# to place overlays without a recorded sync of their own or of other
+# overlays of the same type.
+TYPE_DURATIONS = {
+    'bzr': 30,
+    'cvs': 60,
+    'darcs': 30,
+    'g-common': 10,
+    'g-sorcery': 10,
+    'git': 20,
+    'mercurial': 30,
+    'rsync': 20,
+    'squashfs': 15,
+    'svn': 60,
+    'tar': 15,
+    'stub': 0,
+    }
+
+
+def longest_first(names, state, types):
+    '''
+    Orders overlays by their last recorded sync duration, longest first.
+    Overlays without a record are given the mean duration of the recorded
+    overlays of the same type, or the TYPE_DURATIONS estimate.
+
+    @params names: list of overlay names.
+    @params state: dict of the sync state, see layman.syncstate.
+    @params types: dict of overlay name: source type key.
+    @rtype list of overlay names.
+    '''
+    totals = {}
+    for name, entry in state.items():
+        if name in types:
+            total = totals.setdefault(types[name], [0.0, 0])
+            total[0] += entry['duration']
+            total[1] += 1
+
+    def duration(name):
+        if name in state:
+            return state[name]['duration']
+        type_key = types.get(name)
+        if type_key in totals:
+            return totals[type_key][0] / totals[type_key][1]
+        return TYPE_DURATIONS.get(type_key, 0)
+
+    # sorted() is stable, ties keep the given order
+    return sorted(names, key=lambda name: -duration(name))
+
+
+def given_order(names, state, types):
+    '''Keeps the overlays in the given order.'''
+    return names
+
+
+SYNC_ORDERS = {
+    'longest': longest_first,
+    'none': given_order,
+    }
+
+
+#===============================================================================
+#
+# Class SyncScheduler
+#
+#-------------------------------------------------------------------------------
+
+class SyncScheduler(object):
+    '''
+    Runs a list of jobs using a bounded pool of worker threads.
+
+    Jobs are grouped by the host they connect to.  No more than
+    host_limit jobs run against the same host at a time and the hosts
+    take turns, so one slow host can not hold up the jobs of the others.
+    With a single job slot the jobs are run in the calling thread so the
+    behaviour is identical to the plain serial loop.
+    '''
+
+    def __init__(self, config, jobs=None, host_limit=None):
+        self.config = config
+        self.output = config['output']
+        if jobs is None:
+            jobs = int_option(config, 'sync_jobs', 1)
+        if host_limit is None:
+            host_limit = int_option(config, 'sync_host_limit', 0)
+        self.jobs = max(1, jobs)
+        # 0 (or less) disables the per host limit
+        self.host_limit = max(0, host_limit)
+
+
+    def order(self, tasks, state, types):
+        '''
+        Orders the tasks according to the sync_order option: 'longest'
+        runs the overlays that took longest to sync first so that the
+        slow ones do not end up holding up the pool at the end, 'none'
+        keeps the given order and 'custom' calls the function set as
+        the custom_sync_order_func option with the same arguments as
+        longest_first().
+
+        @params tasks: list of (key, host, callable) tuples keyed by
+                       overlay name.
+        @params state: dict of the sync state, see layman.syncstate.
+        @params types: dict of overlay name: source type key.
+        @rtype list of (key, host, callable) tuples.
+        '''
+        sync_order = self.config['sync_order']
+        if sync_order == 'custom':
+            func = self.config['custom_sync_order_func']
+            if func is None:
+                self.output.warn('sync_order is "custom" but no '
+                                 'custom_sync_order_func is set, using '
+                                 '"longest"')
+                func = longest_first
+        elif sync_order in SYNC_ORDERS:
+            func = SYNC_ORDERS[sync_order]
+        else:
+            self.output.warn('Invalid value "%(value)s" for option '
+                             '"sync_order", using "longest"'
+                             % {'value': sync_order})
+            func = longest_first
+
+        by_key = dict((task[0], task) for task in tasks)
+        ordered = []
+        for key in func([task[0] for task in tasks], state, types):
+            if key in by_key:
+                ordered.append(by_key.pop(key))
+        # keep anything the ordering function left out
+        ordered.extend(task for task in tasks if task[0] in by_key)
+        self.output.debug('SyncScheduler.order(); %(order)s: %(keys)s'
+                          % {'order': sync_order,
+                             'keys': ', '.join(t[0] for t in ordered)}, 6)
+        return ordered
+
+
+    def run(self, tasks):
+        '''
+        Runs the tasks and collects their results.
+
+        @params tasks: list of (key, host, callable) tuples.
+        @rtype list of (key, result, error) tuples in the order of tasks,
+               error being the exception raised by the callable or None.
+        '''
+        results = [None] * len(tasks)
+        workers = min(self.jobs, len(tasks))
+
+        self.output.debug('SyncScheduler.run(); %(tasks)d task(s), '
+                          '%(workers)d worker(s), host limit %(limit)d'
+                          % {'tasks': len(tasks), 'workers': workers,
+                             'limit': self.host_limit}, 5)
+
+        # per host queues, served in turns
+        hosts = []
+        queues = {}
+        for index, task in enumerate(tasks):
+            host = task[1]
+            if host not in queues:
+                hosts.append(host)
+                queues[host] = []
+            queues[host].append(index)
+        running = dict((host, 0) for host in hosts)
+        state = {'turn': 0, 'left': len(tasks)}
+        cond = threading.Condition()
+
+        def next_task():
+            '''Picks the next runnable task, None if all have been taken.
+            Must be called with cond held.'''
+            while state['left']:
+                for i in range(len(hosts)):
+                    host = hosts[(state['turn'] + i) % len(hosts)]
+                    if not queues[host]:
+                        continue
+                    # local sources ('') are not limited
+                    if (self.host_limit and host
+                        and running[host] >= self.host_limit):
+                        continue
+                    state['turn'] = (state['turn'] + i + 1) % len(hosts)
+                    state['left'] -= 1
+                    running[host] += 1
+                    return queues[host].pop(0)
+                # every host with pending jobs is at its limit
+                cond.wait()
+            return None
+
+        def worker():
+            while True:
+                with cond:
+                    index = next_task()
+                if index is None:
+                    return
+                results[index] = self._run_task(tasks[index])
+                with cond:
+                    running[tasks[index][1]] -= 1
+                    cond.notify_all()
+
+        if workers <= 1:
+            worker()
+            return results
+
+        threads = [threading.Thread(target=worker, name='layman-sync-%d' % i)
+                   for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # join with a timeout so a KeyboardInterrupt reaches the main thread
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.2)
+        except KeyboardInterrupt:
+            # the daemon workers die with layman, their commands do not
+            kill_process_groups()
+            raise
+        return results
+
+
+    def _run_task(self, task):
+        key, host, func = task
+        self.output.debug('SyncScheduler; starting job %(key)s (host: '
+                          '%(host)s)' % {'key': key, 'host': host}, 6)
+        try:
+            return (key, func(), None)
+        except Exception as error:
+            return (key, None, error)
+
+
+class HookPool(object):
+    '''
+    Runs jobs in a bounded pool of worker threads, e.g. post sync hooks
+    while the syncs go on, so slow hooks do not hold up the sync jobs,
+    or the downloads of the remote overlay lists.
+    '''
+
+    def __init__(self, jobs, output):
+        '''
+        @params jobs: int maximum number of hooks run at the same time.
+        @params output: layman.output.Message object.
+        '''
+        self.output = output
+        self._queue = queue.Queue()
+        self._results = []
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._worker,
+                                          name='layman-hook-%d' % i)
+                         for i in range(max(1, jobs))]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+
+    def submit(self, key, func):
+        '''
+        Queues a hook.
+
+        @params key: string the result is reported under (overlay name).
+        @params func: callable returning the exit status of the hook.
+        '''
+        with self._lock:
+            index = len(self._results)
+            self._results.append(None)
+        self.output.debug('HookPool.submit(); queued hook of %s' % key, 6)
+        self._queue.put((index, key, func))
+
+
+    def wait(self):
+        '''
+        Waits for all queued hooks and stops the pool.
+
+        @rtype list of (key, result, error) tuples in the order the hooks
+               were submitted, error being the exception raised or None.
+        '''
+        for thread in self._threads:
+            self._queue.put(None)
+        # join with a timeout so a KeyboardInterrupt reaches the main thread
+        try:
+            for thread in self._threads:
+                while thread.is_alive():
+                    thread.join(0.2)
+        except KeyboardInterrupt:
+            # the daemon workers die with layman, their commands do not
+            kill_process_groups()
+            raise
+        return self._results
+
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            index, key, func = job
+            try:
+                self._results[index] = (key, func(), None)
+            except Exception as error:
+                self._results[index] = (key, None, error)
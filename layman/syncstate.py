@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+################################################################################
+# LAYMAN SYNC STATE
+################################################################################
+# File:       syncstate.py
+#
+#             Persistent record of the add/sync operations per overlay.
+#
+# Copyright:
+#             (c) 2026 Gentoo Foundation
+#             Distributed under the terms of the GNU General Public License v2
+#
+'''Persistent record of the add/sync operations per overlay.'''
+
+from __future__ import unicode_literals
+
+#===============================================================================
+#
+# Dependencies
+#
+#-------------------------------------------------------------------------------
+
+import json
+import os
+import tempfile
+import threading
+
+from layman.compatibility import fileopen
+
+#===============================================================================
+#
+# Class SyncState
+#
+#-------------------------------------------------------------------------------
+
+class SyncState(object):
+    '''
+    Keeps the timings, exit status and resulting revision of the last
+    add/sync operation of every installed overlay in a json file, along
+    with counters of all operations and failures.
+
+    Every overlay entry looks like:
+
+        {'action': 'sync', 'start': 1700000000.0, 'end': 1700000012.5,
+         'duration': 12.5, 'status': 0, 'bytes': None,
+         'revision': '1113a4574426777399264193a516aaa4fd5a2403',
+         'last_success': 1700000012.5, 'syncs': 42, 'failures': 1}
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.output = config['output']
+        self.path = config['sync_state']
+        # serializes the updates of concurrent sync jobs
+        self._lock = threading.Lock()
+
+
+    def read(self):
+        '''
+        Reads the stored state.
+
+        @rtype dict {'overlay-name': {...}, ...}
+        '''
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with fileopen(self.path) as state_file:
+                return json.load(state_file)
+        except (IOError, OSError, ValueError) as error:
+            self.output.warn('Failed to read the sync state file %(path)s'
+                             '\nError was: %(err)s'
+                             % {'path': self.path, 'err': error}, 2)
+            return {}
+
+
+    def get(self, name):
+        '''
+        Returns the stored state of a single overlay.
+
+        @params name: overlay name.
+        @rtype dict or None if the overlay has no record.
+        '''
+        return self.read().get(name)
+
+
+    def record(self, name, action, start, end, status, revision=None,
+               transferred=None):
+        '''
+        Records the outcome of an add/sync operation.
+
+        @params name: overlay name.
+        @params action: 'add' or 'sync'.
+        @params start: float time stamp the operation started at.
+        @params end: float time stamp the operation ended at.
+        @params status: int exit status, 0 for success.
+        @params revision: optional str of the resulting revision.
+        @params transferred: optional int number of bytes downloaded.
+        '''
+        with self._lock:
+            # re-read, another layman process may have written meanwhile
+            state = self.read()
+            entry = state.get(name, {'syncs': 0, 'failures': 0,
+                                     'last_success': None})
+            entry.update({
+                'action': action,
+                'start': start,
+                'end': end,
+                'duration': round(end - start, 3),
+                'status': status,
+                'bytes': transferred,
+                'revision': revision,
+                })
+            if action == 'sync':
+                entry['syncs'] += 1
+            if status:
+                entry['failures'] += 1
+            else:
+                entry['last_success'] = end
+            state[name] = entry
+            self._write(state)
+
+
+    def remove(self, name):
+        '''
+        Drops the record of an overlay.
+
+        @params name: overlay name.
+        '''
+        with self._lock:
+            state = self.read()
+            if name in state:
+                del state[name]
+                self._write(state)
+
+
+    def _write(self, state):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory,
+                prefix='.' + os.path.basename(self.path))
+            os.close(fd)
+            with fileopen(tmp_path, 'w') as state_file:
+                state_file.write(json.dumps(state, sort_keys=True, indent=2))
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as error:
+            self.output.warn('Failed to write the sync state file %(path)s'
+                             '\nError was: %(err)s'
+                             % {'path': self.path, 'err': error}, 2)
@@ -16,17 +16,28 @@
 
 '''Runs external (non-doctest) test cases.'''
 
+import _thread
+import asyncio
+import functools
 import os
 import sys
 import shutil
+import subprocess
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
 import xml.etree.ElementTree as ET # Python 2.5
+import hashlib
+import io
+import json
 #Py3
 try:
     import urllib.request as urllib
 except ImportError:
     import urllib
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from  layman.argsparser       import ArgsParser
 from  layman.api              import LaymanAPI
@@ -37,9 +48,15 @@ from  layman.config           import BareConfig, OptionConfig
 from  layman.maker            import Interactive
 from  layman.output           import Message
 from  layman.overlays.overlay import Overlay
+from  layman.overlays.source  import changed_packages
 from  layman.remotedb         import RemoteDB
 from  layman.repoconfmanager  import RepoConfManager
-from  layman.utils            import path
+from  layman.scheduler        import HookPool, SyncScheduler, \
+                                     longest_first, source_host
+from  layman.syncstate        import SyncState
+from  layman.utils            import path, run_command, CommandTimeout, \
+                                     async_run_command, \
+                                     async_get_command_output
 from  warnings import filterwarnings, resetwarnings
 
 encoding = sys.getdefaultencoding()
@@ -115,6 +132,604 @@ class AddDeleteEnableDisableFromConf(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+class QuietRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class HTTPServerTest(unittest.TestCase):
+    '''
+    Base class of the download tests, serves requests from a local HTTP
+    server in a background thread.
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='laymantmp_')
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def serve(self, handler):
+        self.server = HTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class ArchiveDownload(HTTPServerTest):
+    payload = b''.join(b'%06d' % i for i in range(20000))
+
+    def setUp(self):
+        super(ArchiveDownload, self).setUp()
+        self.ranges = []
+        payload, ranges = self.payload, self.ranges
+
+        class Handler(QuietRequestHandler):
+            def do_GET(self):
+                start = 0
+                ranges.append(self.headers.get('Range'))
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                if (self.headers.get('Range')
+                    and self.headers.get('If-Range') == '"v1"'):
+                    start = int(self.headers['Range'][6:].rstrip('-'))
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d'
+                                     % (start, len(payload) - 1,
+                                        len(payload)))
+                else:
+                    self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', len(payload) - start)
+                self.end_headers()
+                self.wfile.write(payload[start:])
+
+        self.serve(Handler)
+
+    def test(self):
+        try:
+            from layman.overlays.modules.tar.tar import TarOverlay
+        except ImportError:
+            return
+        url = 'http://127.0.0.1:%d/overlay.tar.bz2' % self.server.server_port
+        config = BareConfig()
+        overlay = Overlay(config, ovl_dict={
+            'name': 'download', 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [[url, 'tar', None,
+                        'sha256:' + hashlib.sha256(self.payload).hexdigest()]],
+            'status': 'unofficial', 'quality': 'experimental'})
+        source = overlay.sources[0]
+        self.assertEqual(overlay.to_xml().find('source').attrib['digest'],
+                         source.digest)
+
+        pkg = os.path.join(self.tmp_dir, 'download.tar.bz2')
+
+        def interrupted(data, etag=None):
+            with fileopen(pkg + '.part', 'wb') as part:
+                part.write(data)
+            if etag:
+                with fileopen(pkg + '.part.validators', 'w') as part:
+                    json.dump({'url': url, 'etag': etag}, part)
+            del self.ranges[:]
+
+        # resume an interrupted download of the same archive
+        interrupted(self.payload[:1000], '"v1"')
+        source._download(url, pkg)
+        self.assertEqual(self.ranges, ['bytes=1000-'])
+        self.assertEqual(source.transferred, len(self.payload) - 1000)
+        with fileopen(pkg, 'rb') as archive:
+            self.assertEqual(archive.read(), self.payload)
+        self.assertEqual(os.listdir(self.tmp_dir), ['download.tar.bz2'])
+
+        # a partial download of another archive, or of an unknown one,
+        # is started over
+        for etag in ('"v0"', None):
+            interrupted(b'x' * 1000, etag)
+            source._download(url, pkg)
+            self.assertEqual(self.ranges, ['bytes=1000-'] if etag else [None])
+            self.assertEqual(source.transferred, len(self.payload))
+            with fileopen(pkg, 'rb') as archive:
+                self.assertEqual(archive.read(), self.payload)
+
+        # corrupt data is neither installed nor kept for resuming
+        interrupted(b'x' * 1000, '"v1"')
+        self.assertRaises(Exception, source._download, url, pkg)
+        self.assertEqual(os.listdir(self.tmp_dir), ['download.tar.bz2'])
+
+        # an unchanged archive is not downloaded again
+        os.unlink(pkg)
+        validators = source._download(url, pkg)
+        self.assertEqual(validators['etag'], '"v1"')
+        self.assertEqual(validators['sha256'],
+                         hashlib.sha256(self.payload).hexdigest())
+        os.unlink(pkg)
+        self.assertEqual(source._download(url, pkg, validators), None)
+        self.assertFalse(os.path.exists(pkg))
+        self.assertEqual(source._fetch(self.tmp_dir, url, validators),
+                         (None, validators))
+
+        # deleting the overlay drops a partial download and its validators
+        interrupted(self.payload[:1000], '"v1"')
+        source.delete(self.tmp_dir)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class SquashfsDelta(HTTPServerTest):
+    def setUp(self):
+        super(SquashfsDelta, self).setUp()
+        self.requests = []
+        requests = self.requests
+        files = {'/overlay.sqfs': b'new',
+                 '/deltas/%s.vcdiff' % hashlib.sha256(b'old').hexdigest():
+                 b'new'}
+
+        class Handler(QuietRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                if self.path not in files:
+                    self.send_error(404)
+                    return
+                if self.headers.get('If-None-Match') == '"new"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', '"new"')
+                self.send_header('Content-Length', len(files[self.path]))
+                self.end_headers()
+                if self.command == 'GET':
+                    self.wfile.write(files[self.path])
+
+            def do_HEAD(self):
+                requests.append('HEAD ' + self.path)
+                self.do_GET()
+                requests.pop()
+
+        self.serve(Handler)
+
+    def test(self):
+        try:
+            from layman.overlays.modules.squashfs.squashfs import \
+                SquashfsOverlay
+        except ImportError:
+            return
+        # stands in for xdelta3, the test "deltas" are the new images
+        xdelta3 = os.path.join(self.tmp_dir, 'xdelta3')
+        with fileopen(xdelta3, 'w') as f:
+            f.write('#!/bin/sh\ncp "$5" "$6"\n')
+        os.chmod(xdelta3, 0o755)
+
+        url = 'http://127.0.0.1:%d' % self.server.server_port
+        config = OptionConfig(options={'xdelta3_command': xdelta3})
+        config.set_option('quietness', 3)
+        overlay = Overlay(config, ovl_dict={
+            'name': 'delta', 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [[url + '/overlay.sqfs', 'squashfs', None,
+                        'sha256:' + hashlib.sha256(b'new').hexdigest(),
+                        url + '/deltas']],
+            'status': 'unofficial', 'quality': 'experimental'})
+        source = overlay.sources[0]
+        self.assertEqual(overlay.to_xml().find('source').attrib['delta'],
+                         url + '/deltas')
+
+        # the kept image is updated with its delta
+        pkg = os.path.join(self.tmp_dir, 'delta.sqfs')
+        with fileopen(pkg, 'wb') as f:
+            f.write(b'old')
+        validators = {'sha256': hashlib.sha256(b'old').hexdigest()}
+        fetched = {'url': url + '/overlay.sqfs', 'etag': '"new"',
+                   'last_modified': None,
+                   'sha256': hashlib.sha256(b'new').hexdigest()}
+        self.assertEqual(source._fetch(self.tmp_dir, url + '/overlay.sqfs',
+                                       validators), (pkg, fetched))
+        with fileopen(pkg, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+        self.assertFalse(source.clean_archive)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['delta.sqfs', 'xdelta3'])
+
+        # without a delta for the image the download is conditional on
+        # the validators of the updated image
+        del self.requests[:]
+        self.assertEqual(source._fetch(self.tmp_dir, url + '/overlay.sqfs',
+                                       fetched), (None, fetched))
+        self.assertEqual(self.requests,
+                         ['HEAD /overlay.sqfs',
+                          '/deltas/%s.vcdiff'
+                          % hashlib.sha256(b'new').hexdigest(),
+                          '/overlay.sqfs'])
+
+        # and in full without an ETag or Last-Modified date to check
+        del self.requests[:]
+        source._fetch(self.tmp_dir, url + '/overlay.sqfs', validators)
+        self.assertEqual(self.requests[-1], '/overlay.sqfs')
+        with fileopen(pkg, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+
+
+class TarStreamExtract(unittest.TestCase):
+    def _write_archive(self, archive_path, files, links=()):
+        with tarfile.open(archive_path, 'w:bz2') as archive:
+            for name, link_type, linkname in links:
+                info = tarfile.TarInfo(name)
+                info.type = link_type
+                info.linkname = linkname
+                archive.addfile(info)
+            for name, data in files:
+                with fileopen(os.path.join(self.tmp_dir, 'member'),
+                              'wb') as f:
+                    f.write(data)
+                archive.add(os.path.join(self.tmp_dir, 'member'), name)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='laymantmp_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test(self):
+        archive_path = os.path.join(self.tmp_dir, 'overlay.tar.bz2')
+        self._write_archive(archive_path, [('top/sub/file', b'1'),
+                                           ('top/other', b'other')])
+        base = os.path.join(self.tmp_dir, 'base')
+        os.mkdir(base)
+        config = OptionConfig(options={'tar_stream': 'yes',
+                                       'check_upstream': False})
+        config.set_option('quietness', 3)
+        overlay = Overlay(config, ovl_dict={
+            'name': 'stream', 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [['file://' + urllib.pathname2url(archive_path),
+                        'tar', 'top/sub']],
+            'status': 'unofficial', 'quality': 'experimental'})
+        source = overlay.sources[0]
+        self.assertTrue(source.streaming())
+
+        # only the branch is extracted
+        self.assertEqual(source.add(base), 0)
+        target = os.path.join(base, 'stream')
+        self.assertEqual(os.listdir(target), ['file'])
+
+        # the old tree is swapped for the new one
+        self._write_archive(archive_path, [('top/sub/file', b'2')])
+        self.assertEqual(source.sync(base), 0)
+        self.assertFalse(source.not_modified)
+        with fileopen(os.path.join(target, 'file')) as f:
+            self.assertEqual(f.read(), '2')
+        self.assertEqual(sorted(os.listdir(base)),
+                         ['stream', 'stream.validators'])
+
+        # members outside of the destination are refused
+        self._write_archive(archive_path, [('../evil', b'evil')])
+        self.assertRaises(Exception, source.sync, base)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'evil')))
+        self.assertEqual(sorted(os.listdir(base)),
+                         ['stream', 'stream.validators'])
+
+        # so are links out of it, with or without the extraction filter
+        from layman.overlays.modules.tar import tar
+        extract_args = tar.EXTRACT_ARGS
+        try:
+            for tar.EXTRACT_ARGS in (extract_args, {}):
+                for link in [('top/sub/link', tarfile.SYMTYPE, '/etc'),
+                             ('top/sub/link', tarfile.SYMTYPE, '../../..'),
+                             # inside the archive but outside of the branch
+                             ('top/sub/link', tarfile.SYMTYPE,
+                              '../../etc-escape'),
+                             ('top/sub/link', tarfile.LNKTYPE, '../evil')]:
+                    self._write_archive(archive_path,
+                                        [('top/sub/file', b'3')], [link])
+                    self.assertRaises(Exception, source.sync, base)
+                    with fileopen(os.path.join(target, 'file')) as f:
+                        self.assertEqual(f.read(), '2')
+
+
+                self._write_archive(archive_path, [('top/sub/file', b'4')],
+                                    [('top/sub/link', tarfile.SYMTYPE,
+                                      'file')])
+                self.assertEqual(source.sync(base), 0)
+                with fileopen(os.path.join(target, 'link')) as f:
+                    self.assertEqual(f.read(), '4')
+                self._write_archive(archive_path, [('top/sub/file', b'2')])
+                self.assertEqual(source.sync(base), 0)
+        finally:
+            tar.EXTRACT_ARGS = extract_args
+
+
+class GitUpstreamTest(unittest.TestCase):
+    '''
+    Base class of the git overlay tests, sets up a local upstream
+    repository to add the overlays from.
+    '''
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='laymantmp_')
+        self.upstream = os.path.join(self.tmp_dir, 'upstream')
+        self.base = os.path.join(self.tmp_dir, 'base')
+        os.mkdir(self.base)
+        self.git(self.tmp_dir, 'init', '-q', self.upstream)
+        self.commit({'profiles/repo_name': 'upstream\n',
+                     'app-misc/foo/foo-1.ebuild': 'EAPI=7\n'})
+        self.config = OptionConfig(options={'check_upstream': False})
+        self.config.set_option('quiet', True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def git(self, cwd, *args):
+        return subprocess.check_output(
+            ['git', '-c', 'user.name=layman',
+             '-c', 'user.email=foo@example.org'] + list(args),
+            cwd=cwd, stderr=subprocess.STDOUT).decode('utf-8')
+
+    def commit(self, files):
+        for name, text in files.items():
+            filename = os.path.join(self.upstream, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with fileopen(filename, 'w') as f:
+                f.write(text)
+        self.git(self.upstream, 'add', '-A')
+        self.git(self.upstream, 'commit', '-q', '-m', 'update')
+        return self.git(self.upstream, 'rev-parse', 'HEAD').strip()
+
+    def overlay(self, name, src=None, branch=None, **ovl_dict):
+        ovl_dict.update({
+            'name': name, 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [[src or self.upstream, 'git', branch]],
+            'status': 'unofficial', 'quality': 'experimental'})
+        return Overlay(self.config, ovl_dict=ovl_dict)
+
+    def source(self, name, src=None, branch=None, **ovl_dict):
+        return self.overlay(name, src, branch, **ovl_dict).sources[0]
+
+
+class GitShallowClone(GitUpstreamTest):
+    def test(self):
+        self.config.set_option('git_clone_depth', '1')
+        self.commit({'app-misc/foo/foo-2.ebuild': 'EAPI=7\n'})
+        # git ignores --depth for plain local paths
+        source = self.source('shallow', 'file://' + self.upstream)
+        target = os.path.join(self.base, 'shallow')
+        self.assertEqual(source.add(self.base), 0)
+        self.assertEqual(self.git(target, 'rev-list', '--count', 'HEAD'),
+                         '1\n')
+
+        # local changes to files upstream did not touch are kept
+        with fileopen(os.path.join(target, 'app-misc', 'foo',
+                                   'foo-1.ebuild'), 'a') as f:
+            f.write('# local\n')
+        head = self.commit({'profiles/repo_name': 'shallow\n'})
+        self.assertEqual(source.sync(self.base), 0)
+        self.assertEqual(self.git(target, 'rev-parse', 'HEAD').strip(), head)
+        self.assertEqual(self.git(target, 'rev-list', '--count', 'HEAD'),
+                         '1\n')
+        with fileopen(os.path.join(target, 'app-misc', 'foo',
+                                   'foo-1.ebuild')) as f:
+            self.assertEqual(f.read(), 'EAPI=7\n# local\n')
+
+        # a rewritten upstream history is followed
+        self.git(self.upstream, 'commit', '-q', '--amend', '-m', 'rewritten')
+        head = self.git(self.upstream, 'rev-parse', 'HEAD').strip()
+        self.assertEqual(source.sync(self.base), 0)
+        self.assertEqual(self.git(target, 'rev-parse', 'HEAD').strip(), head)
+
+
+class GitCheckUpstream(GitUpstreamTest):
+    def test(self):
+        self.config.set_option('check_upstream', True)
+        overlay = self.overlay('check')
+        source = overlay.sources[0]
+        target = os.path.join(self.base, 'check')
+        self.assertEqual(source.add(self.base), 0)
+        synced = []
+        sync = source.sync
+        source.sync = lambda base: synced.append(base) or sync(base)
+
+        # an unchanged upstream is not fetched
+        self.assertEqual(overlay.sync(self.base), 0)
+        self.assertEqual((synced, overlay.changes), ([], []))
+
+        head = self.commit({'app-misc/foo/foo-2.ebuild': 'EAPI=7\n'})
+        self.assertEqual(overlay.sync(self.base), 0)
+        self.assertEqual(synced, [self.base])
+        self.assertEqual(self.git(target, 'rev-parse', 'HEAD').strip(), head)
+        self.assertEqual(overlay.changes, [('A', 'app-misc/foo/foo-2.ebuild')])
+
+
+class GitSharedObjects(GitUpstreamTest):
+    def test(self):
+        self.config.set_option('git_shared_objects', True)
+        self.git(self.upstream, 'checkout', '-q', '-b', 'dev')
+        self.commit({'app-misc/foo/foo-2.ebuild': 'EAPI=7\n'})
+        self.git(self.upstream, 'checkout', '-q', 'master')
+        self.commit({'app-misc/foo/foo-3.ebuild': 'EAPI=7\n'})
+        # plain local paths are cloned by copying the objects, file://
+        # URLs borrow them from the pool
+        src = 'file://' + self.upstream
+        one, two = self.source('one', src), self.source('two', src, 'dev')
+        self.assertEqual(one.add(self.base), 0)
+        self.assertEqual(two.add(self.base), 0)
+        self.assertTrue(two._uses_object_pool(self.base))
+        pool = os.path.join(self.base, '.git-objects')
+        # only layman collects the pool, it knows what the overlays borrow
+        self.assertEqual(self.git(pool, 'config', 'gc.auto').strip(), '0')
+
+        # two borrows the objects of origin/master, fetched for one
+        self.assertTrue(one.delete(self.base))
+        self.git(pool, 'gc', '-q', '--prune=now')
+        target = os.path.join(self.base, 'two')
+        self.git(target, 'fsck', '--full')
+        self.git(target, 'log', '-q', 'origin/master')
+
+
+class GitSparseCheckout(GitUpstreamTest):
+    def setUp(self):
+        super(GitSparseCheckout, self).setUp()
+        self.commit({'dev-util/bar/bar-1.ebuild': 'EAPI=7\n',
+                     'eclass/foo.eclass': '\n',
+                     'metadata/layout.conf': 'masters = gentoo\n'})
+
+    def checked_out(self, name):
+        return sorted(e for e in os.listdir(os.path.join(self.base, name))
+                      if e != '.git')
+
+    def test(self):
+        overlay = self.overlay('sparse', sparse=['app-misc'])
+        source = overlay.sources[0]
+        self.assertEqual(source.add(self.base), 0)
+        self.assertEqual(self.checked_out('sparse'),
+                         ['app-misc', 'eclass', 'metadata', 'profiles'])
+
+        # changed paths are applied on sync
+        overlay.set_sparse_paths(['dev-util'])
+        self.assertEqual(source.sync(self.base), 0)
+        self.assertEqual(self.checked_out('sparse'),
+                         ['dev-util', 'eclass', 'metadata', 'profiles'])
+
+        # and cleared ones check out everything
+        overlay.set_sparse_paths([])
+        self.assertEqual(source.sync(self.base), 0)
+        self.assertEqual(self.checked_out('sparse'),
+                         ['app-misc', 'dev-util', 'eclass', 'metadata',
+                          'profiles'])
+
+    def test_readd(self):
+        repos = os.path.join(self.tmp_dir, 'repositories.xml')
+        with fileopen(repos, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<repositories version="1.0">\n'
+                    '  <repo quality="experimental" status="unofficial">\n'
+                    '    <name>sparse</name>\n'
+                    '    <description>XXXXXXXXXXX</description>\n'
+                    '    <owner><email>foo@example.org</email></owner>\n'
+                    '    <source type="git">%s</source>\n'
+                    '  </repo>\n'
+                    '</repositories>\n' % self.upstream)
+        for key, value in [
+                ('installed', os.path.join(self.tmp_dir, 'installed.xml')),
+                ('cache', os.path.join(self.tmp_dir, 'cache')),
+                ('overlays', ['file://' + repos]),
+                ('conf_type', ['repos.conf']),
+                ('repos_conf', os.path.join(self.tmp_dir, 'repos.conf')),
+                ('storage', self.base), ('nocheck', 'yes'),
+                ('check_official', False), ('sparse_paths', ['app-misc'])]:
+            self.config.set_option(key, value)
+        api = LaymanAPI(config=self.config)
+        self.assertTrue(api.fetch_remote_list())
+        self.assertTrue(api.add_repos('sparse'))
+        sparse = ['app-misc', 'eclass', 'metadata', 'profiles']
+        self.assertEqual(self.checked_out('sparse'), sparse)
+
+        # --sparse-paths is only given with --add
+        self.config.set_option('sparse_paths', None)
+        api = LaymanAPI(config=self.config)
+        self.assertTrue(api.readd_repos('sparse'))
+        self.assertEqual(api._get_installed_db().select('sparse').sparse_paths,
+                         ['app-misc'])
+        self.assertEqual(self.checked_out('sparse'), sparse)
+
+
+class GitMirror(GitUpstreamTest):
+    def test(self):
+        mirrors = os.path.join(self.tmp_dir, 'mirrors')
+        self.config.set_option('vcs_mirror_dir', mirrors)
+        self.config.set_option('vcs_mirror_interval', '3600')
+        mirror = os.path.join(mirrors, 'git', hashlib.sha1(
+            self.upstream.encode('utf-8')).hexdigest())
+        old = self.git(self.upstream, 'rev-parse', 'HEAD').strip()
+
+        one = self.source('one')
+        self.assertEqual(one.add(self.base), 0)
+        self.assertEqual(self.git(mirror, 'rev-parse', 'HEAD').strip(), old)
+        # the clones only borrow the mirror through url.insteadOf
+        two = os.path.join(self.base, 'two')
+        new = self.commit({'app-misc/foo/foo-2.ebuild': 'EAPI=7\n'})
+        source = self.source('two')
+        self.assertEqual(source.add(self.base), 0)
+        self.assertEqual(self.git(two, 'config', 'remote.origin.url').strip(),
+                         self.upstream)
+
+        # within vcs_mirror_interval the mirror is not updated
+        self.assertEqual(self.git(two, 'rev-parse', 'HEAD').strip(), old)
+        self.assertEqual(source.sync(self.base), 0)
+        self.assertEqual(self.git(two, 'rev-parse', 'HEAD').strip(), old)
+
+        self.config.set_option('vcs_mirror_interval', '0')
+        self.assertEqual(source.sync(self.base), 0)
+        self.assertEqual(self.git(mirror, 'rev-parse', 'HEAD').strip(), new)
+        self.assertEqual(self.git(two, 'rev-parse', 'HEAD').strip(), new)
+
+
+class MercurialMirror(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='laymantmp_')
+        self.upstream = os.path.join(self.tmp_dir, 'upstream')
+        self.base = os.path.join(self.tmp_dir, 'base')
+        os.mkdir(self.base)
+        self.config = OptionConfig(options={'check_upstream': False})
+        self.config.set_option('quiet', True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def hg(self, cwd, *args):
+        return subprocess.check_output(
+            ['hg', '--config', 'ui.username=layman <foo@example.org>']
+            + list(args), cwd=cwd, stderr=subprocess.STDOUT).decode('utf-8')
+
+    def commit(self, name):
+        filename = os.path.join(self.upstream, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with fileopen(filename, 'w') as f:
+            f.write('EAPI=7\n')
+        self.hg(self.upstream, 'commit', '-q', '-A', '-m', 'update')
+        return self.hg(self.upstream, 'identify', '-i').strip()
+
+    def test(self):
+        if not shutil.which('hg'):
+            return
+        self.hg(self.tmp_dir, 'init', self.upstream)
+        old = self.commit('app-misc/foo/foo-1.ebuild')
+        mirrors = os.path.join(self.tmp_dir, 'mirrors')
+        self.config.set_option('vcs_mirror_dir', mirrors)
+        self.config.set_option('vcs_mirror_interval', '3600')
+        src = self.upstream + '/'
+        mirror = os.path.join(mirrors, 'mercurial',
+                              hashlib.sha1(src.encode('utf-8')).hexdigest())
+        ovl_dict = {
+            'name': 'hgmirror', 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [[self.upstream, 'mercurial', None]],
+            'status': 'unofficial', 'quality': 'experimental'}
+        source = Overlay(self.config, ovl_dict=ovl_dict).sources[0]
+        target = os.path.join(self.base, 'hgmirror')
+
+        self.assertEqual(source.add(self.base), 0)
+        self.assertEqual(self.hg(mirror, 'identify', '-i', '-r', 'tip')
+                         .strip(), old)
+        # the clone pulls from upstream without the mirror tier
+        self.assertEqual(self.hg(target, 'paths', 'default').strip(),
+                         src.rstrip('/'))
+
+        # within vcs_mirror_interval the mirror is not updated
+        new = self.commit('app-misc/foo/foo-2.ebuild')
+        self.assertEqual(source.sync(self.base), 0)
+        self.assertEqual(self.hg(target, 'identify', '-i').strip(), old)
+
+        self.config.set_option('vcs_mirror_interval', '0')
+        self.assertEqual(source.sync(self.base), 0)
+        self.assertEqual(self.hg(target, 'identify', '-i').strip(), new)
+
+
 class AddDeleteDB(unittest.TestCase):
     def test(self):
         repo_name     = 'tar_test_overlay'
@@ -206,6 +821,131 @@ class AddDeleteDB(unittest.TestCase):
         shutil.rmtree(temp_dir_path)
 
 
+class DBSyncFailover(unittest.TestCase):
+    def test(self):
+        repo_name     = 'tar_test_overlay'
+        temp_dir_path = tempfile.mkdtemp(prefix='laymantmp_')
+        db_file       = os.path.join(temp_dir_path, 'installed.xml')
+        repo_conf     = os.path.join(temp_dir_path, 'repos.conf')
+
+        tar_source_path = os.path.join(HERE, 'testfiles', 'layman-test.tar.bz2')
+        sources = []
+        for i in range(2):
+            (_, temp_tarball_path) = tempfile.mkstemp()
+            shutil.copyfile(tar_source_path, temp_tarball_path)
+            sources.append('file://'
+                           + urllib.pathname2url(temp_tarball_path))
+
+        my_opts = {'installed'       : db_file,
+                   'conf_type'       : ['repos.conf'],
+                   'nocheck'         : 'yes',
+                   'repos_conf'      : repo_conf,
+                   'storage'         : temp_dir_path,
+                   'check_official'  : False,
+                   'check_upstream'  : False,
+                   'sync_failover'   : True,
+                   'sync_retries'    : '1',
+                   'sync_retry_delay': '0'}
+        config = OptionConfig(options=my_opts)
+        config.set_option('quietness', 3)
+        def installed_sources():
+            c = DbBase(config, paths=[db_file,])
+            return list(c.select(repo_name).source_uris())
+
+        overlay = Overlay(config, ovl_dict={
+            'name': repo_name, 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [[sources[0], 'tar', None]],
+            'status': 'unofficial', 'quality': 'experimental'})
+        db = DB(config)
+        self.assertTrue(db.add(overlay))
+
+        # a source that can be reached is kept whatever went wrong
+        with fileopen(sources[0][len('file://'):], 'wb') as f:
+            f.write(b'garbage')
+        self.assertRaises(Exception, db.sync, repo_name,
+                          alternates=sources[1:])
+        self.assertEqual(len(db.select(repo_name).sync_attempts), 2)
+        self.assertEqual(installed_sources(), sources[:1])
+
+        # the first source goes away, the sync only fails over to the
+        # second with sync_failover set
+        os.unlink(sources[0][len('file://'):])
+        config.set_option('sync_failover', False)
+        self.assertRaises(Exception, db.sync, repo_name,
+                          alternates=sources[1:])
+        self.assertEqual(installed_sources(), sources[:1])
+
+        config.set_option('sync_failover', True)
+        db.sync(repo_name, alternates=sources[1:])
+        attempts = db.select(repo_name).sync_attempts
+        self.assertEqual([(src, status == 0) for src, status, _ in attempts],
+                         [(sources[0], False), (sources[0], False),
+                          (sources[1], True)])
+        self.assertEqual(installed_sources(), sources[1:])
+
+        # without any alternate left the sync fails
+        os.unlink(sources[1][len('file://'):])
+        self.assertRaises(Exception, db.sync, repo_name)
+        self.assertEqual(len(db.select(repo_name).sync_attempts), 2)
+
+        shutil.rmtree(temp_dir_path)
+
+
+class DBSyncManifest(unittest.TestCase):
+    def test(self):
+        repo_name     = 'tar_test_overlay'
+        temp_dir_path = tempfile.mkdtemp(prefix='laymantmp_')
+        manifest_dir  = os.path.join(temp_dir_path, 'changes')
+        tar_source_path = os.path.join(HERE, 'testfiles', 'layman-test.tar.bz2')
+
+        my_opts = {'installed'        : os.path.join(temp_dir_path,
+                                                     'installed.xml'),
+                   'conf_type'        : ['repos.conf'],
+                   'nocheck'          : 'yes',
+                   'repos_conf'       : os.path.join(temp_dir_path,
+                                                     'repos.conf'),
+                   'storage'          : temp_dir_path,
+                   'check_official'   : False,
+                   'check_upstream'   : False,
+                   'sync_manifest_dir': manifest_dir}
+        config = OptionConfig(options=my_opts)
+        config.set_option('quietness', 3)
+
+        overlay = Overlay(config, ovl_dict={
+            'name': repo_name, 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [['file://' + urllib.pathname2url(tar_source_path),
+                        'tar', None]],
+            'status': 'unofficial', 'quality': 'experimental'})
+        db = DB(config)
+        self.assertTrue(db.add(overlay))
+
+        target = os.path.join(temp_dir_path, repo_name, 'layman-test')
+        ebuild = os.path.join('app-admin', 'layman', 'layman-0.8.ebuild')
+        os.unlink(os.path.join(target, ebuild))
+        with fileopen(os.path.join(target, 'stray'), 'w') as f:
+            f.write('stray')
+
+        # the unchanged archive is not extracted again
+        db.sync(repo_name)
+        self.assertEqual(db.select(repo_name).changes, [])
+        self.assertTrue(os.path.exists(os.path.join(target, 'stray')))
+
+        # local changes are reverted once the archive has to be extracted
+        os.unlink(os.path.join(temp_dir_path, repo_name + '.validators'))
+        db.sync(repo_name)
+        changes = [('A', os.path.join('layman-test', ebuild)),
+                   ('D', os.path.join('layman-test', 'stray'))]
+        self.assertEqual(db.select(repo_name).changes, changes)
+        with fileopen(os.path.join(manifest_dir,
+                                   repo_name + '.changes')) as f:
+            self.assertEqual(f.read(), ''.join('%s\t%s\n' % change
+                                               for change in changes))
+
+        shutil.rmtree(temp_dir_path)
+
+
 # Tests archive overlay types (squashfs, tar)
 # http://bugs.gentoo.org/show_bug.cgi?id=304547
 class ArchiveAddRemoveSync(unittest.TestCase):
@@ -338,28 +1078,41 @@ class CLIArgs(unittest.TestCase):
         self.assertTrue(test_url in a['overlays'].split('\n'))
 
         test_keys = ['auto_sync', 'bzr_addopts', 'bzr_command', 'bzr_postsync',
-                     'bzr_syncopts', 'cache', 'check_official', 'clean_archive',
+                     'bzr_syncopts', 'cache', 'check_official',
+                     'check_upstream', 'clean_archive', 'command_timeout',
                      'conf_module', 'conf_type', 'config', 'configdir',
                      'custom_news_pkg', 'cvs_addopts', 'cvs_command',
                      'cvs_postsync', 'cvs_syncopts', 'darcs_addopts',
                      'darcs_command', 'darcs_postsync', 'darcs_syncopts',
-                     'db_type', 'g-common_command', 'g-common_generateopts',
+                     'db_type', 'egencache_command', 'egencache_opts',
+                     'fetch_jobs', 'g-common_command', 'g-common_generateopts',
                      'g-common_postsync', 'g-common_syncopts',
                      'g-sorcery_command', 'g-sorcery_generateopts',
                      'g-sorcery_postsync', 'g-sorcery_syncopts', 'git_addopts',
-                     'git_command', 'git_email', 'git_postsync', 'git_syncopts',
+                     'git_clone_depth',
+                     'git_command', 'git_email', 'git_partial_clone',
+                     'git_postsync', 'git_shared_objects', 'git_syncopts',
                      'git_user', 'gpg_detached_lists', 'gpg_signed_lists',
                      'http_proxy', 'https_proxy', 'installed', 'local_list',
                      'make_conf', 'mercurial_addopts', 'mercurial_command',
                      'mercurial_postsync', 'mercurial_syncopts',
-                     'news_reporter', 'nocheck', 'overlay_defs', 'overlays',
-                     'protocol_filter', 'quietness', 'repos_conf',
+                     'news_reporter', 'nocheck', 'overlay_defs',
+                     'overlay_sync_intervals', 'overlays', 'postsync_jobs',
+                     'protocol_filter', 'quietness', 'regen_cache',
+                     'repos_conf',
                      'require_repoconfig', 'rsync_command', 'rsync_postsync',
                      'rsync_syncopts', 'squashfs_addopts', 'squashfs_command',
                      'squashfs_postsync', 'squashfs_syncopts', 'storage',
                      'support_url_updates', 'svn_addopts', 'svn_command',
-                     'svn_postsync', 'svn_syncopts', 't/f_options',
-                     'tar_command', 'tar_postsync', 'umask', 'width']
+                     'svn_postsync', 'svn_syncopts', 'sync_failover',
+                     'sync_host_limit',
+                     'sync_jobs', 'sync_manifest_dir', 'sync_min_interval',
+                     'sync_order',
+                     'sync_retries', 'sync_retry_delay', 'sync_state',
+                     't/f_options',
+                     'tar_command', 'tar_postsync', 'tar_stream', 'umask',
+                     'vcs_mirror_dir', 'vcs_mirror_interval', 'width',
+                     'xdelta3_command']
         # Due to this not being a dict object, the keys() invocation is needed.
         self.assertEqual(sorted(a.keys()), test_keys)
 
@@ -580,10 +1333,28 @@ class OverlayObjTest(unittest.TestCase):
         print(ovl.short_list(80).decode('utf-8'))
 
 
+    def sparsepaths(self):
+        document = ET.parse(HERE + '/testfiles/global-overlays.xml')
+        overlays = document.findall('overlay') + document.findall('repo')
+        config = {'output': Message(), 'db_type': 'xml'}
+
+        ovl = Overlay(config, xml=overlays[0])
+        self.assertEqual(ovl.sparse_paths, [])
+        self.assertEqual(ovl.to_xml().findall('sparse'), [])
+        self.assertTrue('sparse' not in ovl.to_json())
+
+        ovl.set_sparse_paths(['app-misc/', 'dev-util', '/'])
+        self.assertEqual(ovl.sparse_paths, ['app-misc', 'dev-util'])
+        for ovl_copy in (Overlay(config, xml=ovl.to_xml()),
+                         Overlay(config, json=ovl.to_json())):
+            self.assertEqual(ovl_copy.sparse_paths, ['app-misc', 'dev-util'])
+
+
     def test(self):
         self.objattribs()
         self.getinfostr()
         self.getshortlist()
+        self.sparsepaths()
 
 
 class PathUtil(unittest.TestCase):
@@ -732,6 +1503,88 @@ class ReadWriteSelectListDbBase(unittest.TestCase):
         self.write_db()
 
 
+class XMLStreamRead(unittest.TestCase):
+    def test(self):
+        from layman.db_modules.xml_db.xml_db import DBHandler
+        config = OptionConfig({'nocheck': 'yes'})
+        config.set_option('quietness', 0)
+        with fileopen(HERE + '/testfiles/global-overlays.xml', 'rb') as f:
+            text = f.read()
+        # cut off in the middle of the second overlay
+        broken = text[:text.index(b'</overlay>') + 40]
+
+        # the first overlay is there before the end of the list is read
+        overlays = DBHandler(config, {}, ignore=2).iter_overlays(
+            io.BytesIO(broken))
+        self.assertEqual(next(overlays).name, 'wrobel')
+        self.assertRaises(ET.ParseError, next, overlays)
+
+        # but a broken list adds no overlays at all
+        db_overlays = {}
+        db = DBHandler(config, db_overlays, ignore=2)
+        self.assertFalse(db.read(broken, 'broken'))
+        self.assertEqual(db_overlays, {})
+        self.assertTrue(db.read(text.decode('utf-8'), 'text'))
+        self.assertEqual(sorted(db_overlays), ['wrobel', 'wrobel-stable'])
+
+
+class RegenCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='laymantmp_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test(self):
+        self.assertEqual(changed_packages(None), None)
+        self.assertEqual(changed_packages([
+            ('M', 'app-misc/foo/foo-1.ebuild'),
+            ('D', 'app-misc/bar/bar-2.ebuild'),
+            ('A', 'app-misc/foo/files/foo.patch'),
+            ('M', 'app-misc/foo/Manifest')]),
+            set(['app-misc/foo', 'app-misc/bar']))
+        self.assertEqual(changed_packages([('M', 'eclass/foo.eclass')]),
+                         None)
+
+        config = OptionConfig({'regen_cache': 'yes',
+                               'egencache_command': '/bin/true'})
+        overlay = Overlay(config, ovl_dict={
+            'name': 'regen', 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [['rsync://example.org/regen', 'rsync', None]],
+            'status': 'unofficial', 'quality': 'experimental'})
+        source = overlay.sources[0]
+        stamp = os.path.join(self.tmp_dir, 'regen', 'metadata',
+                             '.layman-md5-cache')
+        os.makedirs(os.path.dirname(stamp))
+
+        self.assertEqual(source.regen_cache(self.tmp_dir, None), 0)
+        self.assertTrue(os.path.exists(stamp))
+
+        # nothing to regenerate runs nothing
+        config.set_option('egencache_command', '/bin/false')
+        self.assertEqual(source.regen_cache(self.tmp_dir, []), 0)
+        self.assertEqual(source.regen_cache(self.tmp_dir,
+                         [('M', 'app-misc/foo/metadata.xml')]), 0)
+        self.assertEqual(source.regen_cache(self.tmp_dir,
+                         [('M', 'app-misc/foo/foo-1.ebuild')]), 1)
+
+        # the overlay started to ship its own cache
+        self.assertEqual(source.regen_cache(self.tmp_dir,
+                         [('A', 'metadata/md5-cache/app-misc/foo-1')]), 0)
+        self.assertFalse(os.path.exists(stamp))
+
+        # read-only mounted overlays cannot take a cache
+        squashfs = Overlay(config, ovl_dict={
+            'name': 'regen', 'description': ['XXXXXXXXXXX'],
+            'owner': [{'email': 'foo@example.org'}],
+            'source': [['https://example.org/regen.squashfs', 'squashfs',
+                        None]],
+            'status': 'unofficial', 'quality': 'experimental'})
+        self.assertEqual(squashfs.sources[0].regen_cache(self.tmp_dir, None),
+                         0)
+
+
 class RemoteDBCache(unittest.TestCase):
     def test(self):
         tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
@@ -763,6 +1616,334 @@ class RemoteDBCache(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+class RemoteDBCacheJobs(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        lists = ['file://' + HERE + '/testfiles/global-overlays.xml',
+                 'file://' + os.path.join(tmpdir, 'missing.xml'),
+                 'file://' + HERE + '/testfiles/subpath-1.xml']
+        config = OptionConfig({'overlays': lists,
+                               'cache': os.path.join(tmpdir, 'cache'),
+                               'nocheck': 'yes',
+                               'fetch_jobs': '2'})
+        config.set_option('quietness', 0)
+        db = RemoteDB(config)
+        # a list failing to download does not hold up the others
+        self.assertEqual(db.cache(), (True, True))
+        self.assertTrue(os.path.exists(db.filepath(lists[0]) + '.xml'))
+        self.assertFalse(os.path.exists(db.filepath(lists[1]) + '.xml'))
+        self.assertTrue(os.path.exists(db.filepath(lists[2]) + '.xml'))
+
+        shutil.rmtree(tmpdir)
+
+
+class RemoteDBFileChanges(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        list_path = os.path.join(tmpdir, 'overlays.xml')
+        shutil.copyfile(HERE + '/testfiles/global-overlays.xml', list_path)
+        url = 'file://' + list_path
+        config = OptionConfig({'overlays': [url],
+                               'cache': os.path.join(tmpdir, 'cache'),
+                               'nocheck': 'yes'})
+        config.set_option('quietness', 0)
+        db = RemoteDB(config)
+        cache_path = db.filepath(url) + '.xml'
+        self.assertEqual(db.cache(), (True, True))
+        os.utime(cache_path, (1, 1))
+
+        # an unchanged list is neither read nor cached again
+        self.assertEqual(db.cache(), (False, True))
+        # a touched list is recognized by its hash
+        os.utime(list_path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(db.cache(), (False, True))
+        self.assertEqual(os.path.getmtime(cache_path), 1)
+        with fileopen(db.filepath(url) + '.timestamp') as f:
+            self.assertEqual(f.read().split()[0],
+                             '%r' % os.stat(list_path).st_mtime)
+
+        with fileopen(HERE + '/testfiles/subpath-1.xml') as f:
+            text = f.read()
+        with fileopen(list_path, 'w') as f:
+            f.write(text)
+        self.assertEqual(db.cache(), (True, True))
+        with fileopen(cache_path) as f:
+            self.assertEqual(f.read(), text)
+
+        # an unchanged signature is still a successful download
+        sig_path = db.filepath(url) + '.sig'
+        db._fetch_url = lambda url, tpath=None: (True, 'signature', '')
+        self.assertTrue(db.dl_sig(url, sig_path))
+        self.assertTrue(db.dl_sig(url, sig_path))
+        db._fetch_url = lambda url, tpath=None: (False, '', '')
+        self.assertFalse(db.dl_sig(url, sig_path))
+
+        shutil.rmtree(tmpdir)
+
+
+class RemoteDBReload(unittest.TestCase):
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        url = 'file://' + HERE + '/testfiles/global-overlays.xml'
+        config = OptionConfig({'overlays': [url],
+                               'cache': os.path.join(tmpdir, 'cache'),
+                               'nocheck': 'yes'})
+        db = RemoteDB(config)
+        self.assertEqual(db.overlays, {})
+        cache_path = db.filepath(url) + '.xml'
+
+        self.assertEqual(db.cache(), (True, True))
+        self.assertEqual(sorted(db.overlays), ['wrobel', 'wrobel-stable'])
+        loaded = RemoteDB(config)
+        self.assertEqual(loaded, db)
+        # the overlays share one controller of the overlay type modules
+        controllers = set(id(ovl.module_controller)
+                          for ovl in loaded.overlays.values())
+        self.assertEqual(len(controllers), 1)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(cache_path))),
+                         sorted(os.path.basename(p) for p in
+                                [cache_path, db.filepath(url) + '.timestamp']))
+
+        # a changed list is read again
+        with fileopen(HERE + '/testfiles/subpath-1.xml') as f:
+            text = f.read()
+        with fileopen(cache_path, 'w') as f:
+            f.write(text)
+        self.assertEqual(sorted(RemoteDB(config).overlays),
+                         sorted(DbBase(config, [cache_path]).overlays))
+
+        shutil.rmtree(tmpdir)
+
+
+class RunCommandTimeout(unittest.TestCase):
+    def test(self):
+        config = OptionConfig({'quiet': True})
+        self.assertEqual(run_command(config, '/bin/sh', ['-c', 'exit 3'],
+                                     timeout=10), 3)
+
+        start = time.time()
+        # the background sleep is part of the killed process group
+        with self.assertRaises(CommandTimeout) as context:
+            run_command(config, '/bin/sh', ['-c', 'sleep 30 & sleep 30'],
+                        timeout=1)
+        self.assertTrue(time.time() - start < 10)
+        self.assertTrue(context.exception.elapsed >= 1)
+        self.assertTrue('timed out after' in str(context.exception))
+
+    def test_interrupt(self):
+        # the commands lead sessions of their own, a Ctrl-C of layman
+        # does not reach them
+        config = OptionConfig({'quiet': True})
+        tmp_dir = tempfile.mkdtemp(prefix='laymantmp_')
+        pid_files = [os.path.join(tmp_dir, str(i)) for i in range(2)]
+        tasks = [(str(i), '', functools.partial(run_command, config,
+                  '/bin/sh', ['-c', 'echo $$ > %s; exec sleep 30' % pid_file],
+                  timeout=60))
+                 for i, pid_file in enumerate(pid_files)]
+        config.set_option('sync_jobs', '2')
+        scheduler = SyncScheduler(config)
+
+        def interrupt():
+            while not all(os.path.getsize(f) if os.path.exists(f) else 0
+                          for f in pid_files):
+                time.sleep(0.05)
+            _thread.interrupt_main()
+        threading.Thread(target=interrupt).start()
+        start = time.time()
+        self.assertRaises(KeyboardInterrupt, scheduler.run, tasks)
+
+        for pid_file in pid_files:
+            with fileopen(pid_file) as f:
+                pid = int(f.read())
+            # reaped by the event loop of the daemon worker
+            while time.time() - start < 10:
+                try:
+                    os.kill(pid, 0)
+                except OSError:
+                    break
+                time.sleep(0.05)
+            self.assertRaises(OSError, os.kill, pid, 0)
+        shutil.rmtree(tmp_dir)
+
+
+class AsyncRunCommand(unittest.TestCase):
+    def test(self):
+        config = OptionConfig({'quiet': True})
+
+        async def run_both():
+            # the commands run side by side on the same event loop
+            return await asyncio.gather(
+                async_run_command(config, '/bin/sh', ['-c', 'exit 3']),
+                async_get_command_output(config, '/bin/sh',
+                                         ['-c', 'echo "$LAYMAN_TEST"'],
+                                         env={'LAYMAN_TEST': 'passed'}))
+        self.assertEqual(asyncio.run(run_both()), [3, (0, 'passed\n')])
+
+        with self.assertRaises(CommandTimeout):
+            asyncio.run(async_run_command(config, '/bin/sh',
+                                          ['-c', 'sleep 30'], timeout=1))
+
+        # the synchronous wrapper also works from a running event loop
+        async def nested():
+            return run_command(config, '/bin/sh', ['-c', 'exit 4'])
+        self.assertEqual(asyncio.run(nested()), 4)
+
+        # and from the worker threads of the sync scheduler and hook pool
+        results = []
+        worker = threading.Thread(target=lambda: results.append(
+            run_command(config, '/bin/sh', ['-c', 'exit 5'])))
+        worker.start()
+        worker.join()
+        self.assertEqual(results, [5])
+
+
+class HookPoolRun(unittest.TestCase):
+    def test(self):
+        pool = HookPool(2, Message())
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            time.sleep(0.2)
+            return 0
+
+        def broken():
+            raise Exception('broken')
+
+        pool.submit('slow', slow)
+        pool.submit('failed', lambda: 1)
+        pool.submit('broken', broken)
+        # the hooks run while the caller goes on
+        self.assertTrue(started.wait(5))
+        results = pool.wait()
+        self.assertEqual([(key, result) for key, result, _ in results],
+                         [('slow', 0), ('failed', 1), ('broken', None)])
+        self.assertEqual(str(results[2][2]), 'broken')
+
+
+class SyncSchedulerRun(unittest.TestCase):
+    def job(self, name):
+        def func():
+            if name == 'broken':
+                raise Exception('sync failed')
+            return name.upper()
+        return func
+
+    def test(self):
+        names = ['wrobel', 'broken', 'wrobel-stable', 'gentoo-zh']
+        for jobs in (1, 3):
+            config = OptionConfig({'sync_jobs': jobs})
+            results = SyncScheduler(config).run(
+                [(name, '', self.job(name)) for name in names])
+
+            self.assertEqual([r[0] for r in results], names)
+            self.assertEqual(results[0][1:], ('WROBEL', None))
+            self.assertEqual(str(results[1][2]), 'sync failed')
+            self.assertEqual(results[3][1], 'GENTOO-ZH')
+
+
+class SyncSchedulerHostLimit(unittest.TestCase):
+    def test(self):
+        self.assertEqual(source_host('https://github.com/a/b.git'),
+                         'github.com')
+        self.assertEqual(source_host('git+ssh://git@GitHub.com:22/a/b'),
+                         'github.com')
+        self.assertEqual(source_host('git@github.com:a/b.git'), 'github.com')
+        self.assertEqual(source_host('file:///var/lib/overlay.tar.gz'), '')
+        self.assertEqual(source_host('/var/lib/overlay'), '')
+
+        lock = threading.Lock()
+        running = {'github.com': 0, 'gitweb.gentoo.org': 0}
+        peak = dict(running)
+        order = []
+
+        def job(host):
+            def func():
+                with lock:
+                    order.append(host)
+                    running[host] += 1
+                    peak[host] = max(peak[host], running[host])
+                time.sleep(0.05)
+                with lock:
+                    running[host] -= 1
+            return func
+
+        hosts = ['github.com'] * 6 + ['gitweb.gentoo.org'] * 2
+        tasks = [(i, host, job(host)) for i, host in enumerate(hosts)]
+
+        config = OptionConfig({'sync_jobs': 1})
+        SyncScheduler(config).run(tasks)
+        # hosts take turns while both have pending jobs
+        self.assertEqual(order[:4], ['github.com', 'gitweb.gentoo.org'] * 2)
+
+        config = OptionConfig({'sync_jobs': 6, 'sync_host_limit': 2})
+        results = SyncScheduler(config).run(tasks)
+        self.assertEqual([r[0] for r in results], list(range(len(hosts))))
+        self.assertEqual(peak['github.com'], 2)
+
+
+class SyncSchedulerOrder(unittest.TestCase):
+    def test(self):
+        state = {'wrobel': {'duration': 2.0},
+                 'gentoo-zh': {'duration': 30.0},
+                 'wrobel-stable': {'duration': 4.0},
+                 'sunrise': {'duration': 10.0}}
+        types = {'wrobel': 'svn', 'gentoo-zh': 'git', 'wrobel-stable': 'svn',
+                 'sunrise': 'git', 'new-git': 'git', 'new-tar': 'tar'}
+        names = ['wrobel', 'new-tar', 'wrobel-stable', 'new-git',
+                 'gentoo-zh', 'sunrise']
+        # new-git gets the git mean of 20s, new-tar the tar estimate
+        self.assertEqual(longest_first(names, state, types),
+                         ['gentoo-zh', 'new-git', 'new-tar', 'sunrise',
+                          'wrobel-stable', 'wrobel'])
+
+        tasks = [(name, '', None) for name in names]
+        config = OptionConfig({'sync_order': 'none'})
+        self.assertEqual(SyncScheduler(config).order(tasks, state, types),
+                         tasks)
+
+        def custom(names, state, types):
+            return sorted(names)[:2]
+        config = OptionConfig({'sync_order': 'custom',
+                               'custom_sync_order_func': custom})
+        ordered = SyncScheduler(config).order(tasks, state, types)
+        self.assertEqual([task[0] for task in ordered],
+                         ['gentoo-zh', 'new-git', 'wrobel', 'new-tar',
+                          'wrobel-stable', 'sunrise'])
+
+
+class SyncStateRecord(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='tmpsyncstate')
+        self.state_path = os.path.join(self.tmp_dir, 'sync_state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test(self):
+        config = OptionConfig({'sync_state': self.state_path})
+        state = SyncState(config)
+        self.assertEqual(state.read(), {})
+
+        state.record('wrobel', 'add', 10.0, 12.5, 0, revision='abc',
+                     transferred=2048)
+        state.record('wrobel', 'sync', 20.0, 21.0, 1)
+        state.record('wrobel-stable', 'sync', 30.0, 40.0, 0)
+
+        # a new instance reads the data back from disk
+        entry = SyncState(config).get('wrobel')
+        self.assertEqual(entry['action'], 'sync')
+        self.assertEqual(entry['duration'], 1.0)
+        self.assertEqual(entry['status'], 1)
+        self.assertEqual(entry['revision'], None)
+        self.assertEqual(entry['last_success'], 12.5)
+        self.assertEqual((entry['syncs'], entry['failures']), (1, 1))
+
+        state.remove('wrobel')
+        self.assertEqual(list(state.read()), ['wrobel-stable'])
+        self.assertEqual(os.listdir(self.tmp_dir), ['sync_state.json'])
+
+
 if __name__ == '__main__':
     filterwarnings('ignore')
     unittest.main()
@@ -31,13 +31,18 @@ __version__ = '$Id: utils.py 236 2006-09-05 20:39:37Z wrobel $'
 #
 #-------------------------------------------------------------------------------
 
+import asyncio
 import codecs
 import copy
+import ctypes
+import errno
 import locale
 import os
 import re
-import subprocess
+import signal
 import sys
+import threading
+import time
 import types
 
 from  layman.output         import Message
@@ -202,6 +207,29 @@ def reload_config(config):
     config.read_config(defaults)
 
 
+def int_option(config, key, default=0):
+    '''
+    Reads an integer option from the config, falling back to default
+    when it is unset or not a valid number.
+
+    @params config: layman.config object.
+    @params key: option name.
+    @params default: int returned for unset or invalid values.
+    @rtype int
+    '''
+    value = config[key]
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        config['output'].warn('Invalid value "%(value)s" for option '
+                              '"%(key)s", using %(default)s'
+                              % {'value': value, 'key': key,
+                                 'default': default})
+        return default
+
+
 def resolve_command(command, output):
     if os.path.isabs(command):
         if not os.path.exists(command):
@@ -220,11 +248,127 @@ def resolve_command(command, output):
         return ('Command', None)
 
 
-def run_command(config, command, args, **kwargs):
+class CommandTimeout(Exception):
+    '''
+    Raised by run_command() and get_command_output() when the command
+    ran longer than its timeout and was killed.
+    '''
+    def __init__(self, command, timeout, elapsed):
+        self.command = command
+        self.timeout = timeout
+        self.elapsed = elapsed
+
+
+    def __str__(self):
+        return 'Command timed out after %(elapsed).1f seconds (limit: '\
+               '%(timeout)s seconds) and was killed: %(cmd)s'\
+               % {'elapsed': self.elapsed, 'timeout': self.timeout,
+                  'cmd': self.command}
+
+
+# (command, PATH) -> resolved binary, so $PATH is walked once per command
+_resolved_commands = {}
+
+def _resolve_cached(command, output):
+    key = (command, os.environ.get('PATH', ''))
+    if key not in _resolved_commands:
+        file_to_run = resolve_command(command, output)[1]
+        if not file_to_run:
+            return None
+        _resolved_commands[key] = file_to_run
+    return _resolved_commands[key]
+
+
+# process groups of the running commands started with a timeout, they
+# lead a session of their own and do not get the SIGINT of a Ctrl-C
+_process_groups = set()
+_process_groups_lock = threading.Lock()
+
+
+def kill_process_groups():
+    '''
+    Terminates the process groups of all commands still running with a
+    timeout, called on a KeyboardInterrupt.  The commands run in other
+    threads than the one getting the interrupt are not cancelled, and
+    the daemon threads running them do not keep layman from exiting.
+    '''
+    with _process_groups_lock:
+        groups = list(_process_groups)
+    for pgid in groups:
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+        except OSError:
+            # already gone
+            pass
+
+
+def _run_coroutine(coro):
+    '''
+    Runs coro to completion from synchronous code and returns its result.
+    When the calling thread already runs an event loop the coroutine is
+    run on a private loop in a helper thread.
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        try:
+            return asyncio.run(coro)
+        except KeyboardInterrupt:
+            kill_process_groups()
+            raise
+
+    outcome = {}
+    def runner():
+        try:
+            outcome['result'] = asyncio.run(coro)
+        except BaseException as error:
+            outcome['error'] = error
+    thread = threading.Thread(target=runner)
+    thread.daemon = True
+    thread.start()
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        kill_process_groups()
+        raise
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+async def async_run_command(config, command, args, **kwargs):
+    '''
+    Runs command with args as a child process without blocking the
+    event loop.
+
+    Accepts the same keyword arguments as run_command(): cwd, env (a
+    dict of updates to the surrounding environment), cmd (a label
+    for the output) and timeout (seconds, None or 0 for no limit).
+    A command running past its timeout is killed along with all of its
+    children and CommandTimeout is raised.
+
+    @rtype int: exit status of the command.
+    '''
+    result, stdout = await _async_command(config, command, args, False,
+                                          kwargs)
+    return result
+
+
+async def async_get_command_output(config, command, args, **kwargs):
+    '''
+    Like async_run_command() but captures the standard output of the
+    command instead of passing it through.
+
+    @rtype tuple: (exit status, decoded standard output)
+    '''
+    return await _async_command(config, command, args, True, kwargs)
+
+
+async def _async_command(config, command, args, capture, kwargs):
     output = config['output']
-    output.debug("Utils.run_command(): " + command, 6)
+    output.debug("Utils.async_run_command(): " + command, 6)
 
-    file_to_run = resolve_command(command, output.error)[1]
+    file_to_run = _resolve_cached(command, output.error)
     args = [file_to_run] + args
     assert('pwd' not in kwargs)  # Bug detector
 
@@ -238,7 +382,7 @@ def run_command(config, command, args, **kwargs):
         env = copy.copy(os.environ)
         env.update(env_updates)
 
-    command_repr = ' '.join(args)
+    command_repr = ' '.join(str(a) for a in args)
     if env_updates is not None:
         command_repr = '%s %s' % (' '.join('%s=%s' % (k, v) for (k, v)
             in sorted(env_updates.items())), command_repr)
@@ -249,40 +393,108 @@ def run_command(config, command, args, **kwargs):
     output.info('Running %s... # %s' % (cmd, command_repr), 2)
 
     if config['quiet']:
-
-        input_source = subprocess.PIPE
-        output_target = open('/dev/null', 'w')
+        # Make child non-interactive and drop its output
+        input_source = asyncio.subprocess.DEVNULL
+        output_target = asyncio.subprocess.DEVNULL
     else:
         # Re-use parent file descriptors
         input_source = None
         output_target = None
-
-    proc = subprocess.Popen(args,
+    if capture:
+        input_source = asyncio.subprocess.DEVNULL
+        output_target = asyncio.subprocess.PIPE
+
+    timeout = kwargs.get('timeout') or None
+    start = time.monotonic()
+    # with a timeout the child leads a process group of its own, so
+    # the helpers it spawns (ssh, proxies) are killed along with it
+    proc = await asyncio.create_subprocess_exec(*args,
         stdin=input_source,
         stdout=output_target,
         stderr=config['stderr'],
         cwd=cwd,
-        env=env)
-
-    if config['quiet']:
-        # Make child non-interactive
-        proc.stdin.close()
+        env=env,
+        start_new_session=bool(timeout))
+    if timeout:
+        with _process_groups_lock:
+            _process_groups.add(proc.pid)
 
+    stdout = ''
     try:
-        result = proc.wait()
+        if capture:
+            data = (await asyncio.wait_for(proc.communicate(), timeout))[0]
+            stdout = data.decode('UTF-8', 'replace')
+        result = await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        await _kill_process_group(proc)
+        elapsed = time.monotonic() - start
+        output.error('Killed %(cmd)s after %(elapsed).1f seconds: %(repr)s'
+                     % {'cmd': cmd, 'elapsed': elapsed,
+                        'repr': command_repr})
+        raise CommandTimeout(command_repr, timeout, elapsed)
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        if proc.returncode is None:
+            if timeout:
+                await _kill_process_group(proc)
+            else:
+                proc.kill()
+        raise
     except Exception as err:
         output.error(
             'Unknown exception running command: %s' % command_repr)
         output.error('Original error was: %s' % str(err))
         result = 1
-
-    if config['quiet']:
-        output_target.close()
+    finally:
+        if timeout:
+            with _process_groups_lock:
+                _process_groups.discard(proc.pid)
 
     if result:
         output.info('Failure result returned from %s' % cmd , 2)
 
-    return result
+    return result, stdout
+
+
+async def _kill_process_group(proc, grace=5):
+    '''
+    Terminates the process group led by proc, killing it if it is still
+    running after grace seconds.
+    '''
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            # already gone
+            pass
+        try:
+            await asyncio.wait_for(proc.wait(), grace)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+
+def run_command(config, command, args, **kwargs):
+    '''
+    Synchronous wrapper around async_run_command(), see there.
+
+    Every call runs an event loop of its own until the command exits, so
+    the calling thread is blocked just as with subprocess.  The overlay
+    sources and the SyncScheduler use this wrapper, and concurrent syncs
+    still take one worker thread each.
+
+    @rtype int: exit status of the command.
+    '''
+    return _run_coroutine(async_run_command(config, command, args, **kwargs))
+
+
+def get_command_output(config, command, args, **kwargs):
+    '''
+    Synchronous wrapper around async_get_command_output(), see there.
+
+    @rtype tuple: (exit status, decoded standard output)
+    '''
+    return _run_coroutine(
+        async_get_command_output(config, command, args, **kwargs))
 
 
 def verify_overlay_src(current_src, remote_srcs):
@@ -322,6 +534,39 @@ def delete_empty_directory(mdir, output=None):
                 output.warn('Hint: You are not root.')
 
 
+# renameat2() arguments, see rename(2)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+def exchange_paths(first, second):
+    '''
+    Atomically swaps two existing paths on the same file system with
+    renameat2(RENAME_EXCHANGE), so that neither of them is missing at any
+    time.
+
+    @params first: string of the first path.
+    @params second: string of the second path.
+    @rtype bool: False if the platform or file system does not support
+           the exchange, in which case nothing was changed.
+    '''
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (AttributeError, OSError):
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                          ctypes.c_char_p, ctypes.c_uint]
+    encoding = sys.getfilesystemencoding() or 'utf-8'
+    names = [name if isinstance(name, bytes) else name.encode(encoding)
+             for name in (first, second)]
+    if renameat2(AT_FDCWD, names[0], AT_FDCWD, names[1],
+                 RENAME_EXCHANGE) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL):
+        return False
+    raise OSError(error, os.strerror(error), first)
+
+
 def create_overlay_dict(**kwargs):
     """Creates a complete empty reository definition.
     Then fills it with values passed in
@@ -7,6 +7,10 @@ from distutils.core import setup, Command
 from distutils.dir_util import copy_tree
 
 
+if sys.version_info < (3, 8):
+    sys.exit('layman requires Python 3.8 or newer')
+
+
 # this affects the names of all the directories we do stuff with
 sys.path.insert(0, './')
 from layman.version import VERSION